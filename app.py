@@ -4,9 +4,11 @@ import ui.mainpage.main_page as main_page
 from ui.mainpage.mainbar_widgets import Chat
 from ui.mainpage.group_widgets import Group
 import json
+import protocol # Shared framing and codecs (JSON, MessagePack, CBOR)
 import time
 import struct
 import threading
+import itertools
 import os
 import sys
 import platform
@@ -48,8 +50,9 @@ def get_godot_executable_path():
     return executable_path
 
 # Network-related constants
-MSG_LENGTH_PREFIX_FORMAT = '!I'  # Network byte order, Unsigned Integer (4 bytes)
-MSG_LENGTH_PREFIX_SIZE = struct.calcsize(MSG_LENGTH_PREFIX_FORMAT)
+MSG_LENGTH_PREFIX_FORMAT = protocol.MSG_LENGTH_PREFIX_FORMAT  # Network byte order, Unsigned Integer (4 bytes)
+MSG_LENGTH_PREFIX_SIZE = protocol.MSG_LENGTH_PREFIX_SIZE
+COMPRESSION_DICT_PATH = "compression.dict" # Optional shared dictionary, trained with benchmarks/compression_bench.py
 
 # Get the correct path
 GODOT_EXECUTABLE_PATH = get_godot_executable_path()
@@ -70,8 +73,9 @@ def format_timestamp(unix_ts):
 
 class MainWindow(QMainWindow):
     serversReceived = Signal(list)  # Signal carrying a list of servers
+    bootstrapReceived = Signal(list) # Servers with their latest history and members (LOGIN_BOOTSTRAP)
     messageReceived = Signal(list)
-    messageHistory = Signal(int, list)
+    messageHistory = Signal(int, list, str) # server_id, messages, page ('latest', 'before' or 'after')
     onlineUsers = Signal(list, int)
     modifyUserStatus = Signal(str, bool)
     onlineCount = Signal(int, int)
@@ -111,6 +115,7 @@ class MainWindow(QMainWindow):
 
 
         self.serversReceived.connect(self.getMyServers)
+        self.bootstrapReceived.connect(self.loadBootstrap)
         self.messageReceived.connect(self.displayMessage)
         self.messageHistory.connect(self.loadHistory)
         self.onlineUsers.connect(self.showUsers)
@@ -221,15 +226,17 @@ class MainWindow(QMainWindow):
             child.deleteLater()
 
 
-    def loadHistory(self, server_id, list):
+    def loadHistory(self, server_id, list, page="latest"):
         # ... (existing code) ...
-        self.deleteHistory(server_id)
-        for msg_data in list:
+        if page == "latest":
+            self.deleteHistory(server_id)
+        for position, msg_data in enumerate(list):
             ts = format_timestamp(msg_data.get('timestamp'))
             sender = msg_data.get('sender_username', 'Unknown')
             content = msg_data.get('content', '')
             print(f"  ({ts}) {sender}: {content}")
-            self.displayMessage([server_id,ts,sender,content])
+            # Older pages go above what is already shown, newer ones below
+            self.displayMessage([server_id,ts,sender,content], position if page == "before" else None)
         print("  --- End of History ---")
 
 
@@ -259,11 +266,11 @@ class MainWindow(QMainWindow):
         if (username and password):
             if (self.handleAuth(username, password, "L")):
                 self.m_receiving_thread.start()
-                self.sendRequest("/my_servers")
+                self.sendRequest("/bootstrap") # Servers, history and members in one round trip
                 self.switch_layout()
 
 
-    def getMyServers(self, servers):
+    def getMyServers(self, servers, requestDetails=True):
         # ... (existing code) ...
         groupBar = self.m_main_page.m_mainBar.m_groupBar
         chatContainer = self.m_main_page.m_chatsContainer
@@ -287,7 +294,16 @@ class MainWindow(QMainWindow):
         # --- Rebuild from server list ---
         for server_item in servers:
             isAdmin = self.m_username == server_item.get('admin_username', 'N/A')
-            self.addGroup(server_item.get('name'), server_item.get('server_id'), server_item.get('invite_code'), isAdmin)
+            self.addGroup(server_item.get('name'), server_item.get('server_id'), server_item.get('invite_code'), isAdmin, requestDetails)
+
+
+    def loadBootstrap(self, servers):
+        # Rebuild the groups without per-group requests, then fill each from the bootstrap data
+        self.getMyServers(servers, requestDetails=False)
+        for server_item in servers:
+            server_id = server_item.get('server_id')
+            self.loadHistory(server_id, server_item.get('messages', []), "latest")
+            self.showUsers(server_item.get('members', []), server_id)
 
 
     def sendMessage(self, ChatID):
@@ -298,7 +314,7 @@ class MainWindow(QMainWindow):
         self.m_main_page.m_chatsContainer.m_chats[ChatID].m_chatView.m_inputMessageBar.m_inputBar.setText("")
 
 
-    def displayMessage(self, list):
+    def displayMessage(self, list, index=None):
         global authenticated_user_details
         print(f"{self.m_userID} : {self.m_username}")
         server_id = list[0]
@@ -318,7 +334,7 @@ class MainWindow(QMainWindow):
         is_admin = chat.m_isAdmin
 
         # <<< Pass server_id to add_message >>>
-        chat.m_chatView.m_chatArea.add_message(sender, text, timestamp, is_admin, isSender, server_id)
+        chat.m_chatView.m_chatArea.add_message(sender, text, timestamp, is_admin, isSender, server_id, index)
 
 
     def switch_layout(self):
@@ -402,6 +418,9 @@ class MainWindow(QMainWindow):
                 elif command == "/my_servers":
                     request_json = {"action": "LIST_MY_SERVERS"}
 
+                elif command == "/bootstrap":
+                    request_json = {"action": "LOGIN_BOOTSTRAP"}
+
                 elif command == "/users_in_server": # <<< NEW COMMAND
                     target_server_id_for_request = None
                     if len(args_list) == 1: # User provided a server ID
@@ -430,12 +449,16 @@ class MainWindow(QMainWindow):
                     else: print("CLIENT: Usage: /leave_server <server_id>")
 
                 elif command == "/server_history":
-                    if len(args_list) == 1:
+                    # /server_history <id> [before|after <message_id>] pages through older/newer messages
+                    if len(args_list) == 1 or (len(args_list) == 3 and args_list[1] in ("before", "after")):
                         try:
                             server_id = int(args_list[0])
-                            request_json = {"action": "SERVER_HISTORY", "payload": {"server_id": server_id}}
-                        except ValueError: print("CLIENT: Invalid server ID. Must be a number.")
-                    else: print("CLIENT: Usage: /server_history <server_id>")
+                            history_payload = {"server_id": server_id}
+                            if len(args_list) == 3:
+                                history_payload[f"{args_list[1]}_message_id"] = int(args_list[2])
+                            request_json = {"action": "SERVER_HISTORY", "payload": history_payload}
+                        except ValueError: print("CLIENT: Invalid server ID or message ID. Must be a number.")
+                    else: print("CLIENT: Usage: /server_history <server_id> [before|after <message_id>]")
 
                 elif command == "/accept_challenge":
                     if len(args_list) == 1:
@@ -504,6 +527,7 @@ class MainWindow(QMainWindow):
                     print("  /my_servers             - List servers you are a member of.")
                     print("  /join_server <code>     - Join a server by its ID.")
                     print("  /server_history <id>    - Set a server as your active context.")
+                    print("  /server_history <id> before|after <msg_id> - Page through older/newer messages.")
                     print("  /leave_server <id>      - Leave a server by its ID.")
                     print("  /users_in_server [id]   - List users in a server (current if no id).")
                     print("  /message <id> <message> - Message to that specific server.")
@@ -521,6 +545,7 @@ class MainWindow(QMainWindow):
                 print("CLIENT: Invalid input. Type /help for commands or /message <server_id> <message> to chat.")
 
             if request_json:
+                request_json["request_id"] = next(request_ids) # Lets the server pipeline read-only requests
                 if not send_json_client(sock, request_json):
                     print("CLIENT: Failed to send request to server. Disconnecting.")
                     running = False
@@ -553,6 +578,9 @@ class MainWindow(QMainWindow):
                         print("\rCLIENT: Disconnected from server (receiver).") # warning
                     running = False
                     break
+                if response_data.get("type") == "PING": # Server heartbeat; unanswered, the server drops us as dead
+                    send_json_client(sock, {"action": "PONG", "payload": response_data.get("payload", {})})
+                    continue
 
                 # prompt_len = len(get_prompt())
                 # sys.stdout.write('\r' + ' ' * (prompt_len + 80) + '\r')
@@ -584,18 +612,26 @@ class MainWindow(QMainWindow):
                                 print(f"  Server Name: '{data.get('server_name')}', ID: {data.get('server_id')}")
                                 print(f"  Invite Code: {data.get('invite_code')}") # Display invite code
                                 self.m_main_page.m_mainBar.m_addGroups.m_createGroupForm.warn.emit("Group created successfully!", 1) # <----
-                                self.sendRequest("/my_servers") # <----
+                                self.sendRequest("/bootstrap") # <----
 
                         elif action_response == "JOIN_SERVER":
                             self.m_main_page.m_mainBar.m_addGroups.m_joinGroupForm.warn.emit("Joined group successfully!", 1) # <----
-                            self.sendRequest("/my_servers") # <----
+                            self.sendRequest("/bootstrap") # <----
+
+                        elif action_response == "LOGIN_BOOTSTRAP":
+                            servers = data.get("servers", [])
+                            print(f"  Loaded {len(servers)} servers with history and members.")
+                            self.bootstrapReceived.emit(servers) # <----
 
                         elif action_response == "SERVER_HISTORY": # Ensure this part is correct from previous step
                             server_name = data.get("server_name", "UnknownServer")
                             messages_history = data.get("messages", [])
                             print(f"  --- Message History for '{server_name}' (ID: {data.get('server_id')}) ---")
                             if messages_history: # <----
-                                self.messageHistory.emit(data.get('server_id'),messages_history) # <----
+                                if data.get("after_message_id") is not None: history_page = "after"
+                                elif data.get("before_message_id") is not None: history_page = "before"
+                                else: history_page = "latest"
+                                self.messageHistory.emit(data.get('server_id'),messages_history,history_page) # <----
                             else:
                                 print("  No messages found for this server.")
 
@@ -723,6 +759,16 @@ class MainWindow(QMainWindow):
                     print(f"SERVER: {payload.get('username')} (ID: {payload.get('user_id')}) left the chat system.")
                     self.modifyUserStatus.emit(payload.get('username'), 0) # <----
 
+                elif response_data.get("type") == "PRESENCE_DELTA":
+                    payload = response_data.get("payload", {})
+                    # Batched presence changes of users who share a server with us
+                    for user in payload.get("joined", []):
+                        print(f"SERVER: {user.get('username')} joined the chat system.")
+                        self.modifyUserStatus.emit(user.get('username'), 1) # <----
+                    for user in payload.get("left", []):
+                        print(f"SERVER: {user.get('username')} (ID: {user.get('user_id')}) left the chat system.")
+                        self.modifyUserStatus.emit(user.get('username'), 0) # <----
+
                 elif status == "error" and not action_response:
                     print(f"SERVER ERROR: {message}")
 
@@ -738,7 +784,7 @@ class MainWindow(QMainWindow):
         print("CLIENT: Receiving thread stopped.")
 
 
-    def addGroup(self, name, chatID, inviteCode, isAdmin):
+    def addGroup(self, name, chatID, inviteCode, isAdmin, requestDetails=True):
         group = Group(name, chatID)
         group.clicked.connect(lambda: self.switchChat(group))
         self.m_main_page.m_mainBar.m_groupBar.m_groups.append(group)
@@ -759,8 +805,9 @@ class MainWindow(QMainWindow):
 
 
         self.m_main_page.serverIDtoIndex[chatID] = chatIndex
-        self.sendRequest(f"/server_history {chatID}")
-        self.sendRequest(f"/users_in_server {chatID}")
+        if requestDetails: # LOGIN_BOOTSTRAP already delivered history and members
+            self.sendRequest(f"/server_history {chatID}")
+            self.sendRequest(f"/users_in_server {chatID}")
 
         new_chat.m_groupDescription.m_membersBar.m_groupInviteContainer.m_groupInvitationID.setText(inviteCode)
 
@@ -768,7 +815,7 @@ class MainWindow(QMainWindow):
     def leaveGroup(self, groupID):
         # ... (existing code) ...
         self.sendRequest(f"/leave_server {groupID}")
-        self.sendRequest("/my_servers")
+        self.sendRequest("/bootstrap")
 
 
     def switchChat(self, group):
@@ -777,13 +824,12 @@ class MainWindow(QMainWindow):
         for g in self.m_main_page.m_mainBar.m_groupBar.m_groups:
             g.setSelected(g == group)
 
-# ... (send_json_client, receive_all, receive_json_client functions) ...
+# ... (send_json_client, get_frame_reader, receive_json_client functions) ...
 def send_json_client(sock, data_dict):
     try:
-        json_bytes = json.dumps(data_dict).encode('utf-8')
-        len_prefix = struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(json_bytes))
-        sock.sendall(len_prefix)
-        sock.sendall(json_bytes)
+        frame = protocol.encode_frame(data_dict, connection_codec, connection_compressor)
+        with send_lock: # The receive thread sends PONGs on the same socket
+            sock.sendall(frame)
         return True
     except BrokenPipeError:
         print("CLIENT: Broken pipe. Server connection lost.")
@@ -794,69 +840,82 @@ def send_json_client(sock, data_dict):
         print(f"CLIENT: Error sending JSON: {e}")
         return False
 
-def receive_all(sock, num_bytes_to_receive):
-    received_data = bytearray()
-    while len(received_data) < num_bytes_to_receive:
-        try:
-            bytes_to_get_now = min(num_bytes_to_receive - len(received_data), 4096)
-            packet = sock.recv(bytes_to_get_now)
-        except socket.timeout:
-            print("CLIENT: Socket timeout during receive_all.")
-            return None # Indicate timeout
-        except ConnectionAbortedError:
-            print("CLIENT: Connection aborted during receive_all.")
-            return None
-        except Exception as e: # Other socket errors
-            print(f"CLIENT: Socket error during receive_all: {e}")
-            return None
-
-        if not packet:
-            # Connection closed prematurely by the server
-            print("CLIENT: Connection closed by server while expecting more data in receive_all.")
-            return None
-        received_data.extend(packet)
-    return received_data
+def get_frame_reader(sock):
+    """The buffered FrameReader for sock, created on first use (the client only ever reads one socket)."""
+    global frame_reader
+    if frame_reader is None or frame_reader.sock is not sock:
+        frame_reader = protocol.FrameReader(sock)
+    return frame_reader
 
 def receive_json_client(sock):
     global running
     try:
-        # 1. Receive the 4-byte length prefix
-        len_prefix_bytes = receive_all(sock, MSG_LENGTH_PREFIX_SIZE)
-        if len_prefix_bytes is None:
+        # 1. Next complete frame from the buffered reader (one recv_into can deliver several)
+        frame = get_frame_reader(sock).read_frame()
+        if frame is None:
+            print("CLIENT: Connection closed by server.")
             if running: running = False
             return None
 
-        # 2. Unpack the length prefix to get the message length
-        actual_message_length = struct.unpack(MSG_LENGTH_PREFIX_FORMAT, len_prefix_bytes)[0]
-        print(f"CLIENT DEBUG: Expecting JSON message of length: {actual_message_length}")
-
-        # 3. Receive the actual JSON message data
-        json_message_bytes = receive_all(sock, actual_message_length)
-        if json_message_bytes is None:
-            if running: running = False
-            return None
+        # 2. Decompress if flagged, then decode with the codec negotiated by HELLO (JSON by default)
+        message_bytes, compressed = frame
+        print(f"CLIENT DEBUG: Received {connection_codec.name} message of length: {len(message_bytes)}")
+        message = protocol.decode_body(message_bytes, compressed, connection_codec, connection_compressor)
+        print(f"CLIENT DEBUG: Received {connection_codec.name} message: {str(message)[:200]}...")
+        return message
 
-        # 4. Decode from UTF-8 and parse JSON
-        json_string = json_message_bytes.decode('utf-8')
-        print(f"CLIENT DEBUG: Received JSON string: {json_string[:200]}...")
-        return json.loads(json_string)
-
-    except struct.error as se:
-        print(f"CLIENT: Struct unpack error (likely bad length prefix from server or connection issue): {se}")
+    except socket.timeout:
+        print("CLIENT: Socket timeout while waiting for the server.")
         if running: running = False
         return None
-    except json.JSONDecodeError as je:
-        print(f"CLIENT: Failed to decode JSON received from server. Error: {je}")
-        print(f"CLIENT DEBUG MALFORMED JSON DATA: <{json_message_bytes.decode('utf-8', errors='ignore') if 'json_message_bytes' in locals() else 'Could not decode for debug'}>")
+    except protocol.FrameTooLargeError as e:
+        print(f"CLIENT: {e}")
         if running: running = False
-        return {"status": "error", "message": "Malformed JSON received from server (decode error)."} # Or None
+        return None
+    except protocol.FrameDecodeError as de:
+        print(f"CLIENT: Failed to decode {connection_codec.name} received from server. Error: {de}")
+        print(f"CLIENT DEBUG MALFORMED DATA: <{bytes(message_bytes[:200]) if 'message_bytes' in locals() else 'Could not decode for debug'}>")
+        if running: running = False
+        return {"status": "error", "message": f"Malformed {connection_codec.name.upper()} received from server (decode error)."} # Or None
     except Exception as e:
         print(f"CLIENT: Critical error in receive_json_client: {e}")
         if running: running = False
         return None
 
 
+def load_compression_dictionary(path=COMPRESSION_DICT_PATH):
+    """The shared dictionary offered in HELLO, if the file is present (it must match the server's --compression-dict)."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return protocol.CompressionDictionary.load(path)
+    except OSError as e:
+        print(f"CLIENT: Could not load compression dictionary {path}: {e}")
+        return None
+
+def negotiate_framing(sock):
+    """Sends HELLO offering the installed codecs and compression, and switches to what the server picks.
+
+    Stays on plain JSON if the server doesn't understand HELLO.
+    """
+    global connection_codec, connection_compressor
+    dictionary = load_compression_dictionary()
+    if not send_json_client(sock, protocol.hello_request(dictionary=dictionary)):
+        return
+    response = receive_json_client(sock)
+    if response and response.get("status") == "success" and response.get("action_response_to") == "HELLO":
+        data = response.get("data") or {}
+        connection_codec = protocol.get_codec(data.get("codec")) or protocol.JSON
+        use_dictionary = dictionary if dictionary is not None and data.get("dictionary") == dictionary.id else None
+        connection_compressor = protocol.get_compressor(data.get("compression"), use_dictionary) if data.get("compression") else None
+    print(f"CLIENT: Using {connection_codec.name} framing, compression: {connection_compressor.name if connection_compressor else 'off'}.")
+
 running = True
+connection_codec = protocol.JSON # Switched by negotiate_framing() right after connecting
+connection_compressor = None # protocol.Compressor, also negotiated by HELLO
+frame_reader = None # protocol.FrameReader for the server socket, see get_frame_reader()
+send_lock = threading.Lock() # One sendall() at a time, so concurrent frames never interleave
+request_ids = itertools.count(1) # request_id echoed back on every response
 authenticated_user_details = None # Stores {'user_id': id, 'username': name}
 current_server_context_name = "Global" # Default context name for the prompt
 client_active_server_id = None # <<<< NEW: Stores the ID of the server client is currently in
@@ -885,6 +944,7 @@ if __name__ == "__main__":
         print(f"CLIENT: Connecting to {server_ip}:{port}...")
         s.connect((server_ip, port))
         print("CLIENT: Connected to server!")
+        negotiate_framing(s)
     except socket.timeout:
         print(f"CLIENT: Connection attempt to server timed out.")
         sys.exit(1)
@@ -0,0 +1,131 @@
+# BROADCAST_FANOUT.PY
+# Measures the CPU cost of one CHAT_MESSAGE broadcast as the number of online
+# members grows, comparing:
+#   per_recipient - the old path: json.dumps + struct.pack + two sendall calls per member
+#   send_json     - server.send_json per member (serializes once per member, one sendall)
+#   encode_once   - server.encode_frame once, same frame handed to every member's socket
+#
+# Each "member" is one end of a socket.socketpair(); a background thread drains the
+# other ends so sends never block. Only the broadcasting thread's CPU time is counted.
+#
+# Usage: python benchmarks/broadcast_fanout.py [--members 1 10 100 1000] [--rounds 200] [--json out.json]
+import argparse
+import json
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+
+def make_broadcast(message_id):
+    return {
+        "type": "CHAT_MESSAGE",
+        "payload": {
+            "sender_username": "bench_user",
+            "sender_user_id": 42,
+            "message": "The quick brown fox jumps over the lazy dog. " * 3,
+            "timestamp": int(time.time()),
+            "server_id": 7,
+            "server_name": "benchmark-server",
+            "message_id": message_id
+        }
+    }
+
+
+def per_recipient(sockets, data_dict):
+    for sock in sockets:
+        json_bytes = json.dumps(data_dict).encode('utf-8')
+        len_prefix = struct.pack(server.MSG_LENGTH_PREFIX_FORMAT, len(json_bytes))
+        sock.sendall(len_prefix)
+        sock.sendall(json_bytes)
+
+
+def send_json_each(sockets, data_dict):
+    for sock in sockets:
+        server.send_json(sock, data_dict)
+
+
+def encode_once(sockets, data_dict):
+    frame = server.encode_frame(data_dict)
+    for sock in sockets:
+        server.send_frame(sock, frame)
+
+
+STRATEGIES = [("per_recipient", per_recipient), ("send_json", send_json_each), ("encode_once", encode_once)]
+
+
+class Drainer(threading.Thread):
+    """Reads and discards everything arriving on the receiving ends."""
+    def __init__(self, sockets):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock in sockets:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    while key.fileobj.recv(65536):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.selector.close()
+
+
+def run_case(member_count, rounds):
+    pairs = [socket.socketpair() for _ in range(member_count)]
+    senders = [pair[0] for pair in pairs]
+    receivers = [pair[1] for pair in pairs]
+    drainer = Drainer(receivers)
+    drainer.start()
+    results = {"members": member_count}
+    try:
+        for name, strategy in STRATEGIES:
+            strategy(senders, make_broadcast(0)) # Warm-up
+            start = time.thread_time()
+            for message_id in range(rounds):
+                strategy(senders, make_broadcast(message_id))
+            elapsed = time.thread_time() - start
+            results[name] = elapsed / rounds * 1e6 # CPU microseconds per broadcast
+    finally:
+        drainer.stop()
+        for sock in senders + receivers:
+            sock.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per broadcast vs. member count")
+    parser.add_argument("--members", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    print(f"{'members':>8} " + " ".join(f"{name + ' us':>18}" for name, _ in STRATEGIES) + f" {'speedup':>8}")
+    all_results = []
+    for member_count in args.members:
+        results = run_case(member_count, args.rounds)
+        all_results.append(results)
+        speedup = results["per_recipient"] / results["encode_once"] if results["encode_once"] else float("inf")
+        print(f"{member_count:>8} " + " ".join(f"{results[name]:>18.1f}" for name, _ in STRATEGIES) + f" {speedup:>7.2f}x")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"rounds": args.rounds, "results": all_results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# CODEC_BENCH.PY
+# Compares the wire codecs a client can negotiate with HELLO (see protocol.py)
+# on the two biggest responses the server sends:
+#   SERVER_HISTORY     - a page of chat messages
+#   GET_SERVER_MEMBERS - a member roster with online/admin flags
+# For every codec installed here it reports encode and decode time per frame
+# (CPU microseconds, median of several runs) and the frame size on the wire.
+#
+# Usage: python benchmarks/codec_bench.py [--messages 50 200] [--members 10 100 1000] [--rounds 2000] [--json out.json]
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+REPEATS = 5 # Timing runs per case; the median is reported
+
+
+def make_server_history(message_count):
+    base_ts = 1_700_000_000
+    messages = [{
+        "message_id": 10_000 + i,
+        "server_id": 7,
+        "user_id": 3 + i % 25,
+        "sender_username": f"member_{i % 25}",
+        "content": f"Message {i}: the quick brown fox jumps over the lazy dog.",
+        "timestamp": base_ts + i * 17,
+    } for i in range(message_count)]
+    return {
+        "action_response_to": "SERVER_HISTORY", "request_id": 12, "status": "success",
+        "message": "History for server 7 retrieved.",
+        "data": {"server_id": 7, "server_name": "benchmark-server", "messages": messages,
+                 "before_message_id": None, "after_message_id": None, "has_more": True},
+    }
+
+
+def make_server_members(member_count):
+    members = [{
+        "user_id": 3 + i,
+        "username": f"member_{i}",
+        "is_online": i % 3 == 0,
+        "is_admin": i == 0,
+    } for i in range(member_count)]
+    return {
+        "action_response_to": "GET_SERVER_MEMBERS", "request_id": 13, "status": "success",
+        "message": "Members retrieved.",
+        "data": {"server_id": 7, "server_name": "benchmark-server", "members": members},
+    }
+
+
+def time_per_call(function, argument, rounds):
+    samples = []
+    for _ in range(REPEATS):
+        start = time.thread_time()
+        for _ in range(rounds):
+            function(argument)
+        samples.append((time.thread_time() - start) / rounds * 1e6)
+    return statistics.median(samples)
+
+
+def run_case(name, data_dict, rounds):
+    rows = []
+    for codec_name in protocol.available_codec_names():
+        codec = protocol.get_codec(codec_name)
+        frame = protocol.encode_frame(data_dict, codec)
+        body = memoryview(frame)[protocol.MSG_LENGTH_PREFIX_SIZE:]
+        assert codec.decode(body) == data_dict, f"{codec_name} does not round-trip {name}"
+        rows.append({
+            "case": name,
+            "codec": codec_name,
+            "bytes": len(frame),
+            "encode_us": time_per_call(lambda d: protocol.encode_frame(d, codec), data_dict, rounds),
+            "decode_us": time_per_call(codec.decode, body, rounds),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode/decode time and frame size per codec")
+    parser.add_argument("--messages", type=int, nargs="+", default=[50, 200], help="SERVER_HISTORY page sizes")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000], help="GET_SERVER_MEMBERS roster sizes")
+    parser.add_argument("--rounds", type=int, default=2000, help="Calls per timing run (scaled down for big payloads)")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    missing = [name for name in protocol.CODEC_PREFERENCE if name not in protocol.CODECS]
+    if missing:
+        print(f"Not installed, skipped: {', '.join(missing)} (pip install msgpack cbor2)")
+
+    cases = [(f"SERVER_HISTORY x{count}", make_server_history(count), count) for count in args.messages]
+    cases += [(f"GET_SERVER_MEMBERS x{count}", make_server_members(count), count) for count in args.members]
+
+    print(f"{'case':<24} {'codec':<8} {'bytes':>9} {'vs json':>8} {'encode us':>10} {'decode us':>10}")
+    all_rows = []
+    for name, data_dict, item_count in cases:
+        rounds = max(20, args.rounds * 10 // max(item_count, 10))
+        rows = run_case(name, data_dict, rounds)
+        json_bytes = rows[-1]["bytes"] if rows[-1]["codec"] == "json" else None
+        for row in rows:
+            ratio = f"{row['bytes'] / json_bytes:.2f}" if json_bytes else "-"
+            print(f"{row['case']:<24} {row['codec']:<8} {row['bytes']:>9} {ratio:>8} {row['encode_us']:>10.1f} {row['decode_us']:>10.1f}")
+        all_rows.extend(rows)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"rounds": args.rounds, "results": all_rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
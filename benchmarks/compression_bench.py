@@ -0,0 +1,152 @@
+# COMPRESSION_BENCH.PY
+# Measures per-frame compression (see protocol.py) on typical server traffic and
+# trains the optional shared dictionary.
+#
+# Samples are SERVER_HISTORY, GET_SERVER_MEMBERS and LIST_ALL_SERVERS responses
+# plus single CHAT_MESSAGE broadcasts, either built from a chat database (--db)
+# or synthetic. The dictionary is trained on every other sample and evaluated on
+# the rest, so the numbers aren't measured on the training data. For each codec
+# and compression setting it reports total bytes on the wire, the ratio to raw
+# frames (overall and for frames under 1KB), and compress/decompress CPU time.
+#
+# Usage: python benchmarks/compression_bench.py [--db chat_app.db] [--save-dict compression.dict]
+#   The saved file is what server.py --compression-dict and the clients' compression.dict expect.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+from codec_bench import make_server_history, make_server_members
+
+SMALL_FRAME_BYTES = 1024
+
+
+def make_chat_broadcast(index):
+    return {
+        "type": "CHAT_MESSAGE",
+        "payload": {
+            "sender_username": f"member_{index % 25}",
+            "sender_user_id": 3 + index % 25,
+            "message": f"Message {index}: see you at {index % 12 + 1}pm?",
+            "timestamp": 1_700_000_000 + index * 17,
+            "server_id": 7 + index % 5,
+            "server_name": f"server-{index % 5}",
+            "message_id": 10_000 + index,
+        }
+    }
+
+
+def make_server_list(server_count):
+    servers = [{
+        "server_id": 7 + i, "name": f"server-{i}", "admin_user_id": 3 + i % 25,
+        "admin_username": f"member_{i % 25}", "created_at": 1_700_000_000 + i * 3600,
+    } for i in range(server_count)]
+    return {"action_response_to": "LIST_ALL_SERVERS", "status": "success",
+            "message": "All servers listed.", "data": {"servers": servers}}
+
+
+def synthetic_samples():
+    samples = [make_chat_broadcast(i) for i in range(200)]
+    samples += [make_server_history(count) for count in (5, 10, 20, 50) for _ in range(5)]
+    samples += [make_server_members(count) for count in (2, 5, 10, 30, 100) for _ in range(4)]
+    samples += [make_server_list(count) for count in (3, 10, 30) for _ in range(4)]
+    return samples
+
+
+def database_samples(database_file):
+    import database
+    database.configure_connection_pool(database_file=database_file)
+    samples = []
+    servers = database.get_all_servers() or []
+    samples.append({"action_response_to": "LIST_ALL_SERVERS", "status": "success",
+                    "message": "All servers listed.", "data": {"servers": servers}})
+    for server in servers:
+        server_id = server["server_id"]
+        messages, has_more = database.get_message_page(server_id)
+        samples.append({"action_response_to": "SERVER_HISTORY", "status": "success",
+                        "message": f"History for server {server_id} retrieved.",
+                        "data": {"server_id": server_id, "server_name": server["name"], "messages": messages,
+                                 "before_message_id": None, "after_message_id": None, "has_more": has_more}})
+        members = database.get_server_members(server_id) or []
+        samples.append({"action_response_to": "GET_SERVER_MEMBERS", "status": "success",
+                        "message": f"Retrieved members for server '{server['name']}'.",
+                        "data": {"server_id": server_id, "server_name": server["name"],
+                                 "members": [dict(member, is_online=False, is_admin=False) for member in members]}})
+        for message in messages:
+            samples.append({"type": "CHAT_MESSAGE", "payload": {
+                "sender_username": message["sender_username"], "sender_user_id": message["user_id"],
+                "message": message["content"], "timestamp": message["timestamp"], "server_id": server_id,
+                "server_name": server["name"], "message_id": message["message_id"]}})
+    return samples
+
+
+def measure(bodies, compressor):
+    """Frames every body like encode_frame would; returns bytes and CPU time per frame."""
+    total = small_total = 0
+    compress_time = decompress_time = 0.0
+    for body in bodies:
+        start = time.thread_time()
+        compressed = compressor.compress(body) if compressor else None
+        compress_time += time.thread_time() - start
+        frame_size = protocol.MSG_LENGTH_PREFIX_SIZE + len(compressed if compressed is not None else body)
+        if compressed is not None:
+            start = time.thread_time()
+            assert compressor.decompress(compressed) == body
+            decompress_time += time.thread_time() - start
+        total += frame_size
+        if len(body) < SMALL_FRAME_BYTES:
+            small_total += frame_size
+    return total, small_total, compress_time / len(bodies) * 1e6, decompress_time / len(bodies) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-frame compression ratios and dictionary training")
+    parser.add_argument("--db", dest="database_file", help="Build samples from this chat database instead of synthetic data")
+    parser.add_argument("--dict-size", type=int, default=protocol.COMPRESSION_DICT_SIZE)
+    parser.add_argument("--save-dict", help="Train a dictionary on all samples and write it to this file")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    samples = database_samples(args.database_file) if args.database_file else synthetic_samples()
+    if len(samples) < 4:
+        sys.exit(f"Only {len(samples)} samples; the database needs some servers and messages.")
+    print(f"{len(samples)} sample messages ({'from ' + args.database_file if args.database_file else 'synthetic'})")
+
+    all_rows = []
+    print(f"{'codec':<8} {'compression':<14} {'bytes':>9} {'ratio':>6} {'<1KB ratio':>10} {'comp us':>8} {'decomp us':>9}")
+    for codec_name in protocol.available_codec_names():
+        codec = protocol.get_codec(codec_name)
+        bodies = [codec.encode(sample) for sample in samples]
+        training, evaluation = bodies[::2], bodies[1::2]
+        dictionary = protocol.CompressionDictionary(protocol.train_dictionary(training, args.dict_size))
+        settings = [("raw", None)]
+        for name in protocol.COMPRESSION_PREFERENCE:
+            settings.append((name, protocol.Compressor(name)))
+            settings.append((name + "+dict", protocol.Compressor(name, dictionary)))
+        raw_total = raw_small = None
+        for label, compressor in settings:
+            total, small_total, compress_us, decompress_us = measure(evaluation, compressor)
+            if raw_total is None:
+                raw_total, raw_small = total, small_total
+            print(f"{codec_name:<8} {label:<14} {total:>9} {total / raw_total:>6.2f} "
+                  f"{(small_total / raw_small if raw_small else 1.0):>10.2f} {compress_us:>8.1f} {decompress_us:>9.1f}")
+            all_rows.append({"codec": codec_name, "compression": label, "bytes": total,
+                             "small_frame_bytes": small_total, "compress_us": compress_us, "decompress_us": decompress_us})
+
+    if args.save_dict:
+        training = [protocol.get_codec(name).encode(sample) for name in protocol.available_codec_names() for sample in samples]
+        data = protocol.train_dictionary(training, args.dict_size)
+        with open(args.save_dict, "wb") as f:
+            f.write(data)
+        print(f"Wrote {len(data)}-byte dictionary {protocol.CompressionDictionary(data).id} to {args.save_dict}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"samples": len(samples), "results": all_rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
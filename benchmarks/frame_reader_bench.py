@@ -0,0 +1,119 @@
+# FRAME_READER_BENCH.PY
+# Receive-side cost of a flood of small frames, comparing:
+#   receive_all  - the old path: recv() of at most 4096 bytes into a fresh bytearray,
+#                  once for the length prefix and again for the body of every frame
+#   frame_reader - protocol.FrameReader: recv_into() a preallocated buffer, then every
+#                  complete frame in it is handed out as a memoryview without another syscall
+#
+# A writer thread pushes pre-encoded frames through a socket.socketpair(); only the
+# reading thread's CPU time is counted, and every frame is decoded (JSON) as the
+# server and clients would.
+#
+# Usage: python benchmarks/frame_reader_bench.py [--frames 100000] [--sizes 64 256 1024] [--json out.json]
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+
+def make_frames(frame_count, body_size):
+    frames = []
+    for index in range(frame_count):
+        message = {"type": "CHAT_MESSAGE", "payload": {"message_id": index, "message": ""}}
+        padding = body_size - len(protocol.JSON.encode(message))
+        message["payload"]["message"] = "x" * max(padding, 0)
+        frames.append(protocol.encode_frame(message))
+    return b"".join(frames)
+
+
+class CountingSocket:
+    """Counts receive syscalls on the reading end."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+def receive_all(sock, num_bytes_to_receive):
+    received_data = bytearray()
+    while len(received_data) < num_bytes_to_receive:
+        packet = sock.recv(min(num_bytes_to_receive - len(received_data), 4096))
+        if not packet:
+            return None
+        received_data.extend(packet)
+    return received_data
+
+
+def read_with_receive_all(sock, frame_count):
+    for _ in range(frame_count):
+        prefix = receive_all(sock, protocol.MSG_LENGTH_PREFIX_SIZE)
+        length = struct.unpack(protocol.MSG_LENGTH_PREFIX_FORMAT, prefix)[0]
+        protocol.JSON.decode(receive_all(sock, length))
+
+
+def read_with_frame_reader(sock, frame_count):
+    reader = protocol.FrameReader(sock)
+    for _ in range(frame_count):
+        body, compressed = reader.read_frame()
+        protocol.decode_body(body, compressed)
+
+
+STRATEGIES = [("receive_all", read_with_receive_all), ("frame_reader", read_with_frame_reader)]
+
+
+def run_case(strategy, payload, frame_count):
+    writer_end, reader_end = socket.socketpair()
+    writer = threading.Thread(target=writer_end.sendall, args=(payload,), daemon=True)
+    sock = CountingSocket(reader_end)
+    try:
+        writer.start()
+        start_cpu, start_wall = time.thread_time(), time.perf_counter()
+        strategy(sock, frame_count)
+        cpu, wall = time.thread_time() - start_cpu, time.perf_counter() - start_wall
+        writer.join()
+    finally:
+        writer_end.close()
+        reader_end.close()
+    return {"cpu_us_per_frame": cpu / frame_count * 1e6, "frames_per_sec": frame_count / wall,
+            "syscalls_per_frame": sock.calls / frame_count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive cost per frame for small-message floods")
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 1024], help="Body sizes in bytes")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    print(f"{'body':>6} {'reader':<13} {'cpu us/frame':>12} {'frames/s':>10} {'recv/frame':>10}")
+    all_results = []
+    for body_size in args.sizes:
+        payload = make_frames(args.frames, body_size)
+        for name, strategy in STRATEGIES:
+            result = run_case(strategy, payload, args.frames)
+            result.update({"body_bytes": body_size, "reader": name})
+            all_results.append(result)
+            print(f"{body_size:>6} {name:<13} {result['cpu_us_per_frame']:>12.2f} "
+                  f"{result['frames_per_sec']:>10.0f} {result['syscalls_per_frame']:>10.3f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"frames": args.frames, "results": all_results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
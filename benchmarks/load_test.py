@@ -0,0 +1,379 @@
+# LOAD_TEST.PY
+# Load-generation harness for the chat server.
+#
+# Starts server.py on a free local port with a throwaway database, connects N
+# synthetic clients spread across M chat servers, and has every client send
+# SEND_CHAT_MESSAGE at a fixed rate for a fixed duration. Each message carries the
+# time it was sent, so every recipient can measure end-to-end delivery latency
+# (sender -> server -> broadcast -> recipient). All clients run on one asyncio loop
+# in this process, so they share a clock. The server runs with --no-rate-limit, so
+# it processes the whole offered load instead of answering RATE_LIMITED.
+#
+# Reports throughput, p50/p90/p99 delivery latency, SERVER_HISTORY latency and the
+# server's CPU time and RSS (from /proc, Linux only), and saves everything as JSON
+# so runs can be compared across commits.
+#
+# Usage: python benchmarks/load_test.py --clients 100 --servers 10 --rate 2 --duration 20 [--server-arg=--async]
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+MSG_LENGTH_PREFIX_FORMAT = '!I'  # Network byte order, Unsigned Integer (4 bytes)
+MSG_LENGTH_PREFIX_SIZE = struct.calcsize(MSG_LENGTH_PREFIX_FORMAT)
+BENCH_MESSAGE_PREFIX = "bench|"
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_summary(samples_ns):
+    """Milliseconds summary of a list of nanosecond latencies."""
+    values = sorted(samples_ns)
+    to_ms = lambda v: None if v is None else round(v / 1e6, 3)
+    return {
+        "count": len(values),
+        "p50_ms": to_ms(percentile(values, 0.50)),
+        "p90_ms": to_ms(percentile(values, 0.90)),
+        "p99_ms": to_ms(percentile(values, 0.99)),
+        "max_ms": to_ms(values[-1] if values else None),
+        "mean_ms": to_ms(sum(values) / len(values) if values else None),
+    }
+
+
+# --- Server process and /proc sampling ---
+
+class ServerProcess:
+    def __init__(self, port, server_args, workdir):
+        self.port = port
+        self.server_args = server_args
+        self.workdir = workdir
+        self.log_path = os.path.join(workdir, "server.log")
+        self.process = None
+
+    def start(self, timeout=15.0):
+        command = [sys.executable, os.path.join(REPO_DIR, "server.py"), str(self.port),
+                   "--db", os.path.join(self.workdir, "bench.db"), "--traffic-log", "off", "--no-rate-limit",
+                   *self.server_args]
+        env = dict(os.environ, TERM="dumb")
+        self._log_file = open(self.log_path, "w")
+        self.process = subprocess.Popen(command, cwd=self.workdir, stdout=self._log_file,
+                                        stderr=subprocess.STDOUT, env=env)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited early with code {self.process.returncode}; see {self.log_path}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server did not start listening within {timeout}s; see {self.log_path}")
+
+    def pids(self):
+        """The server process plus its worker processes (--workers)."""
+        pids = [self.process.pid]
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except (OSError, ValueError):
+            pass
+        return pids
+
+    def cpu_seconds(self):
+        """utime + stime of the server process and its workers, or None where /proc is unavailable."""
+        try:
+            total = 0
+            for pid in self.pids():
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            return total / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def memory_kb(self):
+        """(current RSS, peak RSS) in kB summed over the server process and its workers, or (None, None) where /proc is unavailable."""
+        rss = peak = None
+        try:
+            for pid in self.pids():
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss = (rss or 0) + int(line.split()[1])
+                        elif line.startswith("VmHWM:"):
+                            peak = (peak or 0) + int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        return rss, peak
+
+    def stop(self, timeout=10.0):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log_file.close()
+
+
+# --- Synthetic clients ---
+
+class BenchClient:
+    def __init__(self, index, host, port):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.username = f"bench{index}"
+        self.reader = None
+        self.writer = None
+        self.server_id = None
+        self.responses = asyncio.Queue()
+        self.latencies_ns = []
+        self.history_latencies_ns = []
+        self.received = 0
+        self.sent = 0
+        self._reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def send(self, data_dict):
+        json_bytes = json.dumps(data_dict).encode('utf-8')
+        self.writer.write(struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(json_bytes)) + json_bytes)
+
+    async def receive(self):
+        len_prefix = await self.reader.readexactly(MSG_LENGTH_PREFIX_SIZE)
+        msg_len = struct.unpack(MSG_LENGTH_PREFIX_FORMAT, len_prefix)[0]
+        return json.loads(await self.reader.readexactly(msg_len))
+
+    async def request(self, action, payload):
+        """Sends one request and waits for its response (only used before/after the reader loop is busy)."""
+        self.send({"action": action, "payload": payload})
+        await self.writer.drain()
+        return await self.responses.get()
+
+    def start_reader(self):
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message = await self.receive()
+                if message.get("type") == "CHAT_MESSAGE":
+                    text = message.get("payload", {}).get("message", "")
+                    if text.startswith(BENCH_MESSAGE_PREFIX):
+                        sent_ns = int(text.split("|", 3)[2])
+                        self.latencies_ns.append(time.perf_counter_ns() - sent_ns)
+                        self.received += 1
+                elif "action_response_to" in message:
+                    await self.responses.put(message)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def login(self):
+        response = await self.request("REGISTER", {"username": self.username, "password": "benchpw"})
+        if response.get("status") != "success":
+            raise RuntimeError(f"REGISTER failed for {self.username}: {response.get('message')}")
+        response = await self.request("LOGIN", {"username": self.username, "password": "benchpw"})
+        if response.get("status") != "success":
+            raise RuntimeError(f"LOGIN failed for {self.username}: {response.get('message')}")
+
+    async def fetch_history(self):
+        start = time.perf_counter_ns()
+        response = await self.request("SERVER_HISTORY", {"server_id": self.server_id})
+        self.history_latencies_ns.append(time.perf_counter_ns() - start)
+        return response
+
+    async def send_messages(self, rate, duration, payload_bytes):
+        """Sends at a fixed rate on a schedule, so a slow server shows up as latency, not as fewer sends."""
+        interval = 1.0 / rate
+        padding = "x" * max(0, payload_bytes)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        next_send = start + (self.index % 100) / 100.0 * interval # Spread clients over the first interval
+        seq = 0
+        while next_send < start + duration:
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = f"{BENCH_MESSAGE_PREFIX}{self.index}:{seq}|{time.perf_counter_ns()}|{padding}"
+            self.send({"action": "SEND_CHAT_MESSAGE", "payload": {"server_id": self.server_id, "message": text}})
+            await self.writer.drain()
+            self.sent += 1
+            seq += 1
+            next_send += interval
+
+    async def close(self):
+        if self.writer is not None:
+            try:
+                self.send({"action": "DISCONNECT", "payload": {}})
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+            self.writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+async def run_load(port, args, server):
+    clients = [BenchClient(i, "127.0.0.1", port) for i in range(args.clients)]
+    server_count = min(args.servers, args.clients)
+    phases = {}
+
+    # Connect and authenticate, a few clients at a time
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    async def setup(client):
+        async with semaphore:
+            await client.connect()
+            client.start_reader()
+            await client.login()
+    await asyncio.gather(*(setup(client) for client in clients))
+    phases["login_seconds"] = round(time.perf_counter() - start, 3)
+
+    # The first M clients create one chat server each; everyone else joins one round-robin
+    invite_codes = []
+    for client in clients[:server_count]:
+        response = await client.request("CREATE_SERVER", {"server_name": f"bench-server-{client.index}"})
+        if response.get("status") != "success":
+            raise RuntimeError(f"CREATE_SERVER failed: {response.get('message')}")
+        client.server_id = response["data"]["server_id"]
+        invite_codes.append((response["data"]["server_id"], response["data"]["invite_code"]))
+    async def join(client):
+        async with semaphore:
+            server_id, invite_code = invite_codes[client.index % server_count]
+            response = await client.request("JOIN_SERVER", {"invite_code": invite_code})
+            if response.get("status") != "success":
+                raise RuntimeError(f"JOIN_SERVER failed: {response.get('message')}")
+            client.server_id = server_id
+    await asyncio.gather(*(join(client) for client in clients[server_count:]))
+    members_per_server = {}
+    for client in clients:
+        members_per_server[client.server_id] = members_per_server.get(client.server_id, 0) + 1
+
+    await asyncio.gather(*(client.fetch_history() for client in clients))
+
+    # Steady-state message load
+    cpu_before = server.cpu_seconds()
+    start = time.perf_counter()
+    await asyncio.gather(*(client.send_messages(args.rate, args.duration, args.payload_bytes) for client in clients))
+    send_elapsed = time.perf_counter() - start
+
+    # Wait for in-flight deliveries
+    expected = sum(client.sent * members_per_server[client.server_id] for client in clients)
+    drain_deadline = time.perf_counter() + args.drain_seconds
+    while sum(client.received for client in clients) < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    cpu_after = server.cpu_seconds()
+    rss_kb, peak_rss_kb = server.memory_kb()
+
+    await asyncio.gather(*(client.fetch_history() for client in clients))
+    for client in clients:
+        await client.close()
+
+    sent = sum(client.sent for client in clients)
+    delivered = sum(client.received for client in clients)
+    server_cpu = None if cpu_before is None or cpu_after is None else round(cpu_after - cpu_before, 3)
+    return {
+        "phases": phases,
+        "members_per_server": sorted(members_per_server.values()),
+        "messages_sent": sent,
+        "deliveries_expected": expected,
+        "deliveries_received": delivered,
+        "delivery_ratio": round(delivered / expected, 4) if expected else None,
+        "send_seconds": round(send_elapsed, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "sent_per_second": round(sent / send_elapsed, 1) if send_elapsed else None,
+        "deliveries_per_second": round(delivered / elapsed, 1) if elapsed else None,
+        "delivery_latency": latency_summary([ns for client in clients for ns in client.latencies_ns]),
+        "history_latency": latency_summary([ns for client in clients for ns in client.history_latencies_ns]),
+        "server_cpu_seconds": server_cpu,
+        "server_cpu_percent": round(100.0 * server_cpu / elapsed, 1) if server_cpu is not None and elapsed else None,
+        "server_rss_kb": rss_kb,
+        "server_peak_rss_kb": peak_rss_kb,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive server.py with synthetic clients and report throughput/latency.")
+    parser.add_argument("--clients", type=int, default=50, help="Number of synthetic users (N).")
+    parser.add_argument("--servers", type=int, default=5, help="Number of chat servers the users are spread over (M).")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second sent by each client.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of steady-state sending.")
+    parser.add_argument("--payload-bytes", type=int, default=64, help="Padding added to each chat message.")
+    parser.add_argument("--drain-seconds", type=float, default=5.0, help="Max wait for in-flight deliveries after sending stops.")
+    parser.add_argument("--connect-concurrency", type=int, default=20, help="Clients connecting/logging in at once.")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument passed to server.py (repeatable), e.g. --server-arg=--async")
+    parser.add_argument("--port", type=int, default=0, help="Server port (default: pick a free one).")
+    parser.add_argument("--output", help="Where to save the JSON results (default: benchmarks/results/<time>-<commit>.json).")
+    args = parser.parse_args()
+
+    port = args.port or free_port()
+    commit = git_commit()
+    with tempfile.TemporaryDirectory(prefix="chatio-load-") as workdir:
+        server = ServerProcess(port, args.server_arg, workdir)
+        server.start()
+        try:
+            results = asyncio.run(run_load(port, args, server))
+        finally:
+            server.stop()
+
+    report = {
+        "benchmark": "load_test",
+        "commit": commit,
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+        "results": results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"load_test-{stamp}-{commit or 'nocommit'}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    latency = results["delivery_latency"]
+    print(f"clients={args.clients} servers={args.servers} rate={args.rate}/s duration={args.duration}s")
+    print(f"sent {results['messages_sent']} ({results['sent_per_second']}/s), "
+          f"delivered {results['deliveries_received']}/{results['deliveries_expected']} ({results['deliveries_per_second']}/s)")
+    print(f"delivery latency ms: p50={latency['p50_ms']} p90={latency['p90_ms']} p99={latency['p99_ms']} max={latency['max_ms']}")
+    print(f"server cpu: {results['server_cpu_seconds']}s ({results['server_cpu_percent']}%), "
+          f"rss {results['server_rss_kb']} kB (peak {results['server_peak_rss_kb']} kB)")
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# LOGIN_BURST.PY
+# Chat latency while a burst of users logs in.
+#
+# Starts server.py the way load_test.py does, on a database pre-seeded with
+# --burst-users accounts. --chat-clients users keep chatting at --rate messages
+# per second each; after --warmup seconds every burst account sends LOGIN
+# (--burst-concurrency connections at a time) and disconnects again. Delivery
+# latency of the chat messages is reported separately for messages sent before,
+# during and after the burst, together with login throughput and latency. Each
+# LOGIN runs the full password key derivation on the server; compare runs with
+# --server-arg=--password-workers=0 (hashing on the server's own threads).
+#
+# The burst accounts are written straight into the database with one shared
+# precomputed hash, so setting up 1000 users does not take 1000 hashes.
+#
+# Usage: python benchmarks/login_burst.py [--burst-users 1000] [--chat-clients 20] [--server-arg=--async]
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import passwords
+from load_test import BENCH_MESSAGE_PREFIX, RESULTS_DIR, BenchClient, ServerProcess, free_port, git_commit, latency_summary
+
+BURST_PASSWORD = "burstpw"
+
+
+def seed_burst_users(database_file, count):
+    database.configure_connection_pool(database_file=database_file)
+    database.initialize_database()
+    password_hash = passwords.hash_password(BURST_PASSWORD)
+    now = int(time.time())
+    with sqlite3.connect(database_file) as conn:
+        conn.executemany("INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                         [(f"burst{index}", password_hash, now) for index in range(count)])
+
+
+class ChatClient(BenchClient):
+    """BenchClient that keeps the send time of every delivered message, so samples can be split by phase."""
+    def __init__(self, index, host, port):
+        super().__init__(index, host, port)
+        self.samples = [] # (sent_ns, latency_ns)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message = await self.receive()
+                if message.get("type") == "CHAT_MESSAGE":
+                    text = message.get("payload", {}).get("message", "")
+                    if text.startswith(BENCH_MESSAGE_PREFIX):
+                        sent_ns = int(text.split("|", 3)[2])
+                        self.samples.append((sent_ns, time.perf_counter_ns() - sent_ns))
+                elif "action_response_to" in message:
+                    await self.responses.put(message)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def chat_until(self, rate, stopped):
+        interval = 1.0 / rate
+        loop = asyncio.get_running_loop()
+        next_send = loop.time() + (self.index % 100) / 100.0 * interval
+        seq = 0
+        while not stopped.is_set():
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = f"{BENCH_MESSAGE_PREFIX}{self.index}:{seq}|{time.perf_counter_ns()}|"
+            self.send({"action": "SEND_CHAT_MESSAGE", "payload": {"server_id": self.server_id, "message": text}})
+            await self.writer.drain()
+            self.sent += 1
+            seq += 1
+            next_send += interval
+
+
+async def burst_login(index, port, semaphore, login_latencies_ns, failures):
+    async with semaphore:
+        client = BenchClient(index, "127.0.0.1", port)
+        client.username = f"burst{index}"
+        start = time.perf_counter_ns()
+        try:
+            await client.connect()
+            client.send({"action": "LOGIN", "payload": {"username": client.username, "password": BURST_PASSWORD}})
+            await client.writer.drain()
+            response = await client.receive()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+            return
+        finally:
+            if client.writer is not None:
+                client.writer.close()
+        if response.get("status") == "success":
+            login_latencies_ns.append(time.perf_counter_ns() - start)
+        else:
+            reason = response.get("error") or response.get("message", "error")
+            failures[reason] = failures.get(reason, 0) + 1
+
+
+async def run_burst(port, args):
+    chat_clients = [ChatClient(i, "127.0.0.1", port) for i in range(args.chat_clients)]
+    for client in chat_clients:
+        await client.connect()
+        client.start_reader()
+        await client.login()
+    response = await chat_clients[0].request("CREATE_SERVER", {"server_name": "login-burst"})
+    server_id, invite_code = response["data"]["server_id"], response["data"]["invite_code"]
+    for client in chat_clients:
+        if client is not chat_clients[0]:
+            await client.request("JOIN_SERVER", {"invite_code": invite_code})
+        client.server_id = server_id
+
+    stopped = asyncio.Event()
+    chatting = asyncio.gather(*(client.chat_until(args.rate, stopped) for client in chat_clients))
+    await asyncio.sleep(args.warmup)
+
+    login_latencies_ns, failures = [], {}
+    semaphore = asyncio.Semaphore(args.burst_concurrency)
+    burst_start = time.perf_counter_ns()
+    await asyncio.gather(*(burst_login(index, port, semaphore, login_latencies_ns, failures)
+                           for index in range(args.burst_users)))
+    burst_end = time.perf_counter_ns()
+
+    await asyncio.sleep(args.cooldown)
+    stopped.set()
+    await chatting
+    await asyncio.sleep(args.drain_seconds)
+    for client in chat_clients:
+        await client.close()
+
+    phases = {"before": [], "during": [], "after": []}
+    for client in chat_clients:
+        for sent_ns, latency_ns in client.samples:
+            phase = "before" if sent_ns < burst_start else "during" if sent_ns < burst_end else "after"
+            phases[phase].append(latency_ns)
+    burst_seconds = (burst_end - burst_start) / 1e9
+    return {
+        "burst_seconds": round(burst_seconds, 3),
+        "logins_succeeded": len(login_latencies_ns),
+        "logins_failed": failures,
+        "logins_per_second": round(len(login_latencies_ns) / burst_seconds, 1) if burst_seconds else None,
+        "login_latency": latency_summary(login_latencies_ns),
+        "chat_latency": {phase: latency_summary(samples) for phase, samples in phases.items()},
+        "chat_messages_sent": sum(client.sent for client in chat_clients),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat delivery latency before, during and after a login burst.")
+    parser.add_argument("--burst-users", type=int, default=1000, help="Accounts that log in during the burst.")
+    parser.add_argument("--burst-concurrency", type=int, default=50, help="Burst logins in flight at once.")
+    parser.add_argument("--chat-clients", type=int, default=20, help="Users chatting in one shared server throughout.")
+    parser.add_argument("--rate", type=float, default=2.0, help="Messages per second sent by each chat client.")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of chat before the burst starts.")
+    parser.add_argument("--cooldown", type=float, default=5.0, help="Seconds of chat after the burst ends.")
+    parser.add_argument("--drain-seconds", type=float, default=2.0, help="Wait for in-flight deliveries after chat stops.")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument passed to server.py (repeatable), e.g. --server-arg=--password-workers=0")
+    parser.add_argument("--port", type=int, default=0, help="Server port (default: pick a free one).")
+    parser.add_argument("--output", help="Where to save the JSON results (default: benchmarks/results/<time>-<commit>.json).")
+    args = parser.parse_args()
+
+    port = args.port or free_port()
+    commit = git_commit()
+    # Every burst connection comes from 127.0.0.1, so lift the per-IP handshake cap above the concurrency used
+    server_args = ["--auth-max-per-ip", str(args.burst_concurrency + args.chat_clients), *args.server_arg]
+    with tempfile.TemporaryDirectory(prefix="chatio-login-burst-") as workdir:
+        seed_burst_users(os.path.join(workdir, "bench.db"), args.burst_users)
+        server = ServerProcess(port, server_args, workdir)
+        server.start()
+        try:
+            results = asyncio.run(run_burst(port, args))
+        finally:
+            server.stop()
+
+    report = {
+        "benchmark": "login_burst",
+        "commit": commit,
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+        "results": results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"login_burst-{stamp}-{commit or 'nocommit'}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    login = results["login_latency"]
+    print(f"burst of {args.burst_users} logins ({args.burst_concurrency} at a time): {results['burst_seconds']}s, "
+          f"{results['logins_per_second']} logins/s, failed {results['logins_failed'] or 0}")
+    print(f"login latency ms: p50={login['p50_ms']} p99={login['p99_ms']} max={login['max_ms']}")
+    print(f"{'chat latency ms':<16} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for phase, summary in results["chat_latency"].items():
+        print(f"{phase:<16} {summary['count']:>6} {summary['p50_ms']!s:>8} {summary['p90_ms']!s:>8} "
+              f"{summary['p99_ms']!s:>8} {summary['max_ms']!s:>8}")
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,25 @@
 import socket
 import os
 import threading
+import itertools
 import sys
 import json
+import protocol # Shared framing and codecs (JSON, MessagePack, CBOR)
 import getpass
 import time
 import struct
 import subprocess # <<< ADDED
 
-MSG_LENGTH_PREFIX_FORMAT = '!I'  # Network byte order, Unsigned Integer (4 bytes)
-MSG_LENGTH_PREFIX_SIZE = struct.calcsize(MSG_LENGTH_PREFIX_FORMAT)
+MSG_LENGTH_PREFIX_FORMAT = protocol.MSG_LENGTH_PREFIX_FORMAT  # Network byte order, Unsigned Integer (4 bytes)
+MSG_LENGTH_PREFIX_SIZE = protocol.MSG_LENGTH_PREFIX_SIZE
+COMPRESSION_DICT_PATH = "compression.dict" # Optional shared dictionary, trained with benchmarks/compression_bench.py
 GODOT_EXECUTABLE_PATH = "/home/cxn/Documents/code/python/Database Systems/chat app/Chat-App---Final-Project/GodotGame/FinalLinux.x86_64" # <<< ADDED: Path to your game executable
 
 def send_json_client(sock, data_dict):
     try:
-        json_bytes = json.dumps(data_dict).encode('utf-8')
-        len_prefix = struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(json_bytes))
-        sock.sendall(len_prefix)
-        sock.sendall(json_bytes)
+        frame = protocol.encode_frame(data_dict, connection_codec, connection_compressor)
+        with send_lock: # The receive thread sends PONGs on the same socket
+            sock.sendall(frame)
         return True
     except BrokenPipeError:
         print("CLIENT: Broken pipe. Server connection lost.")
@@ -29,68 +31,82 @@ def send_json_client(sock, data_dict):
         print(f"CLIENT: Error sending JSON: {e}")
         return False
 
-def receive_all(sock, num_bytes_to_receive):
-    received_data = bytearray()
-    while len(received_data) < num_bytes_to_receive:
-        try:
-            bytes_to_get_now = min(num_bytes_to_receive - len(received_data), 4096)
-            packet = sock.recv(bytes_to_get_now)
-        except socket.timeout:
-            print("CLIENT: Socket timeout during receive_all.")
-            return None # Indicate timeout
-        except ConnectionAbortedError:
-            print("CLIENT: Connection aborted during receive_all.")
-            return None
-        except Exception as e: # Other socket errors
-            print(f"CLIENT: Socket error during receive_all: {e}")
-            return None
-
-        if not packet:
-            # Connection closed prematurely by the server
-            print("CLIENT: Connection closed by server while expecting more data in receive_all.")
-            return None
-        received_data.extend(packet)
-    return received_data
+def get_frame_reader(sock):
+    """The buffered FrameReader for sock, created on first use (the client only ever reads one socket)."""
+    global frame_reader
+    if frame_reader is None or frame_reader.sock is not sock:
+        frame_reader = protocol.FrameReader(sock)
+    return frame_reader
 
 def receive_json_client(sock):
     global running
     try:
-        # 1. Receive the 4-byte length prefix
-        len_prefix_bytes = receive_all(sock, MSG_LENGTH_PREFIX_SIZE)
-        if len_prefix_bytes is None:
-            if running: running = False
-            return None
-
-        # 2. Unpack the length prefix to get the message length
-        actual_message_length = struct.unpack(MSG_LENGTH_PREFIX_FORMAT, len_prefix_bytes)[0]
-        print(f"CLIENT DEBUG: Expecting JSON message of length: {actual_message_length}")
-
-        # 3. Receive the actual JSON message data
-        json_message_bytes = receive_all(sock, actual_message_length)
-        if json_message_bytes is None:
+        # 1. Next complete frame from the buffered reader (one recv_into can deliver several)
+        frame = get_frame_reader(sock).read_frame()
+        if frame is None:
+            print("CLIENT: Connection closed by server.")
             if running: running = False
             return None
 
-        # 4. Decode from UTF-8 and parse JSON
-        json_string = json_message_bytes.decode('utf-8')
-        print(f"CLIENT DEBUG: Received JSON string: {json_string[:200]}...")
-        return json.loads(json_string)
+        # 2. Decompress if flagged, then decode with the codec negotiated by HELLO (JSON by default)
+        message_bytes, compressed = frame
+        print(f"CLIENT DEBUG: Received {connection_codec.name} message of length: {len(message_bytes)}")
+        message = protocol.decode_body(message_bytes, compressed, connection_codec, connection_compressor)
+        print(f"CLIENT DEBUG: Received {connection_codec.name} message: {str(message)[:200]}...")
+        return message
 
-    except struct.error as se:
-        print(f"CLIENT: Struct unpack error (likely bad length prefix from server or connection issue): {se}")
+    except socket.timeout:
+        print("CLIENT: Socket timeout while waiting for the server.")
+        if running: running = False
+        return None
+    except protocol.FrameTooLargeError as e:
+        print(f"CLIENT: {e}")
         if running: running = False
         return None
-    except json.JSONDecodeError as je:
-        print(f"CLIENT: Failed to decode JSON received from server. Error: {je}")
-        print(f"CLIENT DEBUG MALFORMED JSON DATA: <{json_message_bytes.decode('utf-8', errors='ignore') if 'json_message_bytes' in locals() else 'Could not decode for debug'}>")
+    except protocol.FrameDecodeError as de:
+        print(f"CLIENT: Failed to decode {connection_codec.name} received from server. Error: {de}")
+        print(f"CLIENT DEBUG MALFORMED DATA: <{bytes(message_bytes[:200]) if 'message_bytes' in locals() else 'Could not decode for debug'}>")
         if running: running = False
-        return {"status": "error", "message": "Malformed JSON received from server (decode error)."} # Or None
+        return {"status": "error", "message": f"Malformed {connection_codec.name.upper()} received from server (decode error)."} # Or None
     except Exception as e:
         print(f"CLIENT: Critical error in receive_json_client: {e}")
         if running: running = False
         return None
 
+
+def load_compression_dictionary(path=COMPRESSION_DICT_PATH):
+    """The shared dictionary offered in HELLO, if the file is present (it must match the server's --compression-dict)."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return protocol.CompressionDictionary.load(path)
+    except OSError as e:
+        print(f"CLIENT: Could not load compression dictionary {path}: {e}")
+        return None
+
+def negotiate_framing(sock):
+    """Sends HELLO offering the installed codecs and compression, and switches to what the server picks.
+
+    Stays on plain JSON if the server doesn't understand HELLO.
+    """
+    global connection_codec, connection_compressor
+    dictionary = load_compression_dictionary()
+    if not send_json_client(sock, protocol.hello_request(dictionary=dictionary)):
+        return
+    response = receive_json_client(sock)
+    if response and response.get("status") == "success" and response.get("action_response_to") == "HELLO":
+        data = response.get("data") or {}
+        connection_codec = protocol.get_codec(data.get("codec")) or protocol.JSON
+        use_dictionary = dictionary if dictionary is not None and data.get("dictionary") == dictionary.id else None
+        connection_compressor = protocol.get_compressor(data.get("compression"), use_dictionary) if data.get("compression") else None
+    print(f"CLIENT: Using {connection_codec.name} framing, compression: {connection_compressor.name if connection_compressor else 'off'}.")
+
 running = True
+connection_codec = protocol.JSON # Switched by negotiate_framing() right after connecting
+connection_compressor = None # protocol.Compressor, also negotiated by HELLO
+frame_reader = None # protocol.FrameReader for the server socket, see get_frame_reader()
+send_lock = threading.Lock() # One sendall() at a time, so concurrent frames never interleave
+request_ids = itertools.count(1) # request_id echoed back on every response
 authenticated_user_details = None # Stores {'user_id': id, 'username': name}
 current_server_context_name = "Global" # Default context name for the prompt
 client_active_server_id = None
@@ -150,6 +166,9 @@ def sendingThread(sock):
                 elif command == "/my_servers":
                     request_json = {"action": "LIST_MY_SERVERS"}
 
+                elif command == "/bootstrap":
+                    request_json = {"action": "LOGIN_BOOTSTRAP"}
+
                 elif command == "/users_in_server": # <<< NEW COMMAND
                     target_server_id_for_request = None
                     if len(args_list) == 1: # User provided a server ID
@@ -176,12 +195,16 @@ def sendingThread(sock):
                     else: print("CLIENT: Usage: /leave_server <server_id>")
 
                 elif command == "/server_history":
-                    if len(args_list) == 1:
+                    # /server_history <id> [before|after <message_id>] pages through older/newer messages
+                    if len(args_list) == 1 or (len(args_list) == 3 and args_list[1] in ("before", "after")):
                         try:
                             server_id = int(args_list[0])
-                            request_json = {"action": "SERVER_HISTORY", "payload": {"server_id": server_id}}
-                        except ValueError: print("CLIENT: Invalid server ID. Must be a number.")
-                    else: print("CLIENT: Usage: /server_history <server_id>")
+                            history_payload = {"server_id": server_id}
+                            if len(args_list) == 3:
+                                history_payload[f"{args_list[1]}_message_id"] = int(args_list[2])
+                            request_json = {"action": "SERVER_HISTORY", "payload": history_payload}
+                        except ValueError: print("CLIENT: Invalid server ID or message ID. Must be a number.")
+                    else: print("CLIENT: Usage: /server_history <server_id> [before|after <message_id>]")
 
                 elif command == "/accept_challenge":
                     if len(args_list) == 1:
@@ -247,8 +270,10 @@ def sendingThread(sock):
                     print("  /create_server <name>   - Create a new server.")
                     print("  /list_servers           - List all available servers.")
                     print("  /my_servers             - List servers you are a member of.")
+                    print("  /bootstrap              - Your servers with recent history and members.")
                     print("  /join_server <code>     - Join a server by its ID.")
                     print("  /server_history <id>    - Set a server as your active context.")
+                    print("  /server_history <id> before|after <msg_id> - Page through older/newer messages.")
                     print("  /leave_server <id>      - Leave a server by its ID.")
                     print("  /users_in_server [id]   - List users in a server (current if no id).")
                     print("  /message <id> <message> - Message to that specific server.")
@@ -269,6 +294,7 @@ def sendingThread(sock):
                 sys.stdout.write(get_prompt()); sys.stdout.flush()
 
             if request_json:
+                request_json["request_id"] = next(request_ids) # Lets the server pipeline read-only requests
                 if not send_json_client(sock, request_json):
                     print("CLIENT: Failed to send request to server. Disconnecting.")
                     running = False
@@ -307,6 +333,9 @@ def receivingThread(sock):
                     print("\rCLIENT: Disconnected from server (receiver).")
                 running = False
                 break
+            if response_data.get("type") == "PING": # Server heartbeat; unanswered, the server drops us as dead
+                send_json_client(sock, {"action": "PONG", "payload": response_data.get("payload", {})})
+                continue
 
             prompt_len = len(get_prompt())
             sys.stdout.write('\r' + ' ' * (prompt_len + 100) + '\r')
@@ -337,6 +366,13 @@ def receivingThread(sock):
                             print(f"  Server Name: '{data.get('server_name')}', ID: {data.get('server_id')}")
                             print(f"  Invite Code: {data.get('invite_code')}") # Display invite code
 
+                    elif action_response == "LOGIN_BOOTSTRAP":
+                        for server_item in data.get("servers", []):
+                            online_count = sum(1 for member in server_item.get("members", []) if member.get("is_online"))
+                            print(f"    ID: {server_item.get('server_id')}, Name: \"{server_item.get('name')}\", "
+                                  f"{len(server_item.get('messages', []))} recent messages, "
+                                  f"{online_count}/{len(server_item.get('members', []))} members online")
+
                     elif action_response == "SERVER_HISTORY": # Ensure this part is correct from previous step
                         server_name = data.get("server_name", "UnknownServer")
                         messages_history = data.get("messages", [])
@@ -348,6 +384,11 @@ def receivingThread(sock):
                                 content = msg_data.get('content', '')
                                 print(f"  ({ts}) {sender}: {content}")
                             print("  --- End of History ---")
+                            if data.get("has_more"):
+                                if data.get("after_message_id") is not None:
+                                    print(f"  More newer messages: /server_history {data.get('server_id')} after {messages_history[-1].get('message_id')}")
+                                else:
+                                    print(f"  More older messages: /server_history {data.get('server_id')} before {messages_history[0].get('message_id')}")
                         else:
                             print("  No messages found for this server.")
 
@@ -448,6 +489,12 @@ def receivingThread(sock):
             elif response_data.get("type") == "USER_LEFT":
                 payload = response_data.get("payload", {})
                 print(f"SERVER: {payload.get('username')} (ID: {payload.get('user_id')}) left the chat system.")
+            elif response_data.get("type") == "PRESENCE_DELTA":
+                payload = response_data.get("payload", {})
+                for user in payload.get("joined", []):
+                    print(f"SERVER: {user.get('username')} joined the chat system.")
+                for user in payload.get("left", []):
+                    print(f"SERVER: {user.get('username')} (ID: {user.get('user_id')}) left the chat system.")
 
             elif status == "error" and not action_response:
                  print(f"SERVER ERROR: {message}")
@@ -487,6 +534,7 @@ if __name__ == "__main__":
         print(f"CLIENT: Connecting to {server_ip}:{port}...")
         s.connect((server_ip, port))
         print("CLIENT: Connected to server!")
+        negotiate_framing(s)
     except socket.timeout:
         print(f"CLIENT: Connection attempt to server timed out.")
         sys.exit(1)
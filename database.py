@@ -1,7 +1,17 @@
 # DATABASE.PY
+import json
+import logging
+import os
 import sqlite3
 import time # For Unix timestamps
 import secrets
+import threading
+import queue
+
+import metrics
+import passwords
+
+logger = logging.getLogger("chat.database")
 
 SUPER_USER_ID = 1
 SUPER_USER_USERNAME = "SYSTEM"
@@ -9,41 +19,152 @@ CHALLENGE_USER_ID = 2
 CHALLENGE_USER_USERNAME = "CHALLENGE_NOTICE"
 DATABASE_FILE = 'chat_app.db'
 
+# --- Connection pool settings ---
+DATABASE_POOL_SIZE = 8 # Max SQLite connections open at once, shared by all server threads
+DATABASE_STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per connection (sqlite3 cached_statements)
+DATABASE_BUSY_TIMEOUT = 5.0 # Seconds to wait on a locked database before failing
+
+# Every query function below reports how long its calls take, waiting for a pooled connection included
+DATABASE_CALL_SECONDS = metrics.histogram("chat_database_call_duration_seconds",
+                                          "Time spent in database.py calls, by function.", ["function"])
+_timed = metrics.timed(DATABASE_CALL_SECONDS)
+
+class ConnectionPool:
+    """Bounded pool of persistent SQLite connections shared across threads.
+
+    Connections are opened lazily up to pool_size and configured once (WAL
+    journal, synchronous=NORMAL, foreign keys on), so a query costs a queue
+    get/put instead of open + schema parse + close. A thread that already holds
+    a connection gets the same one back, so helpers calling other helpers can't
+    exhaust the pool.
+    """
+    def __init__(self, database_file, pool_size, statement_cache_size):
+        self.database_file = database_file
+        self.pool_size = pool_size
+        self.statement_cache_size = statement_cache_size
+        self._idle = queue.LifoQueue() # LIFO keeps the most recently used (warm cache) connections busy
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(self.database_file, timeout=DATABASE_BUSY_TIMEOUT,
+                               check_same_thread=False, cached_statements=self.statement_cache_size)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        return conn
+
+    def acquire(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._open()
+            except Exception:
+                self._slots.release()
+                raise
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        if getattr(self._local, 'conn', None) is not conn:
+            return # Not ours (already released)
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return # Still in use further up this thread's call stack
+
+        self._local.conn = None
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Never hand out a connection with a half-finished transaction
+            conn.row_factory = None # Callers opt into sqlite3.Row per use
+            self._idle.put(conn)
+        except sqlite3.Error as e:
+            logger.warning("Discarding broken pooled connection: %s", e)
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_connection():
+    """Borrows a connection from the shared pool. Return it with release_connection()."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_FILE, DATABASE_POOL_SIZE, DATABASE_STATEMENT_CACHE_SIZE)
+    return _pool.acquire()
+
+def release_connection(conn):
+    _pool.release(conn)
+
+def configure_connection_pool(database_file=None, pool_size=None, statement_cache_size=None):
+    """Changes the database file or pool settings; idle connections are closed and reopened lazily."""
+    global _pool, DATABASE_FILE, DATABASE_POOL_SIZE, DATABASE_STATEMENT_CACHE_SIZE
+    with _pool_lock:
+        if database_file is not None:
+            DATABASE_FILE = database_file
+        if pool_size is not None:
+            DATABASE_POOL_SIZE = pool_size
+        if statement_cache_size is not None:
+            DATABASE_STATEMENT_CACHE_SIZE = statement_cache_size
+        if _pool is not None:
+            _pool.close_all()
+        _pool = None
+
 def generate_invite_code(length = 12):
     return secrets.token_urlsafe(length)[:length]
 
-def add_user(username, password):
-    """Adds a new user to the database with a password."""
+@_timed
+def add_user(username, password_hash):
+    """Adds a new user; password_hash comes from passwords.hash_password."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
 
 
         current_time = int(time.time())
 
         cursor.execute("INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)",
-                       (username, password, current_time))
+                       (username, password_hash, current_time))
         conn.commit()
-        print(f"User '{username}' added successfully.")
+        logger.info("User '%s' added successfully.", username)
         return True # Indicate success
     except sqlite3.IntegrityError:
         # This error likely means the username is already taken (due to UNIQUE constraint)
-        print(f"Error: Username '{username}' already exists.")
+        logger.info("Username '%s' already exists.", username)
         return False # Indicate failure (username taken)
     except sqlite3.Error as e:
-        print(f"Database error adding user: {e}")
+        logger.error("Database error adding user: %s", e)
         return False # Indicate general failure
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
+@_timed
 def get_user(user_id):
     """Retrieves user details by username."""
     conn = None
     user_data = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         # Use row_factory to get results as dictionary-like objects
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
@@ -52,58 +173,82 @@ def get_user(user_id):
         user_data = cursor.fetchone() # Fetches one row or None
 
     except sqlite3.Error as e:
-        print(f"Database error getting user: {e}")
+        logger.error("Database error getting user: %s", e)
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
     return user_data # Returns a Row object (like a dict) or None
 
+@_timed
 def get_user_by_name(username): # Needed to get ID from name
     """Retrieves user_id by username."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
         row = cursor.fetchone()
         return row[0] if row else None
     except sqlite3.Error as e:
-        print(f"Database error getting user by name '{username}': {e}")
+        logger.error("Database error getting user by name '%s': %s", username, e)
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
-def check_user_credentials(username, password):
-    """Checks if the username exists and the password is correct."""
-    user_data = get_user_by_name(username) # Use get_user_by_name now
-    if user_data:
-        conn = sqlite3.connect(DATABASE_FILE)
-        conn.row_factory = sqlite3.Row
+@_timed
+def get_user_credentials(username):
+    """(user_id, stored password hash) for username in one query, or None if there is no such user."""
+    conn = None
+    try:
+        conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT password FROM users WHERE user_id = ?", (user_data,))
-        stored_password = cursor.fetchone()['password']
-        conn.close()
+        cursor.execute("SELECT user_id, password FROM users WHERE username = ?", (username,))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else None
+    except sqlite3.Error as e:
+        logger.error("Database error getting credentials for '%s': %s", username, e)
+        return None
+    finally:
+        if conn: release_connection(conn)
 
-        # Check the password
-        if stored_password == password:
-            print(f"Password match for user '{username}'.")
-            return user_data # Return user_id on success
-        else:
-            print(f"Password mismatch for user '{username}'.")
-            return None # Password incorrect
-    else:
-        print(f"User '{username}' not found.")
-        return None # User not found
+@_timed
+def set_password_hash(user_id, password_hash):
+    """Replaces a user's stored password (used to upgrade plaintext rows on login)."""
+    conn = None
+    try:
+        conn = get_connection()
+        conn.execute("UPDATE users SET password = ? WHERE user_id = ?", (password_hash, user_id))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error("Database error updating password of user %s: %s", user_id, e)
+        return False
+    finally:
+        if conn: release_connection(conn)
+
+@_timed
+def check_user_credentials(username, password):
+    """Returns the user_id if the password is correct, else None. Hashes on the calling thread;
+    the server uses server_cache.get_credentials with its PasswordHasher instead."""
+    credentials = get_user_credentials(username)
+    matched, upgraded_hash = passwords.verify_password(password, credentials[1] if credentials else None)
+    if not matched:
+        logger.debug("Invalid credentials for user '%s'.", username)
+        return None
+    if upgraded_hash:
+        set_password_hash(credentials[0], upgraded_hash)
+    return credentials[0]
 
 # --- Server Management Functions ---
 
+@_timed
 def get_challenge_participants(challenge_id):
     """Retrieves a list of participants (user_id, username) for a given challenge."""
     conn = None
     participants = []
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("""
@@ -117,19 +262,19 @@ def get_challenge_participants(challenge_id):
         for row in rows:
             participants.append(dict(row))
     except sqlite3.Error as e:
-        print(f"DB ERROR getting challenge participants for challenge_id {challenge_id}: {e}")
+        logger.error("Error getting challenge participants for challenge_id %s: %s", challenge_id, e)
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
     return participants
 
+@_timed
 def update_challenge_status(challenge_id, new_status):
     """Updates the status of a challenge and its updated_at timestamp."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
         current_time = int(time.time())
 
         cursor.execute("""
@@ -139,27 +284,27 @@ def update_challenge_status(challenge_id, new_status):
         """, (new_status, current_time, challenge_id))
 
         if cursor.rowcount == 0:
-            print(f"DB: No challenge found with ID {challenge_id} to update status to {new_status}.")
+            logger.warning("No challenge found with ID %s to update status to %s.", challenge_id, new_status)
             conn.rollback() # Nothing was updated
             return False
 
         conn.commit()
-        print(f"DB: Challenge ID {challenge_id} status updated to '{new_status}'.")
+        logger.info("Challenge ID %s status updated to '%s'.", challenge_id, new_status)
         return True
     except sqlite3.Error as e:
-        print(f"DB ERROR updating challenge status for {challenge_id}: {e}")
+        logger.error("Error updating challenge status for %s: %s", challenge_id, e)
         if conn: conn.rollback()
         return False
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def add_winner_to_challenge(challenge_id, winner_user_id):
     """Sets the winner for a specific challenge."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
         current_time = int(time.time())
 
         cursor.execute("""
@@ -169,21 +314,22 @@ def add_winner_to_challenge(challenge_id, winner_user_id):
         """, (winner_user_id, current_time, challenge_id))
 
         if cursor.rowcount == 0:
-            print(f"DB WARNING: No challenge found with ID {challenge_id} to add winner.")
+            logger.warning("No challenge found with ID %s to add winner.", challenge_id)
             conn.rollback()
             return False
 
         conn.commit()
-        print(f"DB: Challenge {challenge_id} winner set to User {winner_user_id}.")
+        logger.info("Challenge %s winner set to User %s.", challenge_id, winner_user_id)
         return True
     except sqlite3.Error as e:
-        print(f"DB ERROR adding winner for challenge {challenge_id}: {e}")
+        logger.error("Error adding winner for challenge %s: %s", challenge_id, e)
         if conn: conn.rollback()
         return False
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
+@_timed
 def add_participant_to_challenge(challenge_id, user_id, max_participants=4):
     """
     Adds a user to a challenge if it's pending and not full.
@@ -197,9 +343,8 @@ def add_participant_to_challenge(challenge_id, user_id, max_participants=4):
     """
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
 
         # Check challenge status
         cursor.execute("SELECT status, challenger_user_id, admin_user_id FROM challenges WHERE challenge_id = ?", (challenge_id,))
@@ -229,19 +374,20 @@ def add_participant_to_challenge(challenge_id, user_id, max_participants=4):
             VALUES (?, ?, ?)
         """, (challenge_id, user_id, current_time))
         conn.commit()
-        print(f"DB: User {user_id} added to challenge {challenge_id}.")
+        logger.info("User %s added to challenge %s.", user_id, challenge_id)
         return "SUCCESS"
     except sqlite3.IntegrityError: # Catches UNIQUE constraint violation
-        print(f"DB: User {user_id} likely already joined challenge {challenge_id} (IntegrityError).")
+        logger.info("User %s likely already joined challenge %s (IntegrityError).", user_id, challenge_id)
         return "ALREADY_JOINED" # Should be caught by the explicit check above too
     except sqlite3.Error as e:
-        print(f"DB ERROR adding participant to challenge {challenge_id}: {e}")
+        logger.error("Error adding participant to challenge %s: %s", challenge_id, e)
         if conn: conn.rollback()
         return "ERROR"
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
+@_timed
 def create_challenge(server_id, challenger_user_id, admin_user_id):
     """
     Creates a new challenge in 'pending' status and adds challenger and admin as participants.
@@ -249,9 +395,8 @@ def create_challenge(server_id, challenger_user_id, admin_user_id):
     """
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
 
         # Check for existing active (pending or accepted) challenges in this server
         cursor.execute("""
@@ -259,7 +404,7 @@ def create_challenge(server_id, challenger_user_id, admin_user_id):
             WHERE server_id = ? AND status IN ('pending', 'accepted', 'in_progress')
         """, (server_id,))
         if cursor.fetchone():
-            print(f"DB: Active challenge already exists for server_id {server_id}.")
+            logger.info("Active challenge already exists for server_id %s.", server_id)
             return None # Indicate active challenge exists
 
         current_time = int(time.time())
@@ -281,18 +426,19 @@ def create_challenge(server_id, challenger_user_id, admin_user_id):
             """, participants_to_add)
 
             conn.commit()
-            print(f"DB: Challenge {challenge_id} created for server {server_id} by user {challenger_user_id} against admin {admin_user_id}.")
+            logger.info("Challenge %s created for server %s by user %s against admin %s.", challenge_id, server_id, challenger_user_id, admin_user_id)
             return challenge_id
         else:
             conn.rollback()
             return None
     except sqlite3.Error as e:
-        print(f"DB ERROR creating challenge: {e}")
+        logger.error("Error creating challenge: %s", e)
         if conn: conn.rollback()
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def get_active_challenge_for_server(server_id):
     """
     Retrieves details of an active ('pending', 'accepted', 'in_progress') challenge for a server.
@@ -300,7 +446,7 @@ def get_active_challenge_for_server(server_id):
     """
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("""
@@ -310,34 +456,35 @@ def get_active_challenge_for_server(server_id):
         row = cursor.fetchone()
         return dict(row) if row else None
     except sqlite3.Error as e:
-        print(f"DB ERROR getting active challenge for server {server_id}: {e}")
+        logger.error("Error getting active challenge for server %s: %s", server_id, e)
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def get_challenge_details(challenge_id):
     """Retrieves details of any challenge by its ID."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM challenges WHERE challenge_id = ?", (challenge_id,))
         row = cursor.fetchone()
         return dict(row) if row else None
     except sqlite3.Error as e:
-        print(f"DB ERROR getting details for challenge {challenge_id}: {e}")
+        logger.error("Error getting details for challenge %s: %s", challenge_id, e)
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
+@_timed
 def create_server(server_name, admin_user_id):
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
 
         current_time = int(time.time())
 
@@ -360,57 +507,59 @@ def create_server(server_name, admin_user_id):
             cursor.execute("INSERT INTO memberships (user_id, server_id, joined_at) VALUES (?, ?, ?)",
                            (admin_user_id, server_id, current_time))
             conn.commit()
-            print(f"Server '{server_name}' (ID: {server_id}) created with invite code '{invite_code}' and admin ID {admin_user_id}.")
+            logger.info("Server '%s' (ID: %s) created with invite code '%s' and admin ID %s.", server_name, server_id, invite_code, admin_user_id)
             return {"server_id": server_id, "invite_code": invite_code} # Return more info
         else:
             conn.rollback()
             return None
     # ... (rest of your except and finally blocks, ensure rollback on error) ...
     except sqlite3.Error as e: # Catch specific error
-        print(f"Database error creating server '{server_name}': {e}")
+        logger.error("Database error creating server '%s': %s", server_name, e)
         if conn: conn.rollback()
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def update_server_admin(server_id, new_admin_id):
     """Updates the admin for a specific server."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
 
         # Check if the new admin is actually a member
         cursor.execute("SELECT 1 FROM memberships WHERE user_id = ? AND server_id = ?", (new_admin_id, server_id))
         if cursor.fetchone() is None:
-            print(f"DB ERROR: Cannot make User {new_admin_id} admin of Server {server_id} because they are not a member.")
+            logger.error("Cannot make User %s admin of Server %s because they are not a member.", new_admin_id, server_id)
             return False
 
         cursor.execute("UPDATE servers SET admin_user_id = ? WHERE server_id = ?",
                        (new_admin_id, server_id))
 
         if cursor.rowcount == 0:
-            print(f"DB WARNING: No server found with ID {server_id} to update admin.")
+            logger.warning("No server found with ID %s to update admin.", server_id)
             conn.rollback()
             return False
 
+        _record_server_event(cursor, server_id, SERVER_EVENT_ADMIN_CHANGED, new_admin_id)
         conn.commit()
-        print(f"DB: Server {server_id} admin updated to User {new_admin_id}.")
+        logger.info("Server %s admin updated to User %s.", server_id, new_admin_id)
         return True
     except sqlite3.Error as e:
-        print(f"DB ERROR updating server admin for {server_id}: {e}")
+        logger.error("Error updating server admin for %s: %s", server_id, e)
         if conn: conn.rollback()
         return False
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
 
+@_timed
 def get_server_by_invite_code(invite_code):
     """Retrieves server details by its invite code."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         # Join with users to get admin username as well
@@ -426,17 +575,18 @@ def get_server_by_invite_code(invite_code):
         else:
             return None
     except sqlite3.Error as e:
-        print(f"Database error retrieving server by invite code '{invite_code}': {e}")
+        logger.error("Database error retrieving server by invite code '%s': %s", invite_code, e)
         return None
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
+@_timed
 def get_invite_code_for_server(server_id):
     """Retrieves the invite code for a specific server."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT invite_code, name FROM servers WHERE server_id = ?", (server_id,))
         row = cursor.fetchone()
@@ -445,17 +595,18 @@ def get_invite_code_for_server(server_id):
         else:
             return None
     except sqlite3.Error as e:
-        print(f"Database error retrieving invite code for server {server_id}: {e}")
+        logger.error("Database error retrieving invite code for server %s: %s", server_id, e)
         return None
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def get_all_servers():
     """Retrieves a list of all servers (id, name, admin_id)."""
     conn = None
     servers_list = []
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
@@ -477,18 +628,19 @@ def get_all_servers():
             })
 
     except sqlite3.Error as e:
-        print(f"Database error retrieving all servers: {e}")
+        logger.error("Database error retrieving all servers: %s", e)
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
     return servers_list
 
+@_timed
 def get_user_servers(user_id):
     """Retrieves a list of servers a specific user is a member of, including invite codes."""
     conn = None
     user_servers_list = []
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row # Allows accessing columns by name
         cursor = conn.cursor()
 
@@ -513,44 +665,61 @@ def get_user_servers(user_id):
             })
 
     except sqlite3.Error as e:
-        print(f"Database error retrieving servers for user {user_id}: {e}")
+        logger.error("Database error retrieving servers for user %s: %s", user_id, e)
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
     return user_servers_list
 
+@_timed
+def get_user_server_ids(user_id):
+    """Returns the IDs of every server the user is a member of."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT server_id FROM memberships WHERE user_id = ?", (user_id,))
+        return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error("Database error retrieving server IDs for user %s: %s", user_id, e)
+        return []
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
 def add_user_to_server(user_id, server_id):
     """Adds a user to a server's membership list if they are not already a member."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
         current_time = int(time.time())
 
         cursor.execute("INSERT INTO memberships (user_id, server_id, joined_at) VALUES (?, ?, ?)",
                        (user_id, server_id, current_time))
+        _record_server_event(cursor, server_id, SERVER_EVENT_MEMBER_JOINED, user_id)
         conn.commit()
-        print(f"User ID {user_id} added to server ID {server_id}.")
+        logger.info("User ID %s added to server ID %s.", user_id, server_id)
         return True
     except sqlite3.IntegrityError:
         # This will trigger if the (user_id, server_id) UNIQUE constraint is violated (already a member)
         # or if user_id/server_id does not exist (FK constraint violation)
-        print(f"User ID {user_id} could not be added to server ID {server_id} (already a member or invalid ID).")
+        logger.info("User ID %s could not be added to server ID %s (already a member or invalid ID).", user_id, server_id)
         return False
     except sqlite3.Error as e:
-        print(f"Database error adding user {user_id} to server {server_id}: {e}")
+        logger.error("Database error adding user %s to server %s: %s", user_id, server_id, e)
         return False
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
-def remove_user_from_server(user_id_leaving, server_id):
+@_timed
+def remove_user_from_server(user_id_leaving, server_id, kicked=False):
     conn = None # Initialize conn
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        conn.execute("PRAGMA foreign_keys = ON;")
 
         cursor.execute("SELECT admin_user_id FROM servers WHERE server_id = ?", (server_id,))
         server_row = cursor.fetchone()
@@ -563,6 +732,7 @@ def remove_user_from_server(user_id_leaving, server_id):
             conn.rollback()
             return {"status": "NOT_MEMBER"}
 
+        _record_server_event(cursor, server_id, SERVER_EVENT_MEMBER_KICKED if kicked else SERVER_EVENT_MEMBER_LEFT, user_id_leaving)
         if not is_leaving_user_admin:
             conn.commit()
             return {"status": "SUCCESS_LEFT"}
@@ -586,6 +756,7 @@ def remove_user_from_server(user_id_leaving, server_id):
                 new_admin_username = new_admin_data_row[1]
                 cursor.execute("UPDATE servers SET admin_user_id = ? WHERE server_id = ?",
                                (new_admin_user_id, server_id))
+                _record_server_event(cursor, server_id, SERVER_EVENT_ADMIN_CHANGED, new_admin_user_id)
                 conn.commit()
                 return {
                     "status": "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED",
@@ -596,20 +767,22 @@ def remove_user_from_server(user_id_leaving, server_id):
                 return {"status": "ERROR_FAILED_TO_ASSIGN_NEW_ADMIN"}
         else:
             cursor.execute("DELETE FROM servers WHERE server_id = ?", (server_id,))
+            cursor.execute("DELETE FROM server_events WHERE server_id = ?", (server_id,)) # Nobody is left to resume it
             conn.commit()
             return {"status": "SUCCESS_ADMIN_LEFT_SERVER_DELETED"}
     except sqlite3.Error as e:
-        print(f"Database error processing user {user_id_leaving} leaving server {server_id}: {e}")
+        logger.error("Database error processing user %s leaving server %s: %s", user_id_leaving, server_id, e)
         if conn: conn.rollback()
         return {"status": "ERROR", "data": {"details": str(e)}}
     finally:
-        if conn: conn.close()
+        if conn: release_connection(conn)
 
+@_timed
 def get_server_details(server_id):
     """Retrieves details for a specific server, including admin username."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
@@ -627,35 +800,37 @@ def get_server_details(server_id):
             return None # Server not found
 
     except sqlite3.Error as e:
-        print(f"Database error retrieving details for server {server_id}: {e}")
+        logger.error("Database error retrieving details for server %s: %s", server_id, e)
         return None
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
+@_timed
 def is_user_member(user_id, server_id):
     """Checks if a user is a member of a specific server."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
 
         cursor.execute("SELECT 1 FROM memberships WHERE user_id = ? AND server_id = ? LIMIT 1", (user_id, server_id))
         return cursor.fetchone() is not None # True if a row is found, False otherwise
 
     except sqlite3.Error as e:
-        print(f"Database error checking membership for user {user_id} in server {server_id}: {e}")
+        logger.error("Database error checking membership for user %s in server %s: %s", user_id, server_id, e)
         return False # Default to False on error
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
+@_timed
 def get_server_members(server_id):
-    """Retrieves a list of members (user_id, username) for a specific server."""
+    """Retrieves a list of members (user_id, username) for a specific server. None on database error."""
     conn = None
     members_list = []
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
@@ -672,74 +847,667 @@ def get_server_members(server_id):
             members_list.append(dict(row))
 
     except sqlite3.Error as e:
-        print(f"Database error retrieving members for server {server_id}: {e}")
+        logger.error("Database error retrieving members for server %s: %s", server_id, e)
+        return None
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
     return members_list
 
+@_timed
 def add_message(server_id, user_id, content):
+    """Saves a chat message and returns its message_id (None on failure).
+
+    While the group-commit writer is running the insert is batched with other
+    threads' messages; the call still only returns once the row is committed.
+    """
+    writer = _message_writer
+    if writer is not None:
+        pending = writer.submit(server_id, user_id, content)
+        if pending is not None:
+            pending.done.wait()
+            return pending.message_id
+    return _insert_message(server_id, user_id, content, int(time.time()))
+
+def _insert_message(server_id, user_id, content, current_time):
+    """Inserts and commits a single message (the path used when no writer is running)."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
-        current_time = int(time.time())
         cursor.execute("""
             INSERT INTO messages (server_id, user_id, content, timestamp)
             VALUES (?, ?, ?, ?)
         """, (server_id, user_id, content, current_time))
         conn.commit()
         message_id = cursor.lastrowid
-        print(f"Message from UserID {user_id} saved to ServerID {server_id} with MsgID {message_id}.")
+        logger.debug("Message from UserID %s saved to ServerID %s with MsgID %s.", user_id, server_id, message_id)
         return message_id # Return the new message's ID
     except sqlite3.Error as e:
-        print(f"Database error adding message: {e}")
+        logger.error("Database error adding message: %s", e)
         if conn:
             conn.rollback()
         return None
     finally:
         if conn:
-            conn.close()
-
-def get_messages_for_server(server_id, limit=50):
+            release_connection(conn)
+
+# --- Group-commit message writer ---
+MESSAGE_WRITER_BATCH_SIZE = 64 # Commit as soon as this many messages are waiting...
+MESSAGE_WRITER_FLUSH_INTERVAL_MS = 10 # ...or once the first waiting message is this old
+
+class PendingMessage:
+    def __init__(self, server_id, user_id, content, timestamp):
+        self.server_id = server_id
+        self.user_id = user_id
+        self.content = content
+        self.timestamp = timestamp
+        self.message_id = None
+        self.done = threading.Event()
+
+class MessageWriter(threading.Thread):
+    """Background thread that inserts chat messages in batches with one commit per batch.
+
+    Callers of add_message block until their batch is committed and then get the
+    real AUTOINCREMENT message_id, so broadcasts carry the same ids as before.
+    """
+    def __init__(self, batch_size, flush_interval_ms):
+        super().__init__(name="message-writer", daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self._queue = queue.Queue()
+        self._submit_lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, server_id, user_id, content):
+        """Queues a message. Returns the PendingMessage, or None once the writer is stopping."""
+        pending = PendingMessage(server_id, user_id, content, int(time.time()))
+        with self._submit_lock:
+            if self._closed:
+                return None
+            self._queue.put(pending)
+        return pending
+
+    def stop(self):
+        """Flushes everything already queued, then ends the thread."""
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None) # Nothing can be queued after this sentinel
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        conn = None
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            for pending in batch:
+                cursor.execute("""
+                    INSERT INTO messages (server_id, user_id, content, timestamp)
+                    VALUES (?, ?, ?, ?)
+                """, (pending.server_id, pending.user_id, pending.content, pending.timestamp))
+                pending.message_id = cursor.lastrowid
+            conn.commit()
+            logger.debug("Committed batch of %s message(s), last MsgID %s.", len(batch), batch[-1].message_id)
+        except sqlite3.Error as e:
+            logger.warning("Error committing message batch of %s: %s. Retrying one by one.", len(batch), e)
+            if conn:
+                conn.rollback()
+            # One bad row (e.g. a server deleted meanwhile) must not fail the whole batch
+            for pending in batch:
+                pending.message_id = _insert_message(pending.server_id, pending.user_id, pending.content, pending.timestamp)
+        except Exception as e:
+            logger.error("Unexpected error in message writer: %s", e)
+            for pending in batch:
+                pending.message_id = None
+        finally:
+            if conn:
+                release_connection(conn)
+            for pending in batch:
+                pending.done.set()
+
+_message_writer = None
+
+def start_message_writer(batch_size=None, flush_interval_ms=None):
+    """Starts batching add_message inserts into group commits."""
+    global _message_writer
+    if _message_writer is not None:
+        return
+    _message_writer = MessageWriter(batch_size or MESSAGE_WRITER_BATCH_SIZE,
+                                    flush_interval_ms if flush_interval_ms is not None else MESSAGE_WRITER_FLUSH_INTERVAL_MS)
+    _message_writer.start()
+    logger.info("Message writer started (batch size %s, flush every %.0f ms).", _message_writer.batch_size, _message_writer.flush_interval * 1000)
+
+def stop_message_writer():
+    """Commits any queued messages and stops the writer. Safe to call when it isn't running."""
+    global _message_writer
+    writer = _message_writer
+    if writer is None:
+        return
+    writer.stop()
+    _message_writer = None
+    logger.info("Message writer flushed and stopped.")
+
+# --- Forked worker processes (server.py --workers) ---
+_inherited_pools = [] # Pools a forked child inherited; kept referenced so they are never closed there
+
+def _reset_after_fork():
+    """Runs in a freshly forked child: it must open its own connections and writer thread.
+
+    SQLite connections can't be used across fork(), and closing the inherited
+    ones could checkpoint or delete the WAL files the parent still uses, so they
+    are just abandoned.
+    """
+    global _pool, _pool_lock, _message_writer
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+    _pool = None
+    _pool_lock = threading.Lock()
+    _message_writer = None # Its thread does not exist in the child
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+MESSAGE_HISTORY_PAGE_SIZE = 50 # Messages per SERVER_HISTORY page unless the client asks for fewer/more
+MESSAGE_HISTORY_MAX_PAGE_SIZE = 200 # Upper bound on a client-requested page size
+
+@_timed
+def get_message_page(server_id, before_message_id=None, after_message_id=None, limit=MESSAGE_HISTORY_PAGE_SIZE):
+    """Returns (messages, has_more) for one page of a server's history, oldest first.
+
+    Pages are keyset cursors on message_id, so no rows are skipped with OFFSET:
+      - no cursor: the latest `limit` messages; has_more means older ones exist.
+      - before_message_id: the `limit` messages just older than it; has_more means even older ones exist.
+      - after_message_id: the `limit` messages just newer than it (optionally bounded by
+        before_message_id); has_more means newer ones exist past this page.
+    """
     conn = None
     messages_list = []
+    has_more = False
+    limit = max(1, min(int(limit), MESSAGE_HISTORY_MAX_PAGE_SIZE))
+    conditions = ["m.server_id = ?"]
+    params = [server_id]
+    if after_message_id is not None:
+        conditions.append("m.message_id > ?")
+        params.append(after_message_id)
+    if before_message_id is not None:
+        conditions.append("m.message_id < ?")
+        params.append(before_message_id)
+    # Walk forward from an 'after' cursor, otherwise backward from the newest/'before' end
+    order = "ASC" if after_message_id is not None else "DESC"
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT m.message_id, m.server_id, m.user_id, u.username as sender_username, m.content, m.timestamp
             FROM messages m
             JOIN users u ON m.user_id = u.user_id
-            WHERE m.server_id = ?
-            ORDER BY m.timestamp DESC
+            WHERE {" AND ".join(conditions)}
+            ORDER BY m.message_id {order}
             LIMIT ?
-        """, (server_id, limit)) # Get latest N messages
+        """, (*params, limit + 1)) # One extra row tells us whether another page exists
         rows = cursor.fetchall()
-        for row in reversed(rows): # Reverse to get them in chronological order for display
-            messages_list.append(dict(row))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if order == "DESC":
+            rows.reverse() # Chronological order for display
+        messages_list = [dict(row) for row in rows]
     except sqlite3.Error as e:
-        print(f"Database error retrieving messages for server {server_id}: {e}")
+        logger.error("Database error retrieving messages for server %s: %s", server_id, e)
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
+    return messages_list, has_more
+
+@_timed
+def get_messages_for_server(server_id, limit=MESSAGE_HISTORY_PAGE_SIZE):
+    """The latest `limit` messages of a server, oldest first."""
+    messages_list, _ = get_message_page(server_id, limit=limit)
     return messages_list
 
+@_timed
+def get_login_bootstrap(user_id, history_limit=MESSAGE_HISTORY_PAGE_SIZE):
+    """Everything a client needs after LOGIN, in three queries on one connection.
+
+    Returns a list of the user's servers (same fields as get_user_servers), each with
+    "messages" (latest page, oldest first), "has_more" and "members"
+    ([{'user_id', 'username'}] sorted by username). Returns None on a database error.
+    """
+    conn = None
+    history_limit = max(1, min(int(history_limit), MESSAGE_HISTORY_MAX_PAGE_SIZE))
+    try:
+        conn = get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT s.server_id, s.name, s.admin_user_id, u_admin.username as admin_username, s.invite_code
+            FROM servers s
+            JOIN memberships m ON s.server_id = m.server_id
+            JOIN users u_admin ON s.admin_user_id = u_admin.user_id
+            WHERE m.user_id = ?
+            ORDER BY s.name ASC
+        """, (user_id,))
+        servers = {}
+        for row in cursor.fetchall():
+            servers[row["server_id"]] = dict(row, messages=[], has_more=False, members=[])
+
+        # Latest page of every server at once; the correlated subquery walks
+        # idx_messages_server_message backwards, so only history_limit + 1 rows per server are read
+        cursor.execute("""
+            SELECT m.message_id, m.server_id, m.user_id, u.username as sender_username, m.content, m.timestamp
+            FROM memberships my
+            JOIN messages m ON m.server_id = my.server_id
+            JOIN users u ON m.user_id = u.user_id
+            WHERE my.user_id = ?
+              AND m.message_id IN (
+                  SELECT recent.message_id FROM messages recent
+                  WHERE recent.server_id = my.server_id
+                  ORDER BY recent.message_id DESC
+                  LIMIT ?
+              )
+            ORDER BY m.server_id, m.message_id
+        """, (user_id, history_limit + 1)) # One extra row per server tells us whether older messages exist
+        for row in cursor.fetchall():
+            server = servers.get(row["server_id"])
+            if server is not None:
+                server["messages"].append(dict(row))
+        for server in servers.values():
+            if len(server["messages"]) > history_limit:
+                server["has_more"] = True
+                del server["messages"][0] # Drop the extra (oldest) row
+
+        cursor.execute("""
+            SELECT my.server_id, u.user_id, u.username
+            FROM memberships my
+            JOIN memberships m ON m.server_id = my.server_id
+            JOIN users u ON u.user_id = m.user_id
+            WHERE my.user_id = ?
+            ORDER BY my.server_id, u.username ASC
+        """, (user_id,))
+        for row in cursor.fetchall():
+            server = servers.get(row["server_id"])
+            if server is not None:
+                server["members"].append({"user_id": row["user_id"], "username": row["username"]})
+
+        return list(servers.values())
+    except sqlite3.Error as e:
+        logger.error("Database error building login bootstrap for user %s: %s", user_id, e)
+        return None
+    finally:
+        if conn:
+            release_connection(conn)
+
+# --- Server events and resume tokens ---
+# Membership and admin changes are also written to server_events, in the same
+# transaction as the change. Each event carries the newest message_id of its
+# server at that moment (after_message_id), so a client's last seen message_id
+# per server is also its position in the event log: RESUME replays the events
+# with after_message_id >= that position. An event that the client may already
+# have seen is replayed again; the events describe state and are safe to apply
+# twice. Resume tokens are stored as SHA-256 hashes (passwords.hash_resume_token).
+SERVER_EVENT_MEMBER_JOINED = "MEMBER_JOINED"
+SERVER_EVENT_MEMBER_LEFT = "MEMBER_LEFT"
+SERVER_EVENT_MEMBER_KICKED = "MEMBER_KICKED"
+SERVER_EVENT_ADMIN_CHANGED = "ADMIN_CHANGED" # user_id is the new admin
+RESUME_STATE_PRUNE_INTERVAL = 600 # Seconds between deletions of expired tokens and old events
+_last_resume_state_prune = 0.0
+
+def _record_server_event(cursor, server_id, event_type, user_id):
+    """Adds an event to server_events; the caller commits it together with the change."""
+    cursor.execute("""
+        INSERT INTO server_events (server_id, event_type, user_id, username, after_message_id, created_at)
+        SELECT ?, ?, user_id, username, (SELECT COALESCE(MAX(message_id), 0) FROM messages WHERE server_id = ?), ?
+        FROM users WHERE user_id = ?
+    """, (server_id, event_type, server_id, int(time.time()), user_id))
+
+@_timed
+def get_resume_delta(user_id, last_seen, history_limit=MESSAGE_HISTORY_PAGE_SIZE):
+    """What changed in the user's servers since the client last saw them, in three queries on one connection.
+
+    last_seen maps server_id -> the newest message_id the client holds for it.
+    Returns the user's current servers (same fields as get_user_servers), each
+    with "messages" newer than its last_seen entry (oldest first, at most
+    history_limit; "has_more" means newer ones remain) and "events" (dicts of
+    event_id, event_type, user_id, username, created_at) from server_events.
+    Servers missing from last_seen come back with both lists empty. Returns None
+    on a database error.
+    """
+    conn = None
+    history_limit = max(1, min(int(history_limit), MESSAGE_HISTORY_MAX_PAGE_SIZE))
+    seen_json = json.dumps({str(server_id): message_id for server_id, message_id in last_seen.items()})
+    try:
+        conn = get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT s.server_id, s.name, s.admin_user_id, u_admin.username as admin_username, s.invite_code
+            FROM servers s
+            JOIN memberships m ON s.server_id = m.server_id
+            JOIN users u_admin ON s.admin_user_id = u_admin.user_id
+            WHERE m.user_id = ?
+            ORDER BY s.name ASC
+        """, (user_id,))
+        servers = {}
+        for row in cursor.fetchall():
+            servers[row["server_id"]] = dict(row, messages=[], has_more=False, events=[])
+
+        # Like the bootstrap history query, but walking forward from each server's last seen message
+        cursor.execute("""
+            WITH seen(server_id, message_id) AS (SELECT CAST(key AS INTEGER), value FROM json_each(?))
+            SELECT m.message_id, m.server_id, m.user_id, u.username as sender_username, m.content, m.timestamp
+            FROM seen
+            JOIN memberships my ON my.server_id = seen.server_id AND my.user_id = ?
+            JOIN messages m ON m.server_id = seen.server_id
+            JOIN users u ON m.user_id = u.user_id
+            WHERE m.message_id IN (
+                SELECT newer.message_id FROM messages newer
+                WHERE newer.server_id = seen.server_id AND newer.message_id > seen.message_id
+                ORDER BY newer.message_id ASC
+                LIMIT ?
+            )
+            ORDER BY m.server_id, m.message_id
+        """, (seen_json, user_id, history_limit + 1)) # One extra row per server tells us whether more are missing
+        for row in cursor.fetchall():
+            server = servers.get(row["server_id"])
+            if server is not None:
+                server["messages"].append(dict(row))
+        for server in servers.values():
+            if len(server["messages"]) > history_limit:
+                server["has_more"] = True
+                del server["messages"][-1] # Drop the extra (newest) row; the client pages on from the last one it got
+
+        cursor.execute("""
+            WITH seen(server_id, message_id) AS (SELECT CAST(key AS INTEGER), value FROM json_each(?))
+            SELECT e.event_id, e.server_id, e.event_type, e.user_id, e.username, e.created_at
+            FROM seen
+            JOIN memberships my ON my.server_id = seen.server_id AND my.user_id = ?
+            JOIN server_events e ON e.server_id = seen.server_id AND e.after_message_id >= seen.message_id
+            ORDER BY e.event_id
+        """, (seen_json, user_id))
+        for row in cursor.fetchall():
+            server = servers.get(row["server_id"])
+            if server is not None:
+                event = dict(row)
+                del event["server_id"]
+                server["events"].append(event)
+
+        return list(servers.values())
+    except sqlite3.Error as e:
+        logger.error("Database error building resume delta for user %s: %s", user_id, e)
+        return None
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
+def add_resume_token(token_hash, user_id, expires_at):
+    """Stores a new resume token for the user. Also prunes expired tokens and old events now and then."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO resume_tokens (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                       (token_hash, user_id, int(time.time()), expires_at))
+        conn.commit()
+        _prune_resume_state(conn, expires_at - int(time.time()))
+        return True
+    except sqlite3.Error as e:
+        logger.error("Database error storing resume token for user %s: %s", user_id, e)
+        if conn: conn.rollback()
+        return False
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
+def get_resume_token_user(token_hash):
+    """Returns (user_id, username) for an unexpired resume token, or None."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.user_id, u.username FROM resume_tokens t
+            JOIN users u ON u.user_id = t.user_id
+            WHERE t.token_hash = ? AND t.expires_at > ?
+        """, (token_hash, int(time.time())))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else None
+    except sqlite3.Error as e:
+        logger.error("Database error looking up a resume token: %s", e)
+        return None
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
+def replace_resume_token(old_token_hash, new_token_hash, user_id, expires_at):
+    """Swaps a used token for a new one in one transaction. False if the old one was already used or expired."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM resume_tokens WHERE token_hash = ? AND user_id = ? AND expires_at > ?",
+                       (old_token_hash, user_id, int(time.time())))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        cursor.execute("INSERT INTO resume_tokens (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                       (new_token_hash, user_id, int(time.time()), expires_at))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error("Database error replacing resume token of user %s: %s", user_id, e)
+        if conn: conn.rollback()
+        return False
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
+def extend_resume_tokens(user_id, expires_at):
+    """Moves the expiry of the user's tokens, so a session can be resumed for a while after it ends."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE resume_tokens SET expires_at = ? WHERE user_id = ? AND expires_at < ?",
+                       (expires_at, user_id, expires_at))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("Database error extending resume tokens of user %s: %s", user_id, e)
+        if conn: conn.rollback()
+    finally:
+        if conn:
+            release_connection(conn)
+
+@_timed
+def delete_resume_tokens(user_id):
+    """Revokes every resume token of the user (explicit logout)."""
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM resume_tokens WHERE user_id = ?", (user_id,))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error("Database error deleting resume tokens of user %s: %s", user_id, e)
+        if conn: conn.rollback()
+    finally:
+        if conn:
+            release_connection(conn)
+
+def _prune_resume_state(conn, max_age):
+    """Deletes expired tokens and events older than max_age, at most once per RESUME_STATE_PRUNE_INTERVAL.
+
+    No unexpired token can be older than max_age (the token lifetime), so no
+    RESUME can still need those events.
+    """
+    global _last_resume_state_prune
+    now = time.time()
+    if now - _last_resume_state_prune < RESUME_STATE_PRUNE_INTERVAL:
+        return
+    _last_resume_state_prune = now
+    try:
+        conn.execute("DELETE FROM resume_tokens WHERE expires_at <= ?", (int(now),))
+        conn.execute("DELETE FROM server_events WHERE created_at < ?", (int(now - max_age),))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning("Could not prune resume tokens and server events: %s", e)
+        conn.rollback()
+
+# --- Schema migrations ---
+# Tables are created by initialize_database; everything added afterwards is a
+# numbered migration. PRAGMA user_version stores the last version applied, so each
+# migration runs exactly once per database file, inside its own transaction.
+SCHEMA_MIGRATIONS = [
+    (1, "Secondary indexes for per-server history, membership and challenge lookups", [
+        # Keyset history pages: WHERE server_id = ? AND message_id < ? ORDER BY message_id
+        "CREATE INDEX IF NOT EXISTS idx_messages_server_message ON messages(server_id, message_id)",
+        # Member lists and admin succession (ORDER BY joined_at); user_id makes it covering
+        "CREATE INDEX IF NOT EXISTS idx_memberships_server_joined ON memberships(server_id, joined_at, user_id)",
+        # Active challenge checks: WHERE server_id = ? AND status IN (...)
+        "CREATE INDEX IF NOT EXISTS idx_challenges_server_status ON challenges(server_id, status)",
+    ]),
+    (2, "Lock the SYSTEM and CHALLENGE_NOTICE accounts (their old placeholder password was a plaintext login)", [
+        f"UPDATE users SET password = '{passwords.UNUSABLE_PASSWORD}' WHERE user_id IN ({SUPER_USER_ID}, {CHALLENGE_USER_ID})",
+    ]),
+    (3, "Resume tokens and the server event log replayed by RESUME", [
+        """CREATE TABLE IF NOT EXISTS resume_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_resume_tokens_user ON resume_tokens(user_id)",
+        """CREATE TABLE IF NOT EXISTS server_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            user_id INTEGER,
+            username TEXT,
+            after_message_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )""",
+        # RESUME: WHERE server_id = ? AND after_message_id >= ?
+        "CREATE INDEX IF NOT EXISTS idx_server_events_server_after ON server_events(server_id, after_message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_server_events_created ON server_events(created_at)",
+    ]),
+]
+# users.username and memberships(user_id, server_id) are already indexed by their UNIQUE constraints.
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn):
+    """Applies every migration newer than the database's user_version. Returns the resulting version."""
+    current_version = get_schema_version(conn)
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        current_version = version
+        logger.info("Applied schema migration %s: %s", version, description)
+    return current_version
+
+# Hot queries and the index each one must use; see check_query_plans()
+HOT_QUERY_PLANS = [
+    ("history page",
+     "SELECT m.message_id FROM messages m JOIN users u ON m.user_id = u.user_id "
+     "WHERE m.server_id = ? AND m.message_id < ? ORDER BY m.message_id DESC LIMIT ?",
+     (1, 1, 1), "idx_messages_server_message"),
+    ("server members",
+     "SELECT u.user_id, u.username FROM users u JOIN memberships m ON u.user_id = m.user_id "
+     "WHERE m.server_id = ? ORDER BY u.username ASC",
+     (1,), "idx_memberships_server_joined"),
+    ("admin succession",
+     "SELECT u.user_id, u.username FROM memberships m JOIN users u ON m.user_id = u.user_id "
+     "WHERE m.server_id = ? ORDER BY m.joined_at ASC, m.membership_id ASC LIMIT 1",
+     (1,), "idx_memberships_server_joined"),
+    ("active challenge",
+     "SELECT challenge_id FROM challenges WHERE server_id = ? AND status IN ('pending', 'accepted', 'in_progress')",
+     (1,), "idx_challenges_server_status"),
+    ("bootstrap history",
+     "SELECT m.message_id FROM memberships my JOIN messages m ON m.server_id = my.server_id "
+     "WHERE my.user_id = ? AND m.message_id IN (SELECT recent.message_id FROM messages recent "
+     "WHERE recent.server_id = my.server_id ORDER BY recent.message_id DESC LIMIT ?)",
+     (1, 1), "idx_messages_server_message"),
+    ("user by name",
+     "SELECT user_id FROM users WHERE username = ?",
+     ("x",), "sqlite_autoindex_users_1"),
+    ("resume events",
+     "SELECT e.event_id FROM server_events e WHERE e.server_id = ? AND e.after_message_id >= ? ORDER BY e.event_id",
+     (1, 1), "idx_server_events_server_after"),
+    ("membership check",
+     "SELECT 1 FROM memberships WHERE user_id = ? AND server_id = ? LIMIT 1",
+     (1, 1), "sqlite_autoindex_memberships_1"),
+]
+
+def check_query_plans(conn=None):
+    """Runs EXPLAIN QUERY PLAN on the hot queries and returns a list of problems (empty if all use their index)."""
+    own_connection = conn is None
+    if own_connection:
+        conn = get_connection()
+    problems = []
+    try:
+        for name, query, params, index_name in HOT_QUERY_PLANS:
+            plan = " | ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params))
+            if index_name not in plan:
+                problems.append(f"{name}: expected {index_name}, got plan '{plan}'")
+    finally:
+        if own_connection:
+            release_connection(conn)
+    return problems
+
 def initialize_database():
     """Connects to the SQLite database and creates tables and system user if they don't exist."""
     conn = None
     try:
         conn = sqlite3.connect(DATABASE_FILE)
         cursor = conn.cursor()
-        print("Database connection established.")
+        logger.debug("Database connection established.")
         cursor.execute("PRAGMA foreign_keys = ON;")
 
         # ... (your existing table creation statements for users, servers, memberships, messages, challenges) ...
 
         # Create the SYSTEM user (superuser)
-        # Generate a dummy hash; this user should not be able to log in normally.
-        dummy_password = "cannot_login_system_user_!@#$%^"
+        # Its password never matches; this user should not be able to log in.
+        dummy_password = passwords.UNUSABLE_PASSWORD
         current_time = int(time.time())
 
         # Create users table
@@ -751,7 +1519,7 @@ def initialize_database():
             created_at INTEGER NOT NULL
         );
         """)
-        print("Checked/Created 'users' table.")
+        logger.debug("Checked/Created 'users' table.")
 
         # Create servers table
         cursor.execute("""
@@ -764,7 +1532,7 @@ def initialize_database():
             FOREIGN KEY (admin_user_id) REFERENCES users(user_id) ON DELETE CASCADE
         );
         """)
-        print("Checked/Created 'servers' table.")
+        logger.debug("Checked/Created 'servers' table.")
 
         # Create memberships table
         cursor.execute("""
@@ -778,7 +1546,7 @@ def initialize_database():
             UNIQUE(user_id, server_id)
         );
         """)
-        print("Checked/Created 'memberships' table.")
+        logger.debug("Checked/Created 'memberships' table.")
 
         # Create messages table
         cursor.execute("""
@@ -792,7 +1560,7 @@ def initialize_database():
             FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE SET NULL
         );
         """)
-        print("Checked/Created 'messages' table.")
+        logger.debug("Checked/Created 'messages' table.")
 
         # Create challenges table
         cursor.execute("""
@@ -811,7 +1579,7 @@ def initialize_database():
             FOREIGN KEY (winner_user_id) REFERENCES users(user_id) ON DELETE SET NULL -- If winner deleted, just remove winner ref
         );
         """)
-        print("Checked/Created 'challenges' table.")
+        logger.debug("Checked/Created 'challenges' table.")
 
 
         # Create challenge_participants table
@@ -826,7 +1594,7 @@ def initialize_database():
             UNIQUE(challenge_id, user_id) -- A user can only join a specific challenge once
         );
         """)
-        print("Checked/Created 'challenge_participants' table.")
+        logger.debug("Checked/Created 'challenge_participants' table.")
 
 
         conn.commit() # Save the changes (table creations)
@@ -840,12 +1608,17 @@ def initialize_database():
         """, (CHALLENGE_USER_ID, CHALLENGE_USER_USERNAME, dummy_password, current_time))
 
         conn.commit()
-        print("Database initialized successfully (including SYSTEM and CHALLENGE user check).")
+
+        schema_version = run_migrations(conn)
+        if logger.isEnabledFor(logging.DEBUG): # Enforced by tests/test_query_plans.py
+            for problem in check_query_plans(conn):
+                logger.debug("Query plan check failed - %s", problem)
+        logger.info("Database initialized successfully (including SYSTEM and CHALLENGE user check, schema version %s).", schema_version)
 
 
     except sqlite3.Error as e:
-        print(f"Database error during initialization: {e}")
+        logger.error("Database error during initialization: %s", e)
     finally:
         if conn:
             conn.close()
-            print("Database connection closed after initialization.")
\ No newline at end of file
+            logger.debug("Database connection closed after initialization.")
\ No newline at end of file
@@ -0,0 +1,521 @@
+# MESSAGE_BUS.PY
+# Pub/sub between chat server nodes, so a message for a user connected to
+# another node still reaches them (see server.handle_bus_message). A node is one
+# server process: a worker of server.py --workers, or a separate server.py
+# instance behind a load balancer. Three interchangeable implementations:
+#   InProcessBus  - nodes in one process (the default for a single server, and handy for experiments)
+#   UnixSocketBus - worker processes on one machine, through a BusBroker run by the main process
+#   RedisBus      - any number of machines, through Redis PUBLISH/SUBSCRIBE (or anything speaking RESP)
+#
+# Messages are dicts. publish() hands a message to every other node, never back
+# to the sender, and stamps it with the sender's "node" id. Every bus announces
+# its node with {"kind": "node_started"} and tells the others
+# {"kind": "node_gone", "node": id} when a node disconnects or stops answering.
+import abc
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+
+import protocol
+
+logger = logging.getLogger("chat.message_bus")
+
+BUS_CODEC = protocol.choose_codec(protocol.available_codec_names()) # Both ends import this module, so they always agree
+BUS_LISTEN_BACKLOG = 64
+BUS_HEARTBEAT_INTERVAL = 5.0 # RedisBus: seconds between "still here" messages...
+BUS_HEARTBEAT_MISSES = 3 # ...and how many may be missed before a node counts as gone
+
+REDIS_ADDRESS = "localhost:6379"
+REDIS_CHANNEL = "chat:bus"
+REDIS_TIMEOUT = 5.0 # Seconds to connect or wait for a command reply
+
+
+def encode_message(message):
+    return protocol.encode_frame(message, BUS_CODEC)
+
+
+class MessageBus(abc.ABC):
+    """Interface shared by the bus implementations."""
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.published = 0
+        self.received = 0
+
+    @abc.abstractmethod
+    def start(self, on_message, on_disconnect=None):
+        """Connects and starts passing other nodes' messages to on_message(message).
+
+        on_message runs on a bus thread and must not block. on_disconnect() is
+        called if the connection to the other nodes is lost for good.
+        """
+
+    @abc.abstractmethod
+    def publish(self, message):
+        """Sends message (a dict) to every other node. Never blocks."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Sends what is still queued, then disconnects."""
+
+
+# --- In-process ---
+
+class InProcessHub:
+    """Connects the InProcessBus instances that share it."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buses = []
+
+    def join(self, bus):
+        with self._lock:
+            self._buses.append(bus)
+
+    def leave(self, bus):
+        with self._lock:
+            if bus in self._buses:
+                self._buses.remove(bus)
+            peers = list(self._buses)
+        for peer in peers:
+            peer._inbox.put({"kind": "node_gone", "node": bus.node_id})
+
+    def peers(self, bus):
+        with self._lock:
+            return [peer for peer in self._buses if peer is not bus]
+
+
+class InProcessBus(MessageBus):
+    """Bus between nodes living in the same process. Alone on its hub, publishing costs nothing."""
+    _STOP = object()
+
+    def __init__(self, node_id=None, hub=None):
+        super().__init__(node_id)
+        self.hub = hub or InProcessHub()
+        self._inbox = queue.SimpleQueue()
+        self._dispatcher = None
+
+    def start(self, on_message, on_disconnect=None):
+        self._dispatcher = threading.Thread(target=self._dispatch, args=(on_message,), name="bus-dispatch", daemon=True)
+        self._dispatcher.start()
+        self.hub.join(self)
+        self.publish({"kind": "node_started"})
+        return self
+
+    def publish(self, message):
+        peers = self.hub.peers(self)
+        if not peers:
+            return
+        message["node"] = self.node_id
+        for peer in peers: # Delivered by each peer's own thread, like a message from a socket
+            peer._inbox.put(message)
+        self.published += 1
+
+    def close(self):
+        if self._dispatcher is None:
+            return
+        self.hub.leave(self)
+        self._inbox.put(self._STOP)
+        self._dispatcher.join()
+        self._dispatcher = None
+
+    def _dispatch(self, on_message):
+        while True:
+            message = self._inbox.get()
+            if message is self._STOP:
+                return
+            self.received += 1
+            try:
+                on_message(message)
+            except Exception:
+                logger.exception("Error handling bus message of kind %s", message.get("kind"))
+
+
+# --- Unix domain socket broker ---
+
+class BusBroker:
+    """Relays every frame a worker publishes to all other connected workers.
+
+    Call listen() before forking the workers (so they can connect right away),
+    close_in_child() in each forked worker, and start() in the main process.
+    A worker's first message (node_started) names it, so the broker can send
+    node_gone when its connection closes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._listener = None
+        self._lock = threading.Lock()
+        self._connections = {} # socket -> lock serializing writes to it
+        self._closed = False
+        self.frames_relayed = 0
+
+    def listen(self):
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(BUS_LISTEN_BACKLOG)
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, name="bus-broker", daemon=True).start()
+
+    def close_in_child(self):
+        """Drops the broker's sockets that a forked worker inherited; only the main process may use them."""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for sock in [self._listener] + connections:
+            if sock is not None:
+                sock.close()
+        self._listener = None
+
+    def close(self):
+        self._closed = True
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError: # Listener closed
+                return
+            with self._lock:
+                self._connections[conn] = threading.Lock()
+            threading.Thread(target=self._relay, args=(conn,), name="bus-relay", daemon=True).start()
+
+    def _relay(self, conn):
+        reader = protocol.FrameReader(conn)
+        node = None
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                body, _ = frame
+                if node is None: # First message names the node
+                    node = BUS_CODEC.decode(body).get("node")
+                    logger.info("Worker %s connected to the bus.", node)
+                self._forward(conn, struct.pack(protocol.MSG_LENGTH_PREFIX_FORMAT, len(body)) + body)
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                logger.warning("Bus connection of worker %s failed: %s", node, e)
+        finally:
+            with self._lock:
+                self._connections.pop(conn, None)
+            conn.close()
+        if not self._closed:
+            logger.info("Worker %s disconnected from the bus.", node)
+            if node is not None:
+                self._forward(None, encode_message({"kind": "node_gone", "node": node}))
+
+    def _forward(self, source, frame):
+        with self._lock:
+            targets = [(conn, send_lock) for conn, send_lock in self._connections.items() if conn is not source]
+        for conn, send_lock in targets:
+            try:
+                with send_lock:
+                    conn.sendall(frame)
+            except OSError as e:
+                logger.warning("Dropping bus connection after send failure: %s", e)
+                with self._lock:
+                    self._connections.pop(conn, None)
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.frames_relayed += 1
+
+
+class UnixSocketBus(MessageBus):
+    """A worker's connection to the BusBroker.
+
+    publish() only queues the message; a writer thread sends it, so request
+    threads (and the bus reader itself) never wait on the broker.
+    """
+    _STOP = object()
+
+    def __init__(self, path, node_id):
+        super().__init__(node_id)
+        self.path = path
+        self._sock = None
+        self._outbound = queue.SimpleQueue()
+        self._closing = False
+        self._writer = None
+
+    def start(self, on_message, on_disconnect=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        self.publish({"kind": "node_started"})
+        self._writer = threading.Thread(target=self._write_loop, name="bus-writer", daemon=True)
+        self._writer.start()
+        threading.Thread(target=self._read_loop, args=(on_message, on_disconnect), name="bus-reader", daemon=True).start()
+        return self
+
+    def publish(self, message):
+        message["node"] = self.node_id
+        self._outbound.put(encode_message(message))
+        self.published += 1
+
+    def close(self):
+        if self._sock is None or self._closing:
+            return
+        self._closing = True
+        self._outbound.put(self._STOP)
+        self._writer.join()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def _write_loop(self):
+        while True:
+            frame = self._outbound.get()
+            if frame is self._STOP:
+                return
+            try:
+                self._sock.sendall(frame)
+            except OSError as e:
+                if not self._closing:
+                    logger.error("Could not publish to the bus: %s", e)
+                return
+
+    def _read_loop(self, on_message, on_disconnect):
+        reader = protocol.FrameReader(self._sock)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                body, _ = frame
+                message = BUS_CODEC.decode(body)
+                self.received += 1
+                try:
+                    on_message(message)
+                except Exception:
+                    logger.exception("Error handling bus message of kind %s", message.get("kind"))
+        except (OSError, ValueError) as e:
+            if not self._closing:
+                logger.error("Bus connection failed: %s", e)
+        if not self._closing:
+            logger.error("Lost the connection to the bus.")
+            if on_disconnect is not None:
+                on_disconnect()
+
+
+# --- Redis (RESP) ---
+
+class RespError(Exception):
+    """An error reply from the server, or a reply that isn't valid RESP."""
+
+
+def parse_address(address):
+    """"host:port" -> (host, port); the port defaults to 6379."""
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, 6379
+    return host, int(port)
+
+
+class RespConnection:
+    """Minimal blocking client for the Redis protocol (RESP2); enough for PUBLISH/SUBSCRIBE and SET/GET/DEL/EXPIRE.
+
+    Works with Redis, its forks, or any local stand-in that speaks RESP.
+    Thread-safe: each command (or pipeline) holds the connection until its replies are read.
+    """
+    def __init__(self, address=REDIS_ADDRESS, timeout=REDIS_TIMEOUT):
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    def connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        return self
+
+    @staticmethod
+    def encode_command(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode("utf-8")
+            elif isinstance(arg, int):
+                arg = str(arg).encode("ascii")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def command(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """Sends every command in one write, then reads the replies in order. Error replies are returned, not raised."""
+        with self._lock:
+            if self._sock is None:
+                self.connect()
+            try:
+                self._sock.sendall(b"".join(self.encode_command(args) for args in commands))
+                return [self.read_reply() for _ in commands]
+            except (OSError, RespError):
+                self.close() # Reconnect on next use; the stream can't be trusted any more
+                raise
+
+    def send(self, *args):
+        """Sends a command without waiting for the reply (for subscriber connections)."""
+        self._sock.sendall(self.encode_command(args))
+
+    def read_reply(self):
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the Redis server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            return RespError(rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by the Redis server")
+            return data[:-2]
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self.read_reply() for _ in range(count)]
+        raise RespError(f"Unexpected reply type {kind!r}")
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._file = None
+
+
+class RedisBus(MessageBus):
+    """Bus through one Redis pub/sub channel, so nodes on different machines can reach each other.
+
+    Redis does not tell subscribers when a publisher dies, so every node
+    publishes a heartbeat and a node that misses BUS_HEARTBEAT_MISSES of them
+    is reported as node_gone.
+    """
+    _STOP = object()
+
+    def __init__(self, node_id, address=REDIS_ADDRESS, channel=REDIS_CHANNEL):
+        super().__init__(node_id)
+        self.address = address
+        self.channel = channel
+        self._publisher = RespConnection(address)
+        self._subscriber = RespConnection(address, timeout=None) # Blocks in SUBSCRIBE until a message arrives
+        self._outbound = queue.SimpleQueue()
+        self._closing = False
+        self._writer = None
+        self._peers_lock = threading.Lock()
+        self._peers_seen = {} # node id -> monotonic time of its last message
+
+    def start(self, on_message, on_disconnect=None):
+        self._publisher.connect()
+        self._subscriber.connect()
+        self._subscriber.send("SUBSCRIBE", self.channel)
+        reply = self._subscriber.read_reply()
+        if not isinstance(reply, list) or reply[0] != b"subscribe":
+            raise RespError(f"SUBSCRIBE {self.channel} failed: {reply}")
+        self._writer = threading.Thread(target=self._write_loop, args=(on_message,), name="bus-writer", daemon=True)
+        self._writer.start()
+        threading.Thread(target=self._read_loop, args=(on_message, on_disconnect), name="bus-reader", daemon=True).start()
+        self.publish({"kind": "node_started"})
+        return self
+
+    def publish(self, message):
+        message["node"] = self.node_id
+        self._outbound.put(BUS_CODEC.encode(message))
+        self.published += 1
+
+    def close(self):
+        if self._writer is None or self._closing:
+            return
+        self._closing = True
+        self._outbound.put(self._STOP)
+        self._writer.join()
+        self._publisher.close()
+        try:
+            self._subscriber._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self, on_message):
+        next_heartbeat = time.monotonic()
+        while True:
+            try:
+                body = self._outbound.get(timeout=max(next_heartbeat - time.monotonic(), 0))
+            except queue.Empty:
+                body = None
+            if body is self._STOP:
+                return
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                next_heartbeat = now + BUS_HEARTBEAT_INTERVAL
+                self._publish_body(BUS_CODEC.encode({"kind": "node_alive", "node": self.node_id}))
+                for node in self._expired_peers(now):
+                    on_message({"kind": "node_gone", "node": node})
+            if body is not None:
+                self._publish_body(body)
+
+    def _publish_body(self, body):
+        try:
+            reply = self._publisher.command("PUBLISH", self.channel, body)
+            if isinstance(reply, RespError):
+                logger.error("PUBLISH to %s failed: %s", self.channel, reply)
+        except OSError as e:
+            if not self._closing:
+                logger.error("Could not publish to Redis at %s: %s", self.address, e)
+
+    def _expired_peers(self, now):
+        deadline = now - BUS_HEARTBEAT_INTERVAL * BUS_HEARTBEAT_MISSES
+        with self._peers_lock:
+            expired = [node for node, seen in self._peers_seen.items() if seen < deadline]
+            for node in expired:
+                del self._peers_seen[node]
+        return expired
+
+    def _read_loop(self, on_message, on_disconnect):
+        try:
+            while True:
+                reply = self._subscriber.read_reply()
+                if not isinstance(reply, list) or len(reply) != 3 or reply[0] != b"message":
+                    continue # Subscription confirmations and the like
+                message = BUS_CODEC.decode(reply[2])
+                node = message.get("node")
+                if node == self.node_id:
+                    continue # Redis echoes our own messages back
+                with self._peers_lock:
+                    self._peers_seen[node] = time.monotonic()
+                if message.get("kind") == "node_alive":
+                    continue
+                self.received += 1
+                try:
+                    on_message(message)
+                except Exception:
+                    logger.exception("Error handling bus message of kind %s", message.get("kind"))
+        except (OSError, ValueError) as e:
+            if not self._closing:
+                logger.error("Redis subscription failed: %s", e)
+        if not self._closing:
+            logger.error("Lost the connection to Redis at %s.", self.address)
+            if on_disconnect is not None:
+                on_disconnect()
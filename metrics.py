@@ -0,0 +1,298 @@
+# METRICS.PY
+# Counters, gauges and latency histograms for the chat server, served in the
+# Prometheus text format (version 0.0.4) over HTTP by a thread of its own.
+# Metrics are registered once at import time by the module they describe and
+# updated in place; a labelled metric hands out one child per label values, so
+# hot paths can bind theirs up front. Numbers that other objects already count
+# (RateLimiter.rejected, AdmissionControl, queue depths, ...) are exported with
+# callback() and read only when the endpoint is scraped. Everything is in
+# memory and per process: with --workers every worker serves its own port.
+import abc
+import bisect
+import functools
+import http.server
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger("chat.metrics")
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; from 0.1 ms (cached reads) up to 10 s (a request stuck behind a slow disk)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._unlabelled = self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """The child for one combination of label values, created on first use."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """A child holding the values of one combination of label values."""
+
+    def samples(self):
+        """Lines of the text format for this metric, without HELP/TYPE."""
+        lines = []
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    """Only goes up. Name it *_total."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("_lock", "buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labelnames, values, [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {count}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. seconds) into cumulative le buckets, plus their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+
+class Callback(_Metric):
+    """A counter or gauge whose value is read from function() at scrape time.
+
+    function returns a number, or {label values tuple: number} for a labelled metric.
+    """
+    def __init__(self, name, help_text, kind, function, labelnames=()):
+        self.kind = kind
+        self.function = function
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return None
+
+    def samples(self, name=None, labelnames=None, values=None):
+        result = self.function()
+        if not self.labelnames:
+            result = {(): result}
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+                for values, value in sorted(result.items())]
+
+
+class Registry:
+    """Every metric of this process, by name. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """Adds metric; if one of the same name and kind exists already (module imported twice), returns that one."""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind:
+                    raise ValueError(f"Metric {metric.name} is already registered as a {existing.kind}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e: # A broken callback must not take the whole page down
+                logger.warning("Could not collect %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=()):
+    return REGISTRY.register(Gauge(name, help_text, labelnames))
+
+
+def histogram(name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+def callback(name, help_text, function, kind="gauge", labelnames=()):
+    return REGISTRY.register(Callback(name, help_text, kind, function, labelnames))
+
+
+def timed(histogram_metric):
+    """Decorator: records the duration of every call in histogram_metric, labelled with the function's name."""
+    def decorate(function):
+        observe = histogram_metric.labels(function.__name__).observe
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MetricsServer(threading.Thread):
+    """Serves GET /metrics on (host, port) until stop(). Scrapes are answered one at a time."""
+    def __init__(self, host, port, registry=REGISTRY):
+        super().__init__(name="metrics-http", daemon=True)
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+        self.httpd = http.server.HTTPServer((host, port), handler)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
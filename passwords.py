@@ -0,0 +1,145 @@
+# PASSWORDS.PY
+# Password hashing for the chat server.
+# Passwords are stored as "scrypt$<n>$<r>$<p>$<salt>$<hash>" with a random salt
+# per user (base64 salt and hash), or as "pbkdf2_sha256$<iterations>$<salt>$<hash>"
+# where Python's OpenSSL lacks scrypt. Rows written before hashing was added
+# hold the plaintext password: verify_password still accepts those and returns
+# a hash to store in their place, so each one is upgraded on the user's next
+# login. Hashing is slow on purpose, so the server runs it on a PasswordHasher:
+# a small pool of worker processes at lower CPU priority, which keeps a login
+# storm from holding the GIL (and the CPU) against chat traffic.
+# Resume tokens (RESUME) are random, so a plain SHA-256 of the token is enough
+# to keep them unusable if the database leaks; they need no slow hashing.
+import base64
+import binascii
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import secrets
+
+logger = logging.getLogger("chat.passwords")
+
+SCRYPT_N = 2 ** 14 # CPU/memory cost; 16 MiB of memory per hash with r=8
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000 # Fallback where hashlib.scrypt is unavailable
+SALT_BYTES = 16
+RESUME_TOKEN_BYTES = 32
+HASH_BYTES = 32
+UNUSABLE_PASSWORD = "!" # Stored for accounts nobody may log in as (SYSTEM, CHALLENGE_NOTICE)
+PASSWORD_HASH_WORKERS = os.cpu_count() or 1 # Processes in the server's PasswordHasher; 0 hashes on the calling thread
+PASSWORD_WORKER_NICE = 10 # Added to the workers' nice value so chat traffic wins the CPU
+
+_DUMMY_SALT = bytes(SALT_BYTES) # Only for the decoy hash computed for unknown users
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def hash_password(password, salt=None):
+    """Returns the string to store for password, with a fresh random salt."""
+    salt = salt or secrets.token_bytes(SALT_BYTES)
+    secret = password.encode("utf-8")
+    if hasattr(hashlib, "scrypt"):
+        digest = hashlib.scrypt(secret, salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=HASH_BYTES)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", secret, salt, PBKDF2_ITERATIONS, HASH_BYTES)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def needs_rehash(stored):
+    """True unless stored is a hash made with the current scheme and parameters."""
+    if hasattr(hashlib, "scrypt"):
+        return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+    return not stored.startswith(f"pbkdf2_sha256${PBKDF2_ITERATIONS}$")
+
+
+def verify_password(password, stored):
+    """Checks password against a stored value. Returns (matched, upgraded_hash).
+
+    upgraded_hash is the value to store instead when the password matched a
+    plaintext row or a hash with outdated parameters, otherwise None. For an
+    unknown user pass stored=None: a decoy hash is computed anyway, so the
+    response time does not reveal which usernames exist.
+    """
+    if stored is None:
+        hash_password(password, _DUMMY_SALT)
+        return False, None
+    if stored == UNUSABLE_PASSWORD:
+        return False, None
+    secret = password.encode("utf-8")
+    scheme, _, fields = stored.partition("$")
+    try:
+        if scheme == "scrypt":
+            n, r, p, salt, expected = fields.split("$")
+            expected = base64.b64decode(expected)
+            digest = hashlib.scrypt(secret, salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                                    dklen=len(expected), maxmem=256 * int(r) * int(n))
+        elif scheme == "pbkdf2_sha256":
+            iterations, salt, expected = fields.split("$")
+            expected = base64.b64decode(expected)
+            digest = hashlib.pbkdf2_hmac("sha256", secret, base64.b64decode(salt), int(iterations), len(expected))
+        else: # Plaintext row from before hashing
+            matched = hmac.compare_digest(stored.encode("utf-8"), secret)
+            return matched, hash_password(password) if matched else None
+    except (ValueError, binascii.Error) as e:
+        logger.error("Unreadable %s password hash: %s", scheme, e)
+        return False, None
+    matched = hmac.compare_digest(digest, expected)
+    return matched, hash_password(password) if matched and needs_rehash(stored) else None
+
+
+def new_resume_token():
+    """Returns (token, token_hash): the token goes to the client, only the hash is stored."""
+    token = secrets.token_urlsafe(RESUME_TOKEN_BYTES)
+    return token, hash_resume_token(token)
+
+
+def hash_resume_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _lower_priority():
+    if hasattr(os, "nice"):
+        os.nice(PASSWORD_WORKER_NICE)
+
+
+class PasswordHasher:
+    """Runs hash_password/verify_password in worker processes; the calling thread just waits.
+
+    The workers come from a forkserver (spawn where unavailable), never from a
+    plain fork of the multi-threaded server. With workers=0, or if the pool
+    breaks, hashing runs on the calling thread.
+    """
+    def __init__(self, workers=PASSWORD_HASH_WORKERS):
+        self.workers = workers
+        self._pool = None
+        if workers > 0:
+            start_methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+            self._pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_lower_priority)
+
+    def hash(self, password):
+        return self._run(hash_password, password)
+
+    def verify(self, password, stored):
+        return self._run(verify_password, password, stored)
+
+    def _run(self, function, *args):
+        pool = self._pool
+        if pool is not None:
+            try:
+                return pool.submit(function, *args).result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                logger.error("Password hashing pool failed (%s); hashing on server threads from now on.", e)
+                self._pool = None
+        return function(*args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
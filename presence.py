@@ -0,0 +1,286 @@
+# PRESENCE.PY
+# Server-scoped presence for the chat server.
+# PresenceRoster tracks which online users belong to which chat servers, so a
+# user's online/offline change only goes to users who share at least one server
+# with them. PresenceCoalescer batches those changes: an isolated change is sent
+# right away as USER_JOINED/USER_LEFT, while changes that arrive during a burst
+# (e.g. a reconnect storm) are merged into one PRESENCE_DELTA per recipient.
+# PresenceRegistry records which node holds each user's session, so a second
+# login is refused wherever it arrives; RedisPresenceRegistry shares that
+# record between server instances.
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import message_bus
+
+logger = logging.getLogger("chat.presence")
+
+PRESENCE_COALESCE_WINDOW_MS = 250 # Minimum gap between two presence flushes; changes in between are batched
+PRESENCE_REGISTRY_TTL = 30 # Seconds a Redis claim lives unless its node refreshes it (a crashed node's users are freed after this)
+PRESENCE_REGISTRY_KEY_PREFIX = "chat:presence:"
+# Deletes a claim only if it is still this node's, in one step: between a separate
+# GET and DEL the key could expire and be claimed by a newer session elsewhere
+PRESENCE_RELEASE_SCRIPT = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0"
+
+
+class PresenceRoster:
+    """server_id -> online user_ids, and online user_id -> server_ids. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._online_by_server = defaultdict(set)
+        self._servers_by_user = {}
+
+    def user_online(self, user_id, server_ids):
+        with self._lock:
+            server_ids = set(server_ids)
+            self._servers_by_user[user_id] = server_ids
+            for server_id in server_ids:
+                self._online_by_server[server_id].add(user_id)
+
+    def user_offline(self, user_id):
+        """Removes the user everywhere and returns the servers they were online in."""
+        with self._lock:
+            server_ids = self._servers_by_user.pop(user_id, set())
+            for server_id in server_ids:
+                self._discard(server_id, user_id)
+            return server_ids
+
+    def add_membership(self, user_id, server_id):
+        """Call after a user joins/creates a server; a no-op for offline users."""
+        with self._lock:
+            server_ids = self._servers_by_user.get(user_id)
+            if server_ids is not None:
+                server_ids.add(server_id)
+                self._online_by_server[server_id].add(user_id)
+
+    def remove_membership(self, user_id, server_id):
+        with self._lock:
+            server_ids = self._servers_by_user.get(user_id)
+            if server_ids is not None:
+                server_ids.discard(server_id)
+            self._discard(server_id, user_id)
+
+    def remove_server(self, server_id):
+        """Call after a server is deleted."""
+        with self._lock:
+            for user_id in self._online_by_server.pop(server_id, ()):
+                self._servers_by_user.get(user_id, set()).discard(server_id)
+
+    def _discard(self, server_id, user_id):
+        online = self._online_by_server.get(server_id)
+        if online is not None:
+            online.discard(user_id)
+            if not online:
+                del self._online_by_server[server_id]
+
+    def online_members(self, server_id):
+        with self._lock:
+            return set(self._online_by_server.get(server_id, ()))
+
+    def online_users(self):
+        """{user_id: server_ids} for every online user."""
+        with self._lock:
+            return {user_id: set(server_ids) for user_id, server_ids in self._servers_by_user.items()}
+
+    def audience(self, user_id, server_ids):
+        """Online users, other than user_id, who are in any of server_ids."""
+        with self._lock:
+            recipients = set()
+            for server_id in server_ids:
+                recipients.update(self._online_by_server.get(server_id, ()))
+        recipients.discard(user_id)
+        return recipients
+
+
+class PresenceEvent:
+    __slots__ = ("user_id", "username", "online", "server_ids", "timestamp")
+
+    def __init__(self, user_id, username, online, server_ids):
+        self.user_id = user_id
+        self.username = username
+        self.online = online
+        self.server_ids = frozenset(server_ids) # Servers at the time of the change (already gone from the roster for a logout)
+        self.timestamp = int(time.time())
+
+
+class PresenceCoalescer(threading.Thread):
+    """Delivers presence changes through deliver(user_ids, data_dict), batching bursts.
+
+    deliver is expected to encode the message once and queue it for every user
+    in user_ids (server.send_frame_to_users).
+    """
+    def __init__(self, roster, deliver, window_ms=None):
+        super().__init__(name="presence-coalescer", daemon=True)
+        self.roster = roster
+        self.deliver = deliver
+        self.window = (PRESENCE_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._stopped = False
+        self._last_flush = 0.0
+        self.events_published = 0
+        self.frames_sent = 0
+
+    def publish(self, user_id, username, online, server_ids):
+        event = PresenceEvent(user_id, username, online, server_ids)
+        self.events_published += 1
+        if not self.is_alive(): # Not started (or already stopped): deliver inline
+            self._flush([event])
+            return
+        with self._cond:
+            self._pending.append(event)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._pending:
+                    return
+            # Leading edge goes out at once; anything within the window waits for the next flush
+            delay = self._last_flush + self.window - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                events, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+            try:
+                self._flush(events)
+            except Exception as e:
+                logger.error("Error delivering %s presence changes: %s", len(events), e)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def _flush(self, events):
+        # Latest change per user wins
+        latest = {}
+        for event in events:
+            latest[event.user_id] = event
+        events = list(latest.values())
+
+        if len(events) == 1:
+            event = events[0]
+            recipients = self.roster.audience(event.user_id, event.server_ids)
+            if recipients:
+                self.deliver(recipients, {
+                    "type": "USER_JOINED" if event.online else "USER_LEFT",
+                    "payload": {"username": event.username, "user_id": event.user_id, "timestamp": event.timestamp}
+                })
+                self.frames_sent += 1
+            return
+
+        # Recipients that should see exactly the same set of changes share one encoded frame
+        changes_by_recipient = defaultdict(list)
+        for index, event in enumerate(events):
+            for recipient in self.roster.audience(event.user_id, event.server_ids):
+                changes_by_recipient[recipient].append(index)
+        recipients_by_changes = defaultdict(list)
+        for recipient, indexes in changes_by_recipient.items():
+            recipients_by_changes[tuple(indexes)].append(recipient)
+
+        now = int(time.time())
+        for indexes, recipients in recipients_by_changes.items():
+            joined = [{"user_id": events[i].user_id, "username": events[i].username} for i in indexes if events[i].online]
+            left = [{"user_id": events[i].user_id, "username": events[i].username} for i in indexes if not events[i].online]
+            self.deliver(recipients, {
+                "type": "PRESENCE_DELTA",
+                "payload": {"joined": joined, "left": left, "timestamp": now}
+            })
+            self.frames_sent += 1
+
+
+class PresenceRegistry:
+    """user_id -> id of the node holding the user's session, for this process only. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners = {}
+
+    def claim(self, user_id, node_id):
+        """Records that node_id holds user_id's session. False if another session already does."""
+        with self._lock:
+            if user_id in self._owners:
+                return False
+            self._owners[user_id] = node_id
+            return True
+
+    def release(self, user_id, node_id):
+        with self._lock:
+            if self._owners.get(user_id) == node_id:
+                del self._owners[user_id]
+
+    def close(self):
+        pass
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """Cluster-wide registry: one Redis key per online user, claimed with SET NX EX.
+
+    The claiming node refreshes its keys every ttl/3 seconds, so the sessions of
+    a node that dies without releasing them free up after at most ttl seconds.
+    """
+    def __init__(self, address=message_bus.REDIS_ADDRESS, ttl=PRESENCE_REGISTRY_TTL, key_prefix=PRESENCE_REGISTRY_KEY_PREFIX):
+        super().__init__()
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._redis = message_bus.RespConnection(address)
+        self._stopped = threading.Event()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="presence-refresh", daemon=True)
+        self._refresher.start()
+
+    def _key(self, user_id):
+        return f"{self.key_prefix}{user_id}"
+
+    def claim(self, user_id, node_id):
+        try:
+            claimed = self._redis.command("SET", self._key(user_id), str(node_id), "NX", "EX", self.ttl)
+        except OSError as e:
+            logger.error("Presence registry unavailable, refusing login of user %s: %s", user_id, e)
+            return False
+        if isinstance(claimed, message_bus.RespError):
+            logger.error("Presence registry error for user %s: %s", user_id, claimed)
+            return False
+        if claimed is None: # Key exists: a session somewhere already holds it
+            return False
+        with self._lock:
+            self._owners[user_id] = node_id
+        return True
+
+    def release(self, user_id, node_id):
+        with self._lock:
+            if self._owners.get(user_id) != node_id:
+                return
+            del self._owners[user_id]
+        try:
+            result = self._redis.command("EVAL", PRESENCE_RELEASE_SCRIPT, 1, self._key(user_id), str(node_id))
+            if isinstance(result, message_bus.RespError):
+                logger.warning("Could not release presence of user %s (it expires in %ss): %s", user_id, self.ttl, result)
+        except OSError as e:
+            logger.warning("Could not release presence of user %s (it expires in %ss): %s", user_id, self.ttl, e)
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.ttl / 3):
+            with self._lock:
+                user_ids = list(self._owners)
+            if not user_ids:
+                continue
+            try:
+                self._redis.pipeline([("EXPIRE", self._key(user_id), self.ttl) for user_id in user_ids])
+            except OSError as e:
+                logger.warning("Could not refresh %s presence claims: %s", len(user_ids), e)
+
+    def close(self):
+        """Stops refreshing and releases every claim this node still holds."""
+        self._stopped.set()
+        with self._lock:
+            owners = list(self._owners.items())
+        for user_id, node_id in owners:
+            self.release(user_id, node_id)
+        self._redis.close()
@@ -0,0 +1,397 @@
+# PROTOCOL.PY
+# Wire format shared by server.py, app.py and client.py.
+# Every message is one frame: a 4-byte big-endian length prefix followed by the
+# body. Bodies are JSON unless the client negotiates a binary codec with HELLO,
+# which must be its first request on the connection:
+#   -> {"action": "HELLO", "payload": {"codecs": ["msgpack", "cbor", "json"]}}
+#   <- {"action_response_to": "HELLO", "status": "success", "data": {"codec": "msgpack", "codecs": [...]}}
+# Both of these frames are JSON; every frame after the reply, in both directions,
+# uses the chosen codec. Clients that never send HELLO keep talking plain JSON.
+#
+# HELLO can also negotiate per-frame compression ("compression": ["zstd", "zlib"]
+# plus an optional shared "dictionary" id). A compressed frame has the high bit
+# of its length prefix set; frames below the size threshold, or that don't get
+# smaller, are sent raw, so both kinds are mixed freely on one connection.
+import collections
+import hashlib
+import heapq
+import json
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import msgpack # Optional: enables the "msgpack" codec
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2 # Optional: enables the "cbor" codec
+except ImportError:
+    cbor2 = None
+
+try:
+    import zstandard # Optional: enables "zstd" compression
+except ImportError:
+    zstandard = None
+
+MSG_LENGTH_PREFIX_FORMAT = '!I'  # Network byte order, Unsigned Integer (4 bytes)
+MSG_LENGTH_PREFIX_SIZE = struct.calcsize(MSG_LENGTH_PREFIX_FORMAT)
+MAX_FRAME_SIZE = 10 * 1024 * 1024 # Larger frames are refused to prevent memory exhaustion
+FRAME_COMPRESSED_FLAG = 0x80000000 # High bit of the length prefix: body is compressed
+FRAME_LENGTH_MASK = 0x7FFFFFFF
+
+FRAME_READER_BUFFER_SIZE = 32 * 1024 # Per connection; larger frames get a buffer of their own
+
+COMPRESSION_MIN_BYTES = 512 # Bodies smaller than this are sent raw
+COMPRESSION_MIN_BYTES_WITH_DICTIONARY = 128 # A shared dictionary makes small frames worth compressing
+COMPRESSION_ZLIB_LEVEL = 6
+COMPRESSION_ZSTD_LEVEL = 3
+COMPRESSION_DICT_SIZE = 16 * 1024 # Size train_dictionary() aims for; zlib only uses the last 32KB anyway
+
+
+class FrameDecodeError(ValueError):
+    """Raised when a frame body cannot be decompressed or decoded with the connection's settings."""
+
+
+class FrameTooLargeError(Exception):
+    """Raised by FrameReader for a length prefix above MAX_FRAME_SIZE; the stream can't be resynchronized."""
+
+
+class Codec:
+    """A named pair of encode (dict -> bytes) and decode (bytes-like -> dict) functions."""
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self._dumps = dumps
+        self._loads = loads
+
+    def encode(self, data_dict):
+        return self._dumps(data_dict)
+
+    def decode(self, body):
+        try:
+            return self._loads(body)
+        except Exception as e: # Each library raises its own exception types
+            raise FrameDecodeError(f"Invalid {self.name} data: {e}") from e
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+
+JSON = Codec("json", lambda data_dict: json.dumps(data_dict).encode('utf-8'), lambda body: json.loads(bytes(body)))
+CODECS = {"json": JSON}
+if msgpack is not None: # strict_map_key=False: RESUME's "servers" map may have int keys, as over JSON/CBOR
+    CODECS["msgpack"] = Codec("msgpack",
+                              lambda data_dict: msgpack.packb(data_dict, use_bin_type=True),
+                              lambda body: msgpack.unpackb(body, raw=False, strict_map_key=False))
+if cbor2 is not None:
+    CODECS["cbor"] = Codec("cbor", cbor2.dumps, lambda body: cbor2.loads(bytes(body)))
+
+CODEC_PREFERENCE = ("msgpack", "cbor", "json") # Order a client offers codecs in by default
+
+
+def get_codec(name):
+    """Returns the Codec registered as name, or None if it is unknown or not installed."""
+    return CODECS.get(name)
+
+def available_codec_names():
+    return [name for name in CODEC_PREFERENCE if name in CODECS]
+
+def choose_codec(offered):
+    """Server side of HELLO: the first codec in the client's list that is available here, else JSON."""
+    if isinstance(offered, list):
+        for name in offered:
+            codec = CODECS.get(name) if isinstance(name, str) else None
+            if codec is not None:
+                return codec
+    return JSON
+
+def hello_request(codecs=None, compression=None, dictionary=None):
+    """Client side of HELLO: offers codecs (all available ones by default) and compression, in preference order."""
+    payload = {"codecs": list(codecs or available_codec_names())}
+    payload["compression"] = list(COMPRESSION_PREFERENCE if compression is None else compression)
+    if dictionary is not None:
+        payload["dictionary"] = dictionary.id
+    return {"action": "HELLO", "payload": payload}
+
+def encode_frame(data_dict, codec=JSON, compressor=None):
+    """Serializes a message once into a complete wire frame (length prefix + body).
+
+    With a compressor the body is compressed, and flagged in the prefix, when that pays off.
+    """
+    body = codec.encode(data_dict)
+    if compressor is not None:
+        compressed = compressor.compress(body)
+        if compressed is not None:
+            return struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(compressed) | FRAME_COMPRESSED_FLAG) + compressed
+    return struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(body)) + body
+
+def parse_prefix(prefix):
+    """Returns (body_length, compressed) for a 4-byte length prefix."""
+    word = struct.unpack(MSG_LENGTH_PREFIX_FORMAT, prefix)[0]
+    return word & FRAME_LENGTH_MASK, bool(word & FRAME_COMPRESSED_FLAG)
+
+def decode_body(body, compressed, codec=JSON, compressor=None):
+    """Decodes one frame body, decompressing it first if its prefix was flagged."""
+    if compressed:
+        if compressor is None:
+            raise FrameDecodeError("Compressed frame on a connection without negotiated compression")
+        body = compressor.decompress(body)
+    return codec.decode(body)
+
+def decode_frame(frame, codec=JSON, compressor=None):
+    """Decodes a complete frame (prefix + body), e.g. one produced by encode_frame."""
+    frame = memoryview(frame)
+    _, compressed = parse_prefix(frame[:MSG_LENGTH_PREFIX_SIZE])
+    return decode_body(frame[MSG_LENGTH_PREFIX_SIZE:], compressed, codec, compressor)
+
+
+class FrameReader:
+    """Buffered frame reader for one blocking socket.
+
+    Each recv_into() fills as much of a preallocated buffer as the kernel has
+    ready, and read_frame() then hands out every complete frame in it without
+    another syscall or copy. Only one thread may read from a given reader.
+    """
+    def __init__(self, sock, buffer_size=FRAME_READER_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # First byte not yet handed out
+        self._end = 0 # End of the bytes received so far
+        self._pending = None # (body, bytes received, compressed) of a large frame interrupted by a timeout
+        self.deadline = None # time.monotonic() by which reads must complete; only reads, the socket stays blocking
+        self._poll = None
+        self.reads = 0 # recv_into calls that returned data
+        self.frames = 0
+
+    def read_frame(self):
+        """Returns (body, compressed) for the next frame, or None once the peer closes the connection.
+
+        body is a memoryview into the reader's buffer and is only valid until the
+        next call, so decode it first. Socket errors and timeouts propagate; a
+        timeout loses nothing, the partial frame stays buffered for the next call.
+        Once self.deadline has passed, reads raise socket.timeout.
+        """
+        if self._pending is not None:
+            return self._finish_large_frame()
+        while True:
+            available = self._end - self._start
+            if available >= MSG_LENGTH_PREFIX_SIZE:
+                length, compressed = parse_prefix(self._view[self._start:self._start + MSG_LENGTH_PREFIX_SIZE])
+                if length > self.max_frame_size:
+                    raise FrameTooLargeError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+                frame_end = self._start + MSG_LENGTH_PREFIX_SIZE + length
+                if frame_end <= self._end:
+                    body = self._view[self._start + MSG_LENGTH_PREFIX_SIZE:frame_end]
+                    self._start = frame_end
+                    self.frames += 1
+                    return body, compressed
+                if MSG_LENGTH_PREFIX_SIZE + length > len(self._buffer):
+                    return self._read_large_frame(length, compressed)
+            if not self._fill():
+                return None
+
+    def _fill(self):
+        """Moves the unread bytes to the front of the buffer and receives more after them. False on EOF."""
+        if self._start:
+            unread = self._end - self._start
+            if unread:
+                self._buffer[:unread] = self._buffer[self._start:self._end] # Same size, so the buffer is never resized
+            self._start, self._end = 0, unread
+        received = self._recv_into(self._view[self._end:])
+        if not received:
+            return False
+        self._end += received
+        self.reads += 1
+        return True
+
+    def _recv_into(self, view):
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0 or not self._wait_readable(remaining):
+                raise socket.timeout("Read deadline passed")
+        return self.sock.recv_into(view)
+
+    def _wait_readable(self, timeout):
+        if not hasattr(select, "poll"): # Windows
+            return bool(select.select([self.sock], [], [], timeout)[0])
+        if self._poll is None:
+            self._poll = select.poll() # Unlike select(), works for descriptors above FD_SETSIZE
+            self._poll.register(self.sock, select.POLLIN)
+        return bool(self._poll.poll(timeout * 1000))
+
+    def _read_large_frame(self, length, compressed):
+        """Reads a frame that does not fit the buffer into a bytearray of its own."""
+        view = memoryview(bytearray(length))
+        have = self._end - self._start - MSG_LENGTH_PREFIX_SIZE
+        view[:have] = self._view[self._start + MSG_LENGTH_PREFIX_SIZE:self._end]
+        self._start = self._end = 0
+        self._pending = (view, have, compressed)
+        return self._finish_large_frame()
+
+    def _finish_large_frame(self):
+        view, have, compressed = self._pending
+        while have < len(view):
+            try:
+                received = self._recv_into(view[have:])
+            except OSError: # Timeouts included: keep what arrived so the next call resumes here
+                self._pending = (view, have, compressed)
+                raise
+            if not received:
+                self._pending = None
+                return None
+            have += received
+            self.reads += 1
+        self._pending = None
+        self.frames += 1
+        return view, compressed
+
+
+# --- Compression ---
+
+class CompressionDictionary:
+    """Raw-content dictionary shared by server and clients; both sides must load the same bytes."""
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.id = hashlib.sha256(self.data).hexdigest()[:16] # Sent in HELLO to check both sides match
+        self._zstd = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def zstd_dict(self):
+        if self._zstd is None:
+            self._zstd = zstandard.ZstdCompressionDict(self.data, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return self._zstd
+
+
+class Compressor:
+    """Compresses/decompresses frame bodies with one algorithm and optional dictionary. Thread-safe."""
+    def __init__(self, name, dictionary=None, min_bytes=None):
+        self.name = name
+        self.dictionary = dictionary
+        if min_bytes is None:
+            min_bytes = COMPRESSION_MIN_BYTES_WITH_DICTIONARY if dictionary else COMPRESSION_MIN_BYTES
+        self.min_bytes = min_bytes
+        self._local = threading.local() # zstd contexts must not be shared between threads
+
+    def compress(self, body):
+        """Returns the compressed body, or None if body is below the threshold or doesn't shrink."""
+        if len(body) < self.min_bytes:
+            return None
+        if self.name == "zstd":
+            compressed = self._zstd_compressor().compress(body)
+        else:
+            if self.dictionary is not None:
+                compressobj = zlib.compressobj(COMPRESSION_ZLIB_LEVEL, zdict=self.dictionary.data)
+            else:
+                compressobj = zlib.compressobj(COMPRESSION_ZLIB_LEVEL)
+            compressed = compressobj.compress(body) + compressobj.flush()
+        return compressed if len(compressed) < len(body) else None
+
+    def decompress(self, body):
+        try:
+            if self.name == "zstd":
+                if zstandard.frame_content_size(body) > MAX_FRAME_SIZE: # -1 (unknown) is capped by max_output_size
+                    raise FrameDecodeError(f"zstd frame expands beyond {MAX_FRAME_SIZE} bytes")
+                return self._zstd_decompressor().decompress(body, max_output_size=MAX_FRAME_SIZE)
+            if self.dictionary is not None:
+                decompressobj = zlib.decompressobj(zdict=self.dictionary.data)
+            else:
+                decompressobj = zlib.decompressobj()
+            data = decompressobj.decompress(body, MAX_FRAME_SIZE)
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise FrameDecodeError(f"Invalid {self.name} frame: {e}") from e
+        if decompressobj.unconsumed_tail or not decompressobj.eof:
+            raise FrameDecodeError(f"{self.name} frame is truncated or expands beyond {MAX_FRAME_SIZE} bytes")
+        return data
+
+    def _zstd_compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            dict_data = self.dictionary.zstd_dict() if self.dictionary else None
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL, dict_data=dict_data)
+        return compressor
+
+    def _zstd_decompressor(self):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            dict_data = self.dictionary.zstd_dict() if self.dictionary else None
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return decompressor
+
+    def __repr__(self):
+        return f"Compressor({self.name!r}, dictionary={self.dictionary.id if self.dictionary else None})"
+
+
+COMPRESSION_PREFERENCE = ("zstd", "zlib") if zstandard is not None else ("zlib",)
+_compressors = {}
+_compressors_lock = threading.Lock()
+
+def get_compressor(name, dictionary=None, min_bytes=None):
+    """Shared Compressor for these settings, so fan-out can compress once per (codec, compressor)."""
+    if name not in COMPRESSION_PREFERENCE:
+        return None
+    key = (name, dictionary.id if dictionary else None, min_bytes)
+    with _compressors_lock:
+        compressor = _compressors.get(key)
+        if compressor is None:
+            compressor = _compressors[key] = Compressor(name, dictionary, min_bytes)
+        return compressor
+
+def choose_compressor(offered, dictionary_id=None, dictionary=None, min_bytes=None):
+    """Server side of HELLO: the first offered algorithm available here, using dictionary only if the ids match."""
+    if not isinstance(offered, list):
+        return None
+    use_dictionary = dictionary if dictionary is not None and dictionary_id == dictionary.id else None
+    for name in offered:
+        if isinstance(name, str) and name in COMPRESSION_PREFERENCE:
+            return get_compressor(name, use_dictionary, min_bytes)
+    return None
+
+def train_dictionary(samples, size=COMPRESSION_DICT_SIZE, segment_size=64, kmer=8):
+    """Builds a raw-content dictionary from sample frame bodies (e.g. typical responses).
+
+    Greedy segment selection in the spirit of zstd's COVER trainer: candidate
+    segments are scored by how many samples share their k-byte substrings, and the
+    best ones are taken until size is reached, each one discounting the substrings
+    it already covers. The best segments end up last, closest to the data.
+    """
+    samples = [bytes(sample) for sample in samples]
+    frequency = collections.Counter()
+    for sample in samples:
+        frequency.update({sample[i:i + kmer] for i in range(len(sample) - kmer + 1)})
+
+    def score(segment):
+        return sum(frequency[segment[i:i + kmer]] for i in range(len(segment) - kmer + 1) if frequency[segment[i:i + kmer]] > 1)
+
+    heap = []
+    step = max(segment_size // 2, 1)
+    for sample in samples:
+        for start in range(0, max(len(sample) - kmer, 0) + 1, step):
+            segment = sample[start:start + segment_size]
+            heap.append((-score(segment), len(heap), segment))
+    heapq.heapify(heap)
+
+    chosen = []
+    total = 0
+    while heap and total < size:
+        negative_score, order, segment = heapq.heappop(heap)
+        current = score(segment) # Lazy re-scoring: scores only go down as substrings get covered
+        if current <= 0:
+            continue
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, order, segment))
+            continue
+        chosen.append(segment)
+        total += len(segment)
+        for i in range(len(segment) - kmer + 1):
+            frequency[segment[i:i + kmer]] = 0
+    return b"".join(reversed(chosen))[-size:]
@@ -0,0 +1,102 @@
+# RATE_LIMIT.PY
+# In-memory token buckets for the chat server's request rate limits.
+# A bucket holds up to `burst` tokens and refills at `rate` tokens per second;
+# every request takes one token from each bucket it is charged to (the user's
+# overall bucket, the user's bucket for that action and, for chat messages, the
+# target server's fan-out bucket). A request is only admitted if all of them
+# have a token, so a rejected request costs nothing. Nothing here touches the
+# database. Limits are per process: with --workers each worker enforces them
+# for the connections it holds.
+import threading
+import time
+
+RATE_LIMIT_PRUNE_THRESHOLD = 10000 # Buckets kept before refilled (idle) ones are dropped
+
+
+def parse_limit(value):
+    """argparse type for the --rate-limit-* options: "5/10" -> (5.0, 10), i.e. 5 per second with bursts of 10.
+
+    Without "/BURST" the burst is the rate rounded down, at least 1.
+    """
+    rate, separator, burst = value.partition("/")
+    try:
+        rate = float(rate)
+        burst = int(burst) if separator else max(1, int(rate))
+    except ValueError:
+        raise ValueError(f"expected RATE or RATE/BURST, got '{value}'") from None
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"rate must be positive and burst at least 1, got '{value}'")
+    return rate, burst
+
+
+def parse_action_limit(value):
+    """argparse type for --rate-limit-action: "SEND_CHAT_MESSAGE=5/10" -> ("SEND_CHAT_MESSAGE", (5.0, 10))."""
+    action, separator, limit = value.partition("=")
+    if not separator or not action:
+        raise ValueError(f"expected ACTION=RATE/BURST, got '{value}'")
+    return action.upper(), parse_limit(limit)
+
+
+class TokenBucket:
+    """Not thread-safe on its own; RateLimiter serialises access."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost=1):
+        """Seconds until cost tokens are available (0 if they are now); call refill() first."""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Named token buckets created on first use. Thread-safe."""
+    def __init__(self, prune_threshold=RATE_LIMIT_PRUNE_THRESHOLD):
+        self.prune_threshold = prune_threshold
+        self._lock = threading.Lock()
+        self._buckets = {} # key -> TokenBucket
+        self.rejected = 0
+
+    def acquire(self, charges):
+        """charges: (key, (rate, burst)) pairs. Takes one token from every bucket, or from none.
+
+        Returns 0.0 if the request is admitted, otherwise the seconds to wait before
+        all of the buckets will have a token again.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            retry_after = 0.0
+            for key, (rate, burst) in charges:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+                else:
+                    bucket.rate, bucket.burst = rate, burst # Limits may have been reconfigured
+                    bucket.refill(now)
+                retry_after = max(retry_after, bucket.wait_time())
+                buckets.append(bucket)
+            if retry_after:
+                self.rejected += 1
+                return retry_after
+            for bucket in buckets:
+                bucket.tokens -= 1
+            if len(self._buckets) > self.prune_threshold:
+                self._prune(now)
+        return 0.0
+
+    def _prune(self, now):
+        """Drops buckets that have refilled completely; recreating them later gives the same result."""
+        for key, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
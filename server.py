@@ -5,8 +5,17 @@ import threading
 import os
 import sys
 import database # Your database module
+import server_cache # Write-through cache of server details and membership
+import traffic_log # Asynchronous, batched traffic logging (MongoDB or file)
+import presence # Server-scoped online roster and presence batching
+import server_logging # Per-module levels, JSON lines, queue-based handler
+import protocol # Framing and the negotiated codecs (JSON, MessagePack, CBOR)
+import message_bus # Pub/sub between server nodes (--workers, --bus redis)
+import rate_limit # Token buckets for per-user, per-action and per-server limits
+import passwords # Salted scrypt hashes, verified in a process pool
+import metrics # Counters, gauges and histograms served to Prometheus (--metrics-port)
 import json
-import pymongo
+import logging
 import time
 import struct
 import platform
@@ -14,10 +23,18 @@ import datetime
 import subprocess # <<< ADDED
 import select     # <<< ADDED
 import fcntl      # <<< ADDED (Linux specific for non-blocking IO)
-
-
-MSG_LENGTH_PREFIX_FORMAT = '!I'  # Network byte order, Unsigned Integer (4 bytes)
-MSG_LENGTH_PREFIX_SIZE = struct.calcsize(MSG_LENGTH_PREFIX_FORMAT)
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import shutil
+import signal
+import tempfile
+
+logger = logging.getLogger("chat.server")
+
+MSG_LENGTH_PREFIX_FORMAT = protocol.MSG_LENGTH_PREFIX_FORMAT  # Network byte order, Unsigned Integer (4 bytes)
+MSG_LENGTH_PREFIX_SIZE = protocol.MSG_LENGTH_PREFIX_SIZE
 SUPERUSER_ID = 1
 SUPERUSER_USERNAME = "SYSTEM"
 CHALLENGE_USER_ID = 2
@@ -62,143 +79,186 @@ try:
     
     # --- Check for execute permissions (optional but helpful for debugging) ---
     if not os.access(GODOT_EXECUTABLE_PATH, os.X_OK):
-         print(f"WARNING: Executable at {GODOT_EXECUTABLE_PATH} might not have execute permissions.")
+         logger.warning("Executable at %s might not have execute permissions.", GODOT_EXECUTABLE_PATH)
 
 except FileNotFoundError:
-    print(f"ERROR: Godot executable not found at {GODOT_EXECUTABLE_PATH}")
+    logger.error("Godot executable not found at %s", GODOT_EXECUTABLE_PATH)
     # Make sure database.update_challenge_status is defined and working
     # database.update_challenge_status(challenge_id, "pending") # Revert status
 
 
 
-try:
-    mongo_client = pymongo.MongoClient("mongodb://localhost:27017/") # Default local MongoDB URI
-
-    log_db = mongo_client["chat_app_logs"] # Select or create a database named 'chat_app_logs'
-    message_logs_collection = log_db["message_traffic"] # Select or create a collection
-
-    print("Soy puto")
-    # Test connection
-    mongo_client.admin.command('ping')
-    print("MongoDB connection successful. Logging is active.")
-    mongodb_logging_active = True
-except pymongo.errors.ConnectionFailure as e:
-    print(f"MongoDB connection failed: {e}. Logging will be disabled.")
-    mongodb_logging_active = False
-except Exception as e_mongo_init:
-    print(f"An error occurred during MongoDB initialization: {e_mongo_init}. Logging will be disabled.")
-    mongodb_logging_active = False
-
-def log_to_mongodb(direction, client_addr, user_details, json_data):
-    """Logs a JSON message to MongoDB."""
-    if not mongodb_logging_active:
-        return # Don't attempt to log if MongoDB isn't available
+TRAFFIC_LOG_SINKS = ("mongodb", "file", "off")
+traffic_logger = None # Set by configure_traffic_logging(); None means traffic logging is off
 
+def configure_traffic_logging(sink_name="mongodb", file_path=None, level=None, sample_rate=None, queue_size=None):
+    """Opens the chosen sink and starts the background writer. Logging stays off if the sink is unavailable."""
+    global traffic_logger
+    if sink_name == "off" or level == "off":
+        logger.info("Traffic logging is disabled.")
+        return None
     try:
-        log_entry = {
-            "timestamp_utc": datetime.datetime.now(datetime.timezone.utc), # Store as UTC
-            "direction": direction,  # "SENT_TO_CLIENT" or "RECEIVED_FROM_CLIENT"
-            "client_ip": client_addr[0] if client_addr else None,
-            "client_port": client_addr[1] if client_addr else None,
-            "user_id": user_details.get("user_id") if user_details else None,
-            "username": user_details.get("username") if user_details else None,
-            "message_json": json_data # Store the actual JSON object (or string if preferred)
-        }
-        message_logs_collection.insert_one(log_entry)
-    except Exception as e:
-        print(f"Error logging to MongoDB: {e}")
-
-def receive_all(sock, num_bytes_to_receive):
-    received_data = bytearray()
-    while len(received_data) < num_bytes_to_receive:
-        try:
-            bytes_to_get_now = min(num_bytes_to_receive - len(received_data), 4096)
-            packet = sock.recv(bytes_to_get_now)
-        except socket.timeout:
-            print(f"SERVER: Socket timeout during receive_all from {sock.getpeername()}.")
-            return None
-        except ConnectionAbortedError:
-            print(f"SERVER: Connection aborted during receive_all from {sock.getpeername()}.")
-            return None
-        except Exception as e:
-            print(f"SERVER: Socket error during receive_all from {sock.getpeername()}: {e}")
-            return None
-
-        if not packet:
-            print(f"SERVER: Connection closed by {sock.getpeername()} while expecting more data in receive_all.")
-            return None
-        received_data.extend(packet)
-    return received_data
-
-def send_json(sock, data_dict, client_addr_for_log = None, user_details_for_log = None):
+        if sink_name == "file":
+            sink = traffic_log.JsonLinesSink(file_path or "message_traffic.jsonl")
+        else:
+            sink = traffic_log.MongoSink.connect()
+    except (traffic_log.TrafficLogSinkError, OSError) as e:
+        logger.warning("%s. Logging will be disabled.", e)
+        return None
+    traffic_logger = traffic_log.TrafficLogger(sink, queue_size=queue_size, sample_rate=sample_rate, level=level).start()
+    logger.info("Traffic logging to %s is active (level: %s, sample rate: %s).", sink_name, traffic_logger.level, traffic_logger.sample_rate)
+    return traffic_logger
+
+def stop_traffic_logging():
+    global traffic_logger
+    if traffic_logger is not None:
+        traffic_logger.stop()
+        traffic_logger = None
+
+def traffic_logging_wanted(direction):
+    """True if this message should be logged; checked before building any log arguments."""
+    logger = traffic_logger
+    return logger is not None and logger.wants(direction)
+
+def log_traffic(direction, client_addr, user_details, json_data, codec=None, compressor=None):
+    """Queues a message (dict, or an encoded frame plus its codec/compressor) for the traffic log. Never blocks on the sink."""
+    logger = traffic_logger
+    if logger is not None:
+        logger.log(direction, client_addr, user_details, json_data, codec, compressor)
+
+# Per-frame compression clients can ask for in HELLO (see protocol.py)
+COMPRESSION_MIN_BYTES = None # Override from --compression-threshold; None keeps protocol's defaults
+compression_dictionary = None # protocol.CompressionDictionary loaded from --compression-dict
+
+def connection_codec(sock):
+    """The codec negotiated for this connection with HELLO (JSON for plain sockets and until HELLO)."""
+    return getattr(sock, 'codec', protocol.JSON)
+
+def connection_compressor(sock):
+    """The compressor negotiated for this connection with HELLO, or None for uncompressed frames."""
+    return getattr(sock, 'compressor', None)
+
+def encode_frame(data_dict, codec=protocol.JSON, compressor=None):
+    """Serializes a message once into a complete wire frame (length prefix + body in codec, maybe compressed)."""
+    return protocol.encode_frame(data_dict, codec, compressor)
+
+def send_frame(sock, frame, client_addr_for_log = None, user_details_for_log = None):
+    """Sends an already encoded frame. The same bytes object can be handed to any number of sockets."""
     try:
         if sock is None: return False # <<< ADDED: Check if socket is valid
-        if mongodb_logging_active: # Check before calling log function
-            log_to_mongodb("SENT_TO_CLIENT", client_addr_for_log, user_details_for_log, data_dict)
-        json_bytes = json.dumps(data_dict).encode('utf-8')
-        len_prefix = struct.pack(MSG_LENGTH_PREFIX_FORMAT, len(json_bytes))
-        sock.sendall(len_prefix)
-        sock.sendall(json_bytes)
+        if traffic_logging_wanted("SENT_TO_CLIENT"): # Check before calling log function
+            # Log the encoded frame; the worker decodes it, so the frame is the snapshot
+            log_traffic("SENT_TO_CLIENT", client_addr_for_log, user_details_for_log, memoryview(frame),
+                        connection_codec(sock), connection_compressor(sock))
+        # Single write so frames from different threads can never interleave
+        sock.sendall(frame)
         return True
     except BrokenPipeError:
         peer_name = "unknown peer"
         try:
             peer_name = sock.getpeername()
         except OSError: pass # Socket might already be closed/invalid
-        print(f"SERVER: Broken pipe while sending to {peer_name}. Client likely disconnected.")
+        logger.debug("Broken pipe while sending to %s. Client likely disconnected.", peer_name)
         return False
     except Exception as e:
         peer_name = "unknown peer"
         try:
             peer_name = sock.getpeername()
         except OSError: pass
-        print(f"SERVER: Error sending JSON data to {peer_name}: {e}")
+        logger.warning("Error sending JSON data to %s: %s", peer_name, e)
         # print(f"SERVER: Data that failed: {data_dict}") # Be cautious logging potentially large/sensitive data
         return False
 
-def receive_json(sock):
+def send_json(sock, data_dict, client_addr_for_log = None, user_details_for_log = None):
+    if sock is None: return False # <<< ADDED: Check if socket is valid
+    frame = encode_frame(data_dict, connection_codec(sock), connection_compressor(sock))
+    return send_frame(sock, frame, client_addr_for_log, user_details_for_log)
+
+def send_frame_to_users(user_ids, data_dict, exclude_user_id = None):
+    """Queues data_dict for every online user in user_ids, wherever they are connected.
+
+    Users connected to other nodes get it through the message bus. Returns the
+    number of sockets in this process the frame was handed to.
+    """
+    delivered = send_frame_to_local_users(user_ids, data_dict, exclude_user_id)
+    if remote_users:
+        remote_user_ids = [user_id for user_id in user_ids if user_id != exclude_user_id and user_id in remote_users]
+        if remote_user_ids:
+            message_bus_client.publish({"kind": "deliver", "user_ids": remote_user_ids, "data": data_dict})
+    return delivered
+
+def send_frame_to_local_users(user_ids, data_dict, exclude_user_id = None):
+    """Encodes data_dict once per codec/compressor in use and queues the frame for every user in user_ids connected here.
+
+    Returns the number of sockets the frame was handed to.
+    """
+    frames = {} # (codec name, compressor) -> encoded frame
+    delivered = 0
+    with lock:
+        for user_id in user_ids:
+            if user_id == exclude_user_id:
+                continue
+            client_info = authenticated_clients.get(user_id)
+            if client_info is not None: # Check if member is online
+                codec = connection_codec(client_info['socket'])
+                compressor = connection_compressor(client_info['socket'])
+                frame = frames.get((codec.name, compressor))
+                if frame is None:
+                    frame = frames[(codec.name, compressor)] = encode_frame(data_dict, codec, compressor)
+                if send_frame(client_info['socket'], frame):
+                    delivered += 1
+    return delivered
+
+def broadcast_to_server_members(server_id, data_dict):
+    """Fans one frame out to every online member of server_id."""
+    started = time.perf_counter()
+    delivered = send_frame_to_users(server_cache.get_member_map(server_id), data_dict)
+    BROADCAST_SECONDS.observe(time.perf_counter() - started)
+    BROADCAST_RECIPIENTS.observe(delivered)
+    return delivered
+
+def request_action(request_data):
+    return request_data.get("action") if isinstance(request_data, dict) else type(request_data).__name__
+
 
+def receive_json(sock):
+    """Reads one frame through the connection's FrameReader and decodes it with the negotiated codec."""
     global running
+    codec = connection_codec(sock)
+    compressor = connection_compressor(sock)
     try:
-        # 1. Receive the 4-byte length prefix
-        len_prefix_bytes = receive_all(sock, MSG_LENGTH_PREFIX_SIZE)
-        if len_prefix_bytes is None:
-            return None
-
-        # 2. Unpack the length prefix
-        actual_message_length = struct.unpack(MSG_LENGTH_PREFIX_FORMAT, len_prefix_bytes)[0]
-        print(f"SERVER DEBUG: Expecting JSON message of length: {actual_message_length} from {sock.getpeername()}")
-
-        # Limit message size to prevent memory exhaustion attacks if necessary
-        if actual_message_length > 10 * 1024 * 1024: # Example: 10MB limit
-            print(f"SERVER WARNING: Message length {actual_message_length} exceeds limit from {sock.getpeername()}. Closing connection.")
-            sock.close()
-            return None
-
-        # 3. Receive the actual JSON message data
-        json_message_bytes = receive_all(sock, actual_message_length)
-        if json_message_bytes is None:
+        frame = sock.frame_reader.read_frame()
+        if frame is None:
+            logger.debug("Connection closed by %s.", sock.getpeername())
             return None
 
-        # 4. Decode and parse JSON
-        json_string = json_message_bytes.decode('utf-8')
-        print(f"SERVER DEBUG: Received JSON string: {json_string[:200]}... from {sock.getpeername()}")
-        return json.loads(json_string)
-
-    except struct.error as se:
-        print(f"SERVER: Struct unpack error (bad length prefix or conn issue from {sock.getpeername()}): {se}")
+        body, compressed = frame
+        # Decompress if flagged, then decode with the negotiated codec (body is only valid until the next read)
+        request_data = protocol.decode_body(body, compressed, codec, compressor)
+        if logger.isEnabledFor(logging.DEBUG): # getpeername() is a syscall; skip it on the production path
+            # Only the action: payloads carry passwords and message text
+            logger.debug("Received %s message of length %s%s from %s: %s", codec.name, len(body),
+                         " (compressed)" if compressed else "", sock.getpeername(), request_action(request_data))
+        return request_data
+
+    except protocol.FrameTooLargeError as e:
+        # Limit message size to prevent memory exhaustion attacks
+        logger.warning("%s from %s. Closing connection.", e, sock.getpeername())
+        sock.close()
+        return None
+    except socket.timeout:
+        logger.debug("Socket timeout while receiving from %s.", sock.getpeername())
         return None
-    except json.JSONDecodeError as je:
-        print(f"SERVER: Failed to decode JSON from {sock.getpeername()}. Error: {je}")
-        print(f"SERVER DEBUG MALFORMED JSON DATA: <{json_message_bytes.decode('utf-8', errors='ignore') if 'json_message_bytes' in locals() else 'Could not decode for debug'}>")
-        return {"status": "error", "message": "Malformed JSON received."} # Send an error JSON back if possible
+    except protocol.FrameDecodeError as de:
+        logger.warning("Failed to decode %s from %s. Error: %s", codec.name, sock.getpeername(), de)
+        logger.debug("Malformed data: <%s>", bytes(body[:200]) if 'body' in locals() else 'Could not decode for debug')
+        return {"status": "error", "message": f"Malformed {codec.name.upper()} received."} # Send an error back if possible
     except Exception as e:
-        print(f"SERVER: Critical error in receive_json from {sock.getpeername()}: {e}")
+        logger.exception("Critical error in receive_json from %s: %s", sock.getpeername(), e)
         return None # General error
 
 def broadcast_message_to_server(username, user_id, server_id, server_name, message_text, response, client_socket):
     # Persist the message
-    thread_name = threading.current_thread().name # Get current thread name for logging
     message_id = database.add_message(server_id, user_id, message_text)
     if message_id:
         chat_message_broadcast = {
@@ -213,23 +273,17 @@ def broadcast_message_to_server(username, user_id, server_id, server_name, messa
                 "message_id": message_id
             }
         }
-        print(f"DEBUG: [{thread_name}] Relaying message from {username} to server '{server_name}' (ID: {server_id})")
+        logger.debug("Relaying message from %s to server '%s' (ID: %s)", username, server_name, server_id)
 
         # Broadcast to all online members of that specific server
-        server_members = database.get_server_members(server_id)
-        with lock:
-            for member in server_members:
-                member_id = member['user_id']
-                if member_id in authenticated_clients: # Check if member is online
-                    send_json(authenticated_clients[member_id]['socket'], chat_message_broadcast)
+        broadcast_to_server_members(server_id, chat_message_broadcast)
 
     else:
         response["message"] = "Failed to save your message."
         send_json(client_socket, response)
 
 def broadcast_system_message_to_server(server_id, server_name, message_text, response, client_socket):
-    thread_name = threading.current_thread().name # Get current thread name for logging
-    print(f"DEBUG: [{thread_name}] Attempting to broadcast SYSTEM message to server_id {server_id} ('{server_name}'): {message_text}")
+    logger.debug("Attempting to broadcast SYSTEM message to server_id %s ('%s'): %s", server_id, server_name, message_text)
     message_id = database.add_message(server_id, SUPERUSER_ID, message_text)
     if message_id:
         chat_message_broadcast = {
@@ -244,16 +298,11 @@ def broadcast_system_message_to_server(server_id, server_name, message_text, res
             "message_id": message_id
             }
         }
-        print(f"DEBUG: [{thread_name}] Relaying message from {SUPERUSER_USERNAME} to server '{server_name}' (ID: {server_id})")
+        logger.debug("Relaying message from %s to server '%s' (ID: %s)", SUPERUSER_USERNAME, server_name, server_id)
 
         # Broadcast to all online members of that specific server
-        server_members = database.get_server_members(server_id)
-        with lock:
-            for member in server_members:
-                member_id = member['user_id']
-                if member_id in authenticated_clients: # Check if member is online
-                    # No need to check if member_id != self.user_id if client handles its own messages
-                    send_json(authenticated_clients[member_id]['socket'], chat_message_broadcast)
+        # No need to check if member_id != self.user_id if client handles its own messages
+        broadcast_to_server_members(server_id, chat_message_broadcast)
         # No direct response to sender for SEND_CHAT_MESSAGE usually
     else:
         # Check if client_socket is valid before sending error
@@ -263,8 +312,7 @@ def broadcast_system_message_to_server(server_id, server_name, message_text, res
 
 
 def broadcast_challenge_message_to_server(server_id, server_name, message_text, response, client_socket):
-    thread_name = threading.current_thread().name # Get current thread name for logging
-    print(f"DEBUG: [{thread_name}] Attempting to broadcast SYSTEM message to server_id {server_id} ('{server_name}'): {message_text}")
+    logger.debug("Attempting to broadcast SYSTEM message to server_id %s ('%s'): %s", server_id, server_name, message_text)
     message_id = database.add_message(server_id, CHALLENGE_USER_ID, message_text)
     if message_id:
         chat_message_broadcast = {
@@ -279,28 +327,47 @@ def broadcast_challenge_message_to_server(server_id, server_name, message_text,
             "message_id": message_id
             }
         }
-        print(f"DEBUG: [{thread_name}] Relaying message from {SUPERUSER_USERNAME} to server '{server_name}' (ID: {server_id})")
+        logger.debug("Relaying message from %s to server '%s' (ID: %s)", SUPERUSER_USERNAME, server_name, server_id)
 
         # Broadcast to all online members of that specific server
-        server_members = database.get_server_members(server_id)
-        with lock:
-            for member in server_members:
-                member_id = member['user_id']
-                if member_id in authenticated_clients: # Check if member is online
-                    # No need to check if member_id != self.user_id if client handles its own messages
-                    send_json(authenticated_clients[member_id]['socket'], chat_message_broadcast)
+        # No need to check if member_id != self.user_id if client handles its own messages
+        broadcast_to_server_members(server_id, chat_message_broadcast)
         # No direct response to sender for SEND_CHAT_MESSAGE usually
     else:
         response["message"] = "Failed to save your message."
         send_json(client_socket, response)
 
+def new_response(action, request_id=None, status="error", message=None):
+    """Base response for an action. Echoes the client's optional request_id so replies can be matched out of order."""
+    response = {"action_response_to": action}
+    if request_id is not None:
+        response["request_id"] = request_id
+    if status is not None:
+        response["status"] = status
+    if message is not None:
+        response["message"] = message
+    return response
+
+def build_member_roster(members, admin_user_id):
+    """Adds is_online/is_admin to [{'user_id', 'username'}] rows, as sent to clients."""
+    member_list_with_status = []
+    with lock:
+        for member_data in members: # Renamed to avoid conflict if member is a keyword
+            member_list_with_status.append({
+                "user_id": member_data['user_id'],
+                "username": member_data['username'],
+                "is_online": member_data['user_id'] in authenticated_clients or member_data['user_id'] in remote_users,
+                "is_admin": member_data['user_id'] == admin_user_id  # <<< ADD is_admin FLAG TO PAYLOAD
+            })
+    return member_list_with_status
+
 def validate_membership(client_socket, response, user_id, server_details, target_server_id):
     if not server_details:
         response["message"] = f"Server ID {target_server_id} not found."
         send_json(client_socket, response)
         return False
 
-    if not database.is_user_member(user_id, server_details['server_id']):
+    if not server_cache.is_user_member(user_id, server_details['server_id']):
         response["message"] = f"You are not a member of server '{server_details['name']}'."
         send_json(client_socket, response)
         return False
@@ -313,12 +380,13 @@ def join_server(client_socket, response, user_id, username, invite_code_to_join)
         if server_to_join:
             server_id = server_to_join['server_id']
             server_name = server_to_join['name']
-            if database.is_user_member(user_id, server_id):
+            if server_cache.is_user_member(user_id, server_id):
                 response["message"] = f"You are already a member of server '{server_name}'."
             else:
                 # Broadcast system message about user joining this server
                 broadcast_system_message_to_server(server_id, server_name, f"{username} joined the server.", response, client_socket)
-                database.add_user_to_server(user_id, server_id)
+                if server_cache.add_user_to_server(user_id, server_id, username):
+                    remember_membership(user_id, server_id)
                 response["status"] = "success"
                 response["message"] = f"Successfully joined server '{server_name}'!"
                 response["data"] = {"server_id": server_id, "server_name": server_name}
@@ -333,8 +401,7 @@ def join_server(client_socket, response, user_id, username, invite_code_to_join)
 # <<< ADDED: Function to monitor game process >>>
 def monitor_game_process(challenge_id, process, server_id, server_name):
     """Monitors the stdout of a game server subprocess for the winner."""
-    thread_name = threading.current_thread().name
-    print(f"INFO: [{thread_name}] Starting monitor for Challenge ID: {challenge_id}, PID: {process.pid}")
+    logger.info("Starting monitor for Challenge ID: %s, PID: %s", challenge_id, process.pid)
 
     winner_username = None
     buffer = b'' # Use a buffer to store partial lines
@@ -349,18 +416,17 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
             ready_to_read, _, _ = select.select([process.stdout], [], [], 1.0) # 1 sec timeout
 
             if ready_to_read:
-                print("soy gay")
                 try:
                     # Read available data (up to 4096 bytes), not just one line
                     chunk = process.stdout.read(4096)
 
                     if chunk is None:
                         # This is the condition we want to handle, though it's weird.
-                        print(f"WARNING: [{thread_name}] process.stdout.read() returned None. Assuming EOF.")
+                        logger.warning("process.stdout.read() returned None. Assuming EOF.")
                         break
                     if not chunk:
                         # This is the standard way to detect EOF.
-                        print(f"INFO: [{thread_name}] process.stdout.read() returned b''. Assuming EOF.")
+                        logger.debug("process.stdout.read() returned b''. Assuming EOF.")
                         break
 
                     buffer += chunk # Add read data to our buffer
@@ -370,10 +436,10 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
                         line_bytes, buffer = buffer.split(b'\n', 1)
                         line = line_bytes.decode('utf-8', errors='ignore').strip()
                         if line: # Process only non-empty lines
-                            print(f"GAME_LOG (Challenge {challenge_id}): {line}")
+                            logger.debug("GAME_LOG (Challenge %s): %s", challenge_id, line)
                             if line.startswith("WINNER:"):
                                 winner_username = line.split(":", 1)[1].strip()
-                                print(f"INFO: [{thread_name}] Detected winner for Challenge {challenge_id}: {winner_username}")
+                                logger.info("Detected winner for Challenge %s: %s", challenge_id, winner_username)
                                 # Optional: you could break here if you don't need further output
 
                 except BlockingIOError:
@@ -382,14 +448,14 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
                     pass
                 except Exception as e:
                     # Catch other potential reading errors
-                    print(f"ERROR: [{thread_name}] Inner loop error reading stdout for Challenge {challenge_id}: {e}")
+                    logger.error("Inner loop error reading stdout for Challenge %s: %s", challenge_id, e)
                     break # Exit on other errors too
 
             # Small sleep even if select times out, avoids 100% CPU if select behaves strangely.
             time.sleep(0.1)
 
     except Exception as e:
-        print(f"ERROR: [{thread_name}] Outer loop error reading stdout for Challenge {challenge_id}: {e}")
+        logger.error("Outer loop error reading stdout for Challenge %s: %s", challenge_id, e)
 
     # Process any remaining data in the buffer after the process finishes
     if buffer:
@@ -397,23 +463,23 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
         for line_bytes in lines:
             line = line_bytes.decode('utf-8', errors='ignore').strip()
             if line:
-                 print(f"GAME_LOG (Challenge {challenge_id}, Final): {line}")
+                 logger.debug("GAME_LOG (Challenge %s, Final): %s", challenge_id, line)
                  if line.startswith("WINNER:") and not winner_username:
                      winner_username = line.split(":", 1)[1].strip()
-                     print(f"INFO: [{thread_name}] Detected winner (final) for Challenge {challenge_id}: {winner_username}")
+                     logger.info("Detected winner (final) for Challenge %s: %s", challenge_id, winner_username)
 
     # --- Rest of the function (Process finished or error occurred) ---
     return_code = process.wait() # Ensure process is finished and get return code
-    print(f"INFO: [{thread_name}] Game process for Challenge {challenge_id} finished. PID: {process.pid}, Code: {return_code}")
+    logger.info("Game process for Challenge %s finished. PID: %s, Code: %s", challenge_id, process.pid, return_code)
 
     # (Your existing winner processing logic here...)
     if winner_username:
         winner_user_id = database.get_user_by_name(winner_username)
         if winner_user_id:
-            print(f"INFO: [{thread_name}] Processing winner {winner_username} (ID: {winner_user_id}) for Challenge {challenge_id}")
+            logger.info("Processing winner %s (ID: %s) for Challenge %s", winner_username, winner_user_id, challenge_id)
             database.update_challenge_status(challenge_id, "completed")
             database.add_winner_to_challenge(challenge_id, winner_user_id)
-            if database.update_server_admin(server_id, winner_user_id):
+            if server_cache.update_server_admin(server_id, winner_user_id):
                 broadcast_system_message_to_server(
                     server_id, server_name,
                     f"Challenge {challenge_id} has ended! The winner and new admin is: {winner_username}!",
@@ -426,7 +492,7 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
                     {}, None
                 )
         else:
-            print(f"ERROR: [{thread_name}] Could not find user_id for winner: {winner_username}. Challenge: {challenge_id}")
+            logger.error("Could not find user_id for winner: %s. Challenge: %s", winner_username, challenge_id)
             database.update_challenge_status(challenge_id, "completed")
             broadcast_system_message_to_server(
                 server_id, server_name,
@@ -434,7 +500,7 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
                 {}, None
             )
     else:
-        print(f"WARNING: [{thread_name}] Game for Challenge {challenge_id} finished, but no winner was detected via stdout.")
+        logger.warning("Game for Challenge %s finished, but no winner was detected via stdout.", challenge_id)
         database.update_challenge_status(challenge_id, "completed")
         broadcast_system_message_to_server(
             server_id, server_name,
@@ -448,7 +514,103 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
             del game_processes[challenge_id]
         if challenge_id in game_monitor_threads:
             del game_monitor_threads[challenge_id]
-    print(f"INFO: [{thread_name}] Monitor for Challenge {challenge_id} finished.")
+    logger.info("Monitor for Challenge %s finished.", challenge_id)
+
+
+# --- Per-connection outbound queues ---
+# Broadcasts only append encoded frames to each recipient's queue; the actual
+# blocking send happens on that connection's own writer, so one client with a
+# full TCP window can't stall fan-out or hold `lock` for everybody else.
+
+OUTBOUND_QUEUE_MAX_FRAMES = 256 # Frames buffered per connection before the overflow policy applies
+OUTBOUND_OVERFLOW_POLICY = "drop_oldest" # "drop_oldest": discard the oldest queued frame; "disconnect": drop the slow client
+OUTBOUND_OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+class OutboundFrames:
+    """Bounded FIFO of encoded frames waiting to be written to one connection."""
+    def __init__(self, max_frames=None, overflow_policy=None):
+        self.max_frames = max_frames or OUTBOUND_QUEUE_MAX_FRAMES
+        self.overflow_policy = overflow_policy or OUTBOUND_OVERFLOW_POLICY
+        self.frames = collections.deque()
+        self.dropped_frames = 0
+
+    def push(self, frame):
+        """Queues a frame. Returns False if the policy says the connection must be dropped instead."""
+        if len(self.frames) >= self.max_frames:
+            if self.overflow_policy == "disconnect":
+                return False
+            self.frames.popleft()
+            self.dropped_frames += 1
+        self.frames.append(frame)
+        return True
+
+class QueuedSocket:
+    """Socket wrapper whose sendall() only enqueues; a dedicated writer thread does the blocking send.
+
+    Everything else (recv, getpeername, settimeout, ...) is passed straight to
+    the wrapped socket; receive_json reads through frame_reader.
+    """
+    def __init__(self, sock, addr=None, max_frames=None, overflow_policy=None):
+        self.sock = sock
+        self.addr = addr
+        self.codec = protocol.JSON # Switched by a HELLO request during the auth phase
+        self.compressor = None # protocol.Compressor, also negotiated by HELLO
+        self.frame_reader = protocol.FrameReader(sock) # Used by receive_json; only the connection's reader thread touches it
+        self.outbound = OutboundFrames(max_frames, overflow_policy)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._drain, name=f"writer-{addr}", daemon=True)
+        self._writer.start()
+
+    def sendall(self, data):
+        with self._cond:
+            if self._closed:
+                raise BrokenPipeError(f"Connection to {self.addr} is closed.")
+            if not self.outbound.push(bytes(data)):
+                logger.warning("Outbound queue for %s overflowed (%s frames). Disconnecting slow client.", self.addr, self.outbound.max_frames)
+                self._shutdown_locked()
+                raise BrokenPipeError(f"Outbound queue for {self.addr} overflowed.")
+            self._cond.notify()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self.outbound.frames and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                frame = self.outbound.frames.popleft()
+            try:
+                self.sock.sendall(frame)
+            except OSError as e:
+                logger.debug("Writer for %s stopped: %s", self.addr, e)
+                with self._cond:
+                    self._shutdown_locked()
+                return
+
+    def _shutdown_locked(self):
+        # Caller holds self._cond. Shutting the socket down also wakes the reader,
+        # which then ends the session through the normal disconnect path.
+        self._closed = True
+        self.outbound.frames.clear()
+        self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def abort(self):
+        """Drops the connection without flushing; the reader sees EOF and ends the session."""
+        with self._cond:
+            self._shutdown_locked()
+
+    def close(self):
+        with self._cond:
+            self._shutdown_locked()
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
 
 
 # Global dictionary to store authenticated clients, keyed by user_id
@@ -456,762 +618,2030 @@ def monitor_game_process(challenge_id, process, server_id, server_name):
 authenticated_clients = {}
 lock = threading.Lock() # Lock for synchronizing access to authenticated_clients
 
-class ClientThread(threading.Thread):
+# --- Presence ---
+# Online/offline changes only go to users who share a server with the user,
+# and bursts are merged into PRESENCE_DELTA messages (see presence.py).
+presence_roster = presence.PresenceRoster()
+# Each process only delivers to its own connections; other nodes run their own coalescer on the same events
+presence_coalescer = presence.PresenceCoalescer(presence_roster, send_frame_to_local_users) # Started by init_server/init_async_server
+
+def remember_membership(user_id, server_id):
+    """Updates the online roster after a join or server creation (always by the user's own session)."""
+    presence_roster.add_membership(user_id, server_id)
+    message_bus_client.publish({"kind": "membership", "user_id": user_id, "server_id": server_id, "status": "JOINED"})
+
+def forget_membership(user_id, server_id, removal_status, from_bus=False):
+    """Updates the online roster after a leave or kick."""
+    if not from_bus: # The user may be online on another node
+        message_bus_client.publish({"kind": "membership", "user_id": user_id, "server_id": server_id, "status": removal_status})
+    if removal_status == "SUCCESS_ADMIN_LEFT_SERVER_DELETED":
+        presence_roster.remove_server(server_id)
+    elif removal_status in ("SUCCESS_LEFT", "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED"):
+        presence_roster.remove_membership(user_id, server_id)
+
+
+# --- Message bus ---
+# Every server process is a node on a message bus (see message_bus.py) and only
+# holds its own connections. Frames for users connected to another node,
+# presence changes, membership changes and server cache invalidations travel
+# over the bus, so several nodes act as one server: worker processes started
+# with --workers (Unix socket broker, or Redis), or separate server.py instances
+# behind a load balancer (Redis). A single process uses the in-process bus,
+# where publishing with no other nodes costs nothing.
+#
+# With --workers N the main process forks N workers that each bind the port with
+# SO_REUSEPORT, so the kernel spreads new connections over them and every worker
+# has a GIL of its own.
+WORKER_COUNT = 1 # Processes serving the port; 1 runs everything in this process as before
+WORKER_RESTART_MIN_UPTIME = 10.0 # A worker that dies sooner than this after starting is not restarted
+MESSAGE_BUS_TYPES = ("inprocess", "unix", "redis")
+MESSAGE_BUS_TYPE = "inprocess" # "unix" is the default with --workers
+REDIS_ADDRESS = message_bus.REDIS_ADDRESS # host:port for --bus redis
+message_bus_client = message_bus.InProcessBus() # Replaced by start_message_bus()
+presence_registry = presence.PresenceRegistry() # Who is logged in where; RedisPresenceRegistry makes it cluster-wide
+node_id = None # This process's id on the bus
+remote_users = {} # user_id -> (node id, username, set of server_ids) for users online on other nodes; guarded by lock
+
+def create_message_bus(worker_number=None, broker_path=None):
+    """Bus and presence registry of the configured MESSAGE_BUS_TYPE for this process."""
+    if MESSAGE_BUS_TYPE == "unix":
+        return message_bus.UnixSocketBus(broker_path, worker_number), presence.PresenceRegistry()
+    node = f"{socket.gethostname()}:{os.getpid()}"
+    if MESSAGE_BUS_TYPE == "redis":
+        return message_bus.RedisBus(node, REDIS_ADDRESS), presence.RedisPresenceRegistry(REDIS_ADDRESS)
+    return message_bus.InProcessBus(node), presence.PresenceRegistry()
+
+def start_message_bus(bus, registry):
+    """Joins the other nodes. Call before serving clients; a node that loses the bus shuts itself down."""
+    global message_bus_client, presence_registry, node_id
+    message_bus_client, presence_registry, node_id = bus, registry, bus.node_id
+    server_cache.set_write_listener(publish_server_change)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    # Without the bus this node would silently miss other nodes' messages, so it stops instead
+    bus.start(handle_bus_message, on_disconnect=lambda: os.kill(os.getpid(), signal.SIGTERM))
+    logger.info("Node %s joined the %s message bus.", node_id, MESSAGE_BUS_TYPE)
+
+def stop_message_bus():
+    message_bus_client.close()
+    presence_registry.close()
+
+def publish_presence(user_id, username, online, server_ids):
+    message_bus_client.publish({"kind": "presence", "user_id": user_id, "username": username,
+                                "online": online, "server_ids": sorted(server_ids)})
+
+def publish_server_change(server_id):
+    """server_cache write listener: other nodes drop their cached copy of the server."""
+    message_bus_client.publish({"kind": "server_changed", "server_id": server_id})
+
+def publish_online_users():
+    """Tells the other nodes who is connected here (sent when a new node joins the bus)."""
+    servers_by_user = presence_roster.online_users()
+    with lock:
+        users = [[user_id, client_info['username'], sorted(servers_by_user.get(user_id, ()))]
+                 for user_id, client_info in authenticated_clients.items()]
+    message_bus_client.publish({"kind": "online_users", "users": users})
+
+def handle_bus_message(message):
+    """Applies a message published by another node. Runs on a bus thread, so it must not block."""
+    kind = message.get("kind")
+    if kind == "deliver":
+        send_frame_to_local_users(message["user_ids"], message["data"])
+    elif kind == "presence":
+        user_id, username, server_ids = message["user_id"], message["username"], message["server_ids"]
+        with lock:
+            if message["online"]:
+                remote_users[user_id] = (message["node"], username, set(server_ids))
+            elif remote_users.get(user_id, (None,))[0] == message["node"]: # Not if they already logged in elsewhere
+                del remote_users[user_id]
+        presence_coalescer.publish(user_id, username, message["online"], server_ids)
+    elif kind == "online_users":
+        with lock:
+            for user_id, username, server_ids in message["users"]:
+                remote_users[user_id] = (message["node"], username, set(server_ids))
+    elif kind == "membership":
+        user_id, server_id, status = message["user_id"], message["server_id"], message["status"]
+        with lock:
+            remote_user = remote_users.get(user_id)
+            if remote_user is not None: # Kept current for the USER_LEFT sent if their node dies
+                if status == "JOINED":
+                    remote_user[2].add(server_id)
+                else:
+                    remote_user[2].discard(server_id)
+        if status != "JOINED":
+            forget_membership(user_id, server_id, status, from_bus=True)
+    elif kind == "server_changed":
+        server_cache.invalidate_server(message["server_id"])
+    elif kind == "end_session": # The user is resuming on another node
+        with lock:
+            client_info = authenticated_clients.get(message["user_id"])
+        if client_info is not None:
+            client_info['session'].client_socket.abort()
+    elif kind == "node_started":
+        publish_online_users()
+    elif kind == "node_gone":
+        # Its connections are gone with it: tell local users those users went offline
+        with lock:
+            gone = {user_id: info for user_id, info in remote_users.items() if info[0] == message["node"]}
+            for user_id in gone:
+                del remote_users[user_id]
+        for user_id, (_, username, server_ids) in gone.items():
+            presence_coalescer.publish(user_id, username, False, server_ids)
+    else:
+        logger.warning("Ignoring bus message of unknown kind %s", kind)
+
+
+# --- Request pipelining ---
+# Clients may tag requests with a request_id and send several without waiting.
+# Read-only requests that carry one run concurrently on a shared pool and may be
+# answered out of order. Any other request first waits for the connection's
+# in-flight reads and then runs alone, so state changes keep their order and a
+# read sent after a write always sees it. Requests without a request_id are
+# processed one at a time, exactly as before.
+PIPELINE_READ_ONLY_ACTIONS = frozenset({
+    "SERVER_HISTORY", "GET_SERVER_MEMBERS", "LIST_ALL_SERVERS", "LIST_MY_SERVERS", "LOGIN_BOOTSTRAP",
+})
+PIPELINE_MAX_IN_FLIGHT = 8 # Pipelined requests per connection before we stop reading from it
+PIPELINE_EXECUTOR_MAX_WORKERS = 16 # Threads shared by all connections for pipelined requests (threaded mode)
+pipeline_executor = None # ThreadPoolExecutor created by init_server
+
+def is_pipelined_request(request_data):
+    return request_data.get("request_id") is not None and request_data.get("action") in PIPELINE_READ_ONLY_ACTIONS
+
+class RequestPipeline:
+    """Runs one connection's pipelined requests on a shared executor, at most max_in_flight at a time."""
+    def __init__(self, executor, max_in_flight=None):
+        self.executor = executor
+        self.max_in_flight = max_in_flight or PIPELINE_MAX_IN_FLIGHT
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def submit(self, fn, *args):
+        """Blocks while the connection already has max_in_flight requests running."""
+        with self._cond:
+            while self.in_flight >= self.max_in_flight:
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError: # Executor shut down during server exit
+            self._finished(None)
+            raise
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            logger.error("Exception in pipelined request: %s", future.exception())
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def wait_idle(self):
+        """Returns once every submitted request has finished."""
+        with self._cond:
+            while self.in_flight:
+                self._cond.wait()
+
+
+# --- Rate limiting ---
+# Every request is checked against in-memory token buckets before it is
+# dispatched (or queued on the pipeline), so a flooding client is turned away
+# without reaching SQLite or the broadcast path: one bucket per user for all
+# actions, one per user and limited action, and, for chat messages that pass the
+# membership check, one per target server capping the fan-out it receives from
+# all senders together. A rejected request is answered with error RATE_LIMITED
+# and retry_after (seconds). A client that keeps sending regardless is no longer
+# read from until retry_after has passed, so its own socket backs up instead of
+# the server.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_USER = (20.0, 40) # (requests per second, burst) per user, all actions together
+RATE_LIMIT_ACTIONS = { # (requests per second, burst) per user for these actions
+    "SEND_CHAT_MESSAGE": (5.0, 10),
+    "SERVER_HISTORY": (5.0, 20),
+    "LIST_ALL_SERVERS": (1.0, 5),
+    "LIST_MY_SERVERS": (2.0, 10),
+    "GET_SERVER_MEMBERS": (5.0, 20),
+    "LOGIN_BOOTSTRAP": (1.0, 5),
+    "CREATE_SERVER": (0.2, 3),
+    "JOIN_SERVER": (1.0, 5),
+    "CHALLENGE_ADMIN": (0.5, 3),
+}
+RATE_LIMIT_SERVER_FANOUT = (50.0, 100) # (chat messages per second, burst) into one server, from all its members
+RATE_LIMIT_EXEMPT_ACTIONS = frozenset({"DISCONNECT", "PING", "PONG"})
+RATE_LIMIT_PAUSE_AFTER = 5 # Requests rejected in a row before we stop reading from the connection...
+RATE_LIMIT_MAX_PAUSE = 5.0 # ...for retry_after seconds, at most this long
+rate_limiter = rate_limit.RateLimiter()
+
+def rate_limit_charges(user_id, action):
+    charges = [(("user", user_id), RATE_LIMIT_USER)]
+    action_limit = RATE_LIMIT_ACTIONS.get(action)
+    if action_limit is not None:
+        charges.append((("action", user_id, action), action_limit))
+    return charges
+
+def send_rate_limited(client_socket, action, request_id, retry_after, message):
+    response = new_response(action, request_id, message=f"{message} Retry in {retry_after:.1f}s.")
+    response["error"] = "RATE_LIMITED"
+    response["retry_after"] = round(retry_after, 3)
+    send_json(client_socket, response)
+
+
+# --- Heartbeats and idle sessions ---
+# A peer that vanishes without closing the connection (a laptop going to sleep,
+# a phone losing coverage) would otherwise leave its reader blocked in recv()
+# forever, the user shown online and their next login refused. SessionReaper
+# sends {"type": "PING"} to sessions that have sent nothing for
+# HEARTBEAT_INTERVAL seconds (clients answer with a PONG action; any request
+# counts) and evicts those silent for IDLE_TIMEOUT by aborting their socket, so
+# they end through the normal disconnect path: presence updates, registry
+# release. TCP keepalive on every accepted socket also lets the kernel notice
+# dead peers, including connections still in the auth phase.
+HEARTBEAT_INTERVAL = 30.0 # Seconds of silence before a session is pinged; 0 disables pings
+IDLE_TIMEOUT = 90.0 # Seconds of silence before a session is evicted; 0 disables reaping
+REAPER_CHECK_INTERVAL = 5.0 # At most; shorter when the heartbeat settings need it
+TCP_KEEPALIVE_IDLE = 60 # Seconds without traffic before the kernel starts probing...
+TCP_KEEPALIVE_INTERVAL = 10 # ...every this many seconds...
+TCP_KEEPALIVE_COUNT = 3 # ...and drops the connection after this many unanswered probes
+TCP_USER_TIMEOUT_MS = 60000 # Linux: drop the connection when sent data stays unacknowledged this long
+
+def configure_keepalive(sock):
+    """TCP keepalive (and, on Linux, a user timeout) for an accepted socket."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+        elif hasattr(socket, "TCP_KEEPALIVE"): # macOS name for the same option
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, TCP_KEEPALIVE_IDLE)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, TCP_USER_TIMEOUT_MS)
+    except OSError as e:
+        logger.debug("Could not enable TCP keepalive: %s", e)
+
+class SessionReaper(threading.Thread):
+    """Pings quiet sessions and evicts silent ones; see the section comment above."""
+    def __init__(self):
+        super().__init__(name="session-reaper", daemon=True)
+        self._stopped = threading.Event()
+        self.pings_sent = 0
+        self.sessions_reaped = 0
+
+    def run(self):
+        check_interval = min(interval for interval in (REAPER_CHECK_INTERVAL, HEARTBEAT_INTERVAL / 2, IDLE_TIMEOUT / 3) if interval > 0)
+        while not self._stopped.wait(check_interval):
+            try:
+                self.check(time.monotonic())
+            except Exception as e:
+                logger.exception("Error in session reaper: %s", e)
+
+    def check(self, now):
+        with lock:
+            sessions = [client['session'] for client in authenticated_clients.values()]
+        for session in sessions:
+            if session.reaped:
+                continue
+            silent_for = now - session.last_received
+            pinged = not HEARTBEAT_INTERVAL or session.last_ping > session.last_received # The client had its chance to answer
+            if IDLE_TIMEOUT and silent_for >= IDLE_TIMEOUT and pinged:
+                session.reaped = True
+                self.sessions_reaped += 1
+                logger.info("Evicting User %s (ID: %s): nothing received for %.0fs. Sessions reaped so far: %s.",
+                            session.username, session.user_id, silent_for, self.sessions_reaped)
+                session.client_socket.abort()
+            elif HEARTBEAT_INTERVAL and silent_for >= HEARTBEAT_INTERVAL and now - session.last_ping >= HEARTBEAT_INTERVAL:
+                session.last_ping = now
+                self.pings_sent += 1
+                send_json(session.client_socket, {"type": "PING", "payload": {"timestamp": int(time.time())}})
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+session_reaper = SessionReaper() # Started by init_server/init_async_server
+
+
+# --- Metrics ---
+# Counters, gauges and latency histograms (metrics.py), served in the Prometheus
+# text format at http://METRICS_HOST:METRICS_PORT/metrics by a thread of their
+# own. Off unless --metrics-port is given; with --workers, worker N serves port
+# METRICS_PORT + N - 1. database.py times its own calls
+# (chat_database_call_duration_seconds). Counts the server keeps anyway
+# (admission control, rate limiting, heartbeats, queues) are read at scrape time.
+METRICS_HOST = "127.0.0.1" # Local scrapers only, unless --metrics-host says otherwise
+METRICS_PORT = 0 # 0: no metrics endpoint
+metrics_server = None # MetricsServer started by init_server/init_async_server
+METRIC_ACTIONS = frozenset({ # action label values; anything else is counted as "other"
+    "SEND_CHAT_MESSAGE", "PONG", "PING", "DISCONNECT", "KICK_USER", "ACCEPT_CHALLENGE", "JOIN_CHALLENGE",
+    "GET_SERVER_MEMBERS", "CREATE_SERVER", "CHALLENGE_ADMIN", "LIST_ALL_SERVERS", "LIST_MY_SERVERS",
+    "LOGIN_BOOTSTRAP", "JOIN_SERVER", "LEAVE_SERVER", "SERVER_HISTORY",
+})
+REQUEST_SECONDS = metrics.histogram("chat_request_duration_seconds",
+                                    "Time to handle one request of a logged-in session, by action.", ["action"])
+AUTH_ATTEMPTS = metrics.counter("chat_auth_attempts_total",
+                                "REGISTER, LOGIN and RESUME requests, by action and result.", ["action", "result"])
+BROADCAST_RECIPIENTS = metrics.histogram("chat_broadcast_recipients",
+                                         "Connections on this node one server broadcast was queued for.",
+                                         buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+BROADCAST_SECONDS = metrics.histogram("chat_broadcast_duration_seconds",
+                                      "Time to encode and queue one server broadcast for every online member.")
+
+def metric_action(action):
+    return action if action in METRIC_ACTIONS else "other"
+
+def traffic_log_stats():
+    logger = traffic_logger
+    return logger.stats() if logger is not None else {"queued": 0, "dropped_queue_full": 0, "dropped_write_failed": 0}
+
+metrics.callback("chat_sessions", "Logged-in sessions on this node.", lambda: len(authenticated_clients))
+metrics.callback("chat_remote_sessions", "Logged-in sessions on other nodes of the message bus.", lambda: len(remote_users))
+metrics.callback("chat_handshakes_in_progress", "Admitted connections that have not logged in yet.",
+                 lambda: admission_control.pending)
+metrics.callback("chat_connections_total", "Connections accepted, by admission control result.",
+                 lambda: {("admitted",): admission_control.accepted, ("rejected",): admission_control.rejected},
+                 kind="counter", labelnames=["result"])
+metrics.callback("chat_handshakes_total", "Admitted connections that logged in or ran out of time.",
+                 lambda: {("authenticated",): admission_control.authenticated, ("timed_out",): admission_control.timed_out},
+                 kind="counter", labelnames=["outcome"])
+metrics.callback("chat_requests_rate_limited_total", "Requests rejected with RATE_LIMITED.",
+                 lambda: rate_limiter.rejected, kind="counter")
+metrics.callback("chat_heartbeat_pings_total", "PINGs sent to silent sessions.", lambda: session_reaper.pings_sent, kind="counter")
+metrics.callback("chat_sessions_reaped_total", "Sessions closed for not answering heartbeats.",
+                 lambda: session_reaper.sessions_reaped, kind="counter")
+metrics.callback("chat_presence_changes_total", "Online/offline changes published to presence subscribers.",
+                 lambda: presence_coalescer.events_published, kind="counter")
+metrics.callback("chat_bus_messages_total", "Message bus messages, by direction.",
+                 lambda: {("published",): message_bus_client.published, ("received",): message_bus_client.received},
+                 kind="counter", labelnames=["direction"])
+metrics.callback("chat_game_processes", "Minigame server processes running.", lambda: len(game_processes))
+metrics.callback("chat_traffic_log_queue_depth", "Traffic log entries waiting for the MongoDB/file writer.",
+                 lambda: traffic_log_stats()["queued"])
+metrics.callback("chat_traffic_log_dropped_total", "Traffic log entries lost, by reason.",
+                 lambda: {("queue_full",): traffic_log_stats()["dropped_queue_full"],
+                          ("write_failed",): traffic_log_stats()["dropped_write_failed"]},
+                 kind="counter", labelnames=["reason"])
+
+def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    try:
+        metrics_server = metrics.MetricsServer(METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logger.error("Cannot serve metrics on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        return
+    metrics_server.start()
+    logger.info("Serving metrics at http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.stop()
+        metrics_server = None
+
+
+class ClientSession:
+    """State and action dispatch for one authenticated user.
+
+    Kept separate from the thread so the threaded server (ClientThread) and the
+    asyncio server (init_async_server) run exactly the same request handling.
+    """
     def __init__(self, client_socket, addr, user_id, username):
-        super().__init__()
         self.client_socket = client_socket
         self.addr = addr
         self.user_id = user_id
         self.username = username
         self.running = True
         self.current_server_id = None # <<< ADDED for /users_in_server default
-
-        thread_name = threading.current_thread().name
-        print(f"DEBUG: [{thread_name}] ClientThread __init__ for UserID: {self.user_id}, Username: {self.username}, Addr: {self.addr}")
+        self.rate_limited_streak = 0 # Requests rejected in a row
+        self.read_backoff = 0.0 # Seconds the read loop should wait before reading the next request
+        self.flood_reported = False # Logged once per session
+        self.last_received = time.monotonic() # Updated by the read loop; SessionReaper evicts silent sessions
+        self.last_ping = 0.0
+        self.reaped = False
+        self.logged_out = False # Sent DISCONNECT; its resume tokens are revoked
+
+        logger.debug("ClientSession __init__ for UserID: %s, Username: %s, Addr: %s", self.user_id, self.username, self.addr)
         with lock:
             authenticated_clients[self.user_id] = {
                 'socket': self.client_socket,
                 'username': self.username,
                 'addr': self.addr,
+                'session': self,
             }
-        print(f"DEBUG: [{thread_name}] User {self.username} (ID: {self.user_id}) added to authenticated_clients.")
-
-    def run(self):
-        thread_name = threading.current_thread().name
-        print(f"DEBUG: [{thread_name}] ClientThread.run started for User: {self.username} (ID: {self.user_id})")
+        logger.debug("User %s (ID: %s) added to authenticated_clients.", self.username, self.user_id)
+
+    def announce_join(self):
+        """Tells the online users who share a server with this user that they came online."""
+        server_ids = database.get_user_server_ids(self.user_id)
+        presence_roster.user_online(self.user_id, server_ids)
+        presence_coalescer.publish(self.user_id, self.username, True, server_ids)
+        publish_presence(self.user_id, self.username, True, server_ids)
+
+    def admit(self, request_data):
+        """Rate-limits one request before it is dispatched. False if it was rejected (and the client told so)."""
+        action = request_data.get("action")
+        self.read_backoff = 0.0
+        if not RATE_LIMIT_ENABLED or action in RATE_LIMIT_EXEMPT_ACTIONS:
+            return True
+        retry_after = rate_limiter.acquire(rate_limit_charges(self.user_id, action))
+        if not retry_after:
+            self.rate_limited_streak = 0
+            return True
+        self.rate_limited_streak += 1
+        logger.debug("Rate limited %s from User %s (retry after %.2fs).", action, self.username, retry_after)
+        send_rate_limited(self.client_socket, action, request_data.get("request_id"), retry_after,
+                          f"Too many {action} requests.")
+        if self.rate_limited_streak >= RATE_LIMIT_PAUSE_AFTER:
+            self.read_backoff = min(retry_after, RATE_LIMIT_MAX_PAUSE)
+            if not self.flood_reported:
+                self.flood_reported = True
+                logger.info("User %s keeps sending while rate limited; pausing reads from them.", self.username)
+        return False
 
-        join_broadcast = {
-            "type": "USER_JOINED", # This is a global "joined the chat system" message
-            "payload": {"username": self.username, "user_id": self.user_id, "timestamp": int(time.time())}
-        }
+    def complete_resume(self, resume):
+        """Sends the RESUME reply: what changed in the user's servers since the positions the client sent.
+
+        Called once the session is registered, so anything newer than this reply
+        also reaches the client live (clients drop messages they already hold by message_id).
+        """
+        last_seen = resume["last_seen"]
+        response = new_response("RESUME", resume["request_id"])
+        servers = database.get_resume_delta(self.user_id, last_seen, resume["history_limit"])
+        if servers is None:
+            response["message"] = "Resumed, but what changed could not be loaded. Use LOGIN_BOOTSTRAP."
+            response["data"] = {"user_id": self.user_id, "username": self.username, "resume_token": resume["resume_token"]}
+            send_json(self.client_socket, response)
+            return
+
+        changed_servers, new_servers = [], []
+        for server_item in servers:
+            if server_item["server_id"] in last_seen:
+                if server_item["messages"] or server_item["events"]:
+                    changed_servers.append(server_item)
+                continue
+            # Joined since (or never loaded by this client): send it like LOGIN_BOOTSTRAP does
+            del server_item["events"]
+            server_item["messages"], server_item["has_more"] = database.get_message_page(
+                server_item["server_id"], limit=resume["history_limit"])
+            server_item["members"] = build_member_roster(server_cache.get_server_members(server_item["server_id"]),
+                                                         server_item["admin_user_id"])
+            new_servers.append(server_item)
+        server_ids = {server_item["server_id"] for server_item in servers}
+        online_user_ids = presence_roster.audience(self.user_id, server_ids)
         with lock:
-            for target_user_id, client_info in authenticated_clients.items():
-                if target_user_id != self.user_id:
-                    send_json(client_info['socket'], join_broadcast)
-
+            online_user_ids.update(user_id for user_id, (_, _, user_server_ids) in remote_users.items()
+                                   if user_id != self.user_id and user_server_ids & server_ids)
+
+        response["status"] = "success"
+        response["message"] = f"Welcome back {self.username}!"
+        response["data"] = {
+            "user_id": self.user_id,
+            "username": self.username,
+            "resume_token": resume["resume_token"],
+            "resume_token_ttl": RESUME_TOKEN_TTL,
+            "servers": changed_servers, # Only servers with new messages or events
+            "new_servers": new_servers,
+            "removed_server_ids": sorted(set(last_seen) - server_ids),
+            "online_user_ids": sorted(online_user_ids),
+        }
+        send_json(self.client_socket, response)
+        logger.info("User %s resumed: %s messages and %s events in %s servers, %s new, %s removed.", self.username,
+                    sum(len(server_item["messages"]) for server_item in changed_servers),
+                    sum(len(server_item["events"]) for server_item in changed_servers),
+                    len(changed_servers), len(new_servers), len(response["data"]["removed_server_ids"]))
+
+    def handle_request(self, request_data):
+        """Processes one decoded request and records how long it took. Returns False when the session should end."""
+        started = time.perf_counter()
         try:
-            while self.running:
-                print(f"DEBUG: [{thread_name}] ClientThread for User {self.username} waiting for JSON...")
-                request_data = receive_json(self.client_socket)
+            return self.dispatch_request(request_data)
+        finally:
+            REQUEST_SECONDS.labels(metric_action(request_data.get("action"))).observe(time.perf_counter() - started)
 
-                if request_data is None:
-                    print(f"DEBUG: [{thread_name}] User {self.username} (ID: {self.user_id}) disconnected or bad data.")
-                    self.running = False
-                    break
+    def dispatch_request(self, request_data):
+        """Runs the handler for the request's action; see handle_request."""
+        if traffic_logging_wanted("RECEIVED_FROM_CLIENT"): # Check before calling log function
+            current_user_details = {"user_id": self.user_id, "username": self.username}
+            log_traffic("RECEIVED_FROM_CLIENT", self.addr, current_user_details, request_data)
 
-                if mongodb_logging_active: # Check before calling log function
-                    current_user_details = {"user_id": self.user_id, "username": self.username}
-                    log_to_mongodb("RECEIVED_FROM_CLIENT", self.addr, current_user_details, request_data)
+        action = request_data.get("action")
+        payload = request_data.get("payload", {})
+        request_id = request_data.get("request_id") # Optional; echoed on the response so pipelined replies can be matched
+        logger.debug("Received %s (request_id %s) from User %s", action, request_id, self.username)
+        response = new_response(action, request_id, message="Unhandled action or error.") # Default error response
 
-                print(f"DEBUG: [{thread_name}] Received from User {self.username}: {request_data}")
+        if action == "SEND_CHAT_MESSAGE":
+            server_id_target_str = payload.get("server_id")
+            message_content = payload.get("message")
 
-                action = request_data.get("action")
-                payload = request_data.get("payload", {})
-                response = {"action_response_to": action, "status": "error", "message": "Unhandled action or error."} # Default error response
+            if server_id_target_str is None or message_content is None:
+                response["message"] = "server_id and message are required for SEND_CHAT_MESSAGE."
+                send_json(self.client_socket, response)
+                return True
 
-                if action == "SEND_CHAT_MESSAGE":
-                    server_id_target_str = payload.get("server_id")
-                    message_content = payload.get("message")
+            try:
+                target_server_id = int(server_id_target_str)
+
+                # Validate server and membership
+                server_details = server_cache.get_server_details(target_server_id)
+                if (validate_membership(self.client_socket, response, self.user_id, server_details, target_server_id)):
+                    retry_after = rate_limiter.acquire([(("server", target_server_id), RATE_LIMIT_SERVER_FANOUT)]) if RATE_LIMIT_ENABLED else 0
+                    if retry_after:
+                        send_rate_limited(self.client_socket, action, request_id, retry_after,
+                                          f"Server '{server_details['name']}' is receiving too many messages.")
+                        return True
+                    # Persist the message
+                    broadcast_message_to_server(self.username, self.user_id, target_server_id, server_details['name'], message_content, response, self.client_socket)
+                    return True
+
+            except ValueError:
+                response["message"] = "Invalid server_id format for SEND_CHAT_MESSAGE."
+                send_json(self.client_socket, response)
+                return True
+
+        elif action == "PONG": # Heartbeat answer; the read loop already noted the activity
+            return True
+
+        elif action == "PING": # Client-initiated heartbeat
+            response["status"] = "success"
+            response["message"] = "PONG"
+            response["data"] = {"timestamp": int(time.time())}
+
+        elif action == "DISCONNECT":
+            logger.debug("User %s sent DISCONNECT.", self.username)
+            self.running = False
+            self.logged_out = True
+            database.delete_resume_tokens(self.user_id) # A deliberate logout cannot be resumed
+            # No response needed, client will close. Server closes in finally.
+            return False
 
-                    if server_id_target_str is None or message_content is None:
-                        response["message"] = "server_id and message are required for SEND_CHAT_MESSAGE."
-                        send_json(self.client_socket, response)
-                        continue
+        elif action == "KICK_USER":
+            payload_server_id_str = payload.get("server_id")
+            payload_user_to_kick_id_str = payload.get("user_to_kick_id")
 
-                    try:
-                        target_server_id = int(server_id_target_str)
+            response = new_response(action, request_id, message="Default error for KICK_USER.")
 
-                        # Validate server and membership
-                        server_details = database.get_server_details(target_server_id)
-                        if (validate_membership(self.client_socket, response, self.user_id, server_details, target_server_id)):
-                            # Persist the message
-                            broadcast_message_to_server(self.username, self.user_id, target_server_id, server_details['name'], message_content, response, self.client_socket)
-                            continue
+            if payload_server_id_str is None or payload_user_to_kick_id_str is None:
+                response["message"] = "server_id and user_to_kick_id are required."
+            else:
+                try:
+                    target_server_id = int(payload_server_id_str)
+                    user_to_kick_id = int(payload_user_to_kick_id_str)
+
+                    server_details = server_cache.get_server_details(target_server_id)
+
+                    if not server_details:
+                        response["message"] = f"Server ID {target_server_id} not found."
+                    elif server_details['admin_user_id'] != self.user_id: # Check if requester is admin
+                        response["message"] = "You are not the admin of this server and cannot kick users."
+                    elif user_to_kick_id == self.user_id: # Admin trying to kick self
+                        response["message"] = "Admins cannot kick themselves. Use /leave_server if you wish to leave."
+                    elif user_to_kick_id == SUPERUSER_ID: # Trying to kick system user
+                        response["message"] = "The SYSTEM user cannot be kicked."
+                    elif not server_cache.is_user_member(user_to_kick_id, target_server_id):
+                        response["message"] = f"User ID {user_to_kick_id} is not a member of this server."
+                    else:
+                        kicked_user_details = database.get_user(user_to_kick_id) # To get username
+                        kicked_username = kicked_user_details['username'] if kicked_user_details else f"User_{user_to_kick_id}"
+                        removal_result = server_cache.remove_user_from_server(user_to_kick_id, target_server_id, kicked=True)
+                        forget_membership(user_to_kick_id, target_server_id, removal_result.get("status"))
 
-                    except ValueError:
-                        response["message"] = "Invalid server_id format for SEND_CHAT_MESSAGE."
-                        send_json(self.client_socket, response)
-                        continue
+                        if removal_result.get("status") == "SUCCESS_LEFT" or \
+                           removal_result.get("status") == "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED" or \
+                           removal_result.get("status") == "SUCCESS_ADMIN_LEFT_SERVER_DELETED":
 
-                elif action == "DISCONNECT":
-                    print(f"DEBUG: [{thread_name}] User {self.username} sent DISCONNECT.")
-                    self.running = False
-                    # No response needed, client will close. Server closes in finally.
-                    break
+                            response["status"] = "success"
+                            response["message"] = f"User '{kicked_username}' (ID: {user_to_kick_id}) has been kicked from server '{server_details['name']}'."
+
+                            # Notify the server
+                            broadcast_system_message_to_server(
+                                target_server_id,
+                                server_details['name'],
+                                f"User '{kicked_username}' has been kicked from the server by Admin {self.username}.",
+                                response,
+                                self.client_socket
+                            )
+
+                            # Notify the kicked user if they are online (possibly on another node)
+                            kick_notification_to_user = {
+                                "type": "YOU_WERE_KICKED",
+                                "payload": {
+                                    "server_id": target_server_id,
+                                    "server_name": server_details['name'],
+                                    "kicked_by_username": self.username,
+                                    "timestamp": int(time.time())
+                                }
+                            }
+                            send_frame_to_users([user_to_kick_id], kick_notification_to_user)
+                        else:
+                            response["message"] = f"Failed to kick user '{kicked_username}'. Reason: {removal_result.get('status', 'Unknown error')}"
+                            if removal_result.get("status") == "NOT_MEMBER": # Should have been caught by is_user_member
+                                 response["message"] = f"User '{kicked_username}' was not found as a member during removal."
 
-                elif action == "KICK_USER":
-                    payload_server_id_str = payload.get("server_id")
-                    payload_user_to_kick_id_str = payload.get("user_to_kick_id")
 
-                    response = {"action_response_to": action, "status": "error", "message": "Default error for KICK_USER."}
+                except ValueError:
+                    response["message"] = "Invalid server_id or user_to_kick_id format. Must be numbers."
+                except Exception as e_kick:
+                    logger.error("Exception in KICK_USER for %s: %s", self.username, e_kick)
+                    response["message"] = f"An unexpected error occurred: {e_kick}"
 
-                    if payload_server_id_str is None or payload_user_to_kick_id_str is None:
-                        response["message"] = "server_id and user_to_kick_id are required."
-                    else:
-                        try:
-                            target_server_id = int(payload_server_id_str)
-                            user_to_kick_id = int(payload_user_to_kick_id_str)
-
-                            server_details = database.get_server_details(target_server_id)
-
-                            if not server_details:
-                                response["message"] = f"Server ID {target_server_id} not found."
-                            elif server_details['admin_user_id'] != self.user_id: # Check if requester is admin
-                                response["message"] = "You are not the admin of this server and cannot kick users."
-                            elif user_to_kick_id == self.user_id: # Admin trying to kick self
-                                response["message"] = "Admins cannot kick themselves. Use /leave_server if you wish to leave."
-                            elif user_to_kick_id == SUPERUSER_ID: # Trying to kick system user
-                                response["message"] = "The SYSTEM user cannot be kicked."
-                            elif not database.is_user_member(user_to_kick_id, target_server_id):
-                                response["message"] = f"User ID {user_to_kick_id} is not a member of this server."
-                            else:
-                                kicked_user_details = database.get_user(user_to_kick_id) # To get username
-                                kicked_username = kicked_user_details['username'] if kicked_user_details else f"User_{user_to_kick_id}"
-                                removal_result = database.remove_user_from_server(user_to_kick_id, target_server_id)
+            send_json(self.client_socket, response) # Send response to the admin who issued kick
+            return True
 
-                                if removal_result.get("status") == "SUCCESS_LEFT" or \
-                                   removal_result.get("status") == "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED" or \
-                                   removal_result.get("status") == "SUCCESS_ADMIN_LEFT_SERVER_DELETED":
+        elif action == "ACCEPT_CHALLENGE":
+            server_id_str = payload.get("server_id")
+            response = new_response(action, request_id)
 
-                                    response["status"] = "success"
-                                    response["message"] = f"User '{kicked_username}' (ID: {user_to_kick_id}) has been kicked from server '{server_details['name']}'."
+            if server_id_str is None:
+                response["message"] = "server_id is required to accept a challenge."
+            else:
+                try:
+                    target_server_id = int(server_id_str)
+                    server_details = server_cache.get_server_details(target_server_id)
 
-                                    # Notify the server
-                                    broadcast_system_message_to_server(
-                                        target_server_id,
-                                        server_details['name'],
-                                        f"User '{kicked_username}' has been kicked from the server by Admin {self.username}.",
-                                        response,
-                                        self.client_socket
+                    if not server_details:
+                        response["message"] = f"Server ID {target_server_id} not found."
+                    else:
+                        server_name = server_details.get('name', f"ServerID_{target_server_id}")
+                        active_challenge = database.get_active_challenge_for_server(target_server_id)
+
+                        if not active_challenge:
+                            response["message"] = f"No active challenge found in server '{server_name}' to accept."
+                        elif active_challenge.get('status') != 'pending':
+                            response["message"] = f"The challenge in server '{server_name}' is not 'pending' (current: {active_challenge.get('status')})."
+                        elif self.user_id != active_challenge.get('admin_user_id'):
+                            response["message"] = "Only the challenged admin can accept this challenge."
+                        elif active_challenge['challenge_id'] in game_processes:
+                             response["message"] = "A game for this challenge is already running or starting."
+                        else:
+                            challenge_id = active_challenge['challenge_id']
+                            if database.update_challenge_status(challenge_id, "accepted"):
+                                response["status"] = "success"
+                                response["message"] = "Challenge accepted! Starting minigame server and sending invites..."
+
+                                # <<< START GAME SERVER SUBPROCESS >>>
+                                try:
+                                    # <<< SEND INVITES >>>
+                                    minigame_info_payload = {
+                                        "challenge_id": challenge_id,
+                                        "server_id": target_server_id,
+                                        "server_name": server_name,
+                                        "minigame_ip": DUMMY_MINIGAME_IP,
+                                        "minigame_port": DUMMY_MINIGAME_PORT,
+                                        "game_type": "DefaultMinigame"
+                                    }
+                                    participants = database.get_challenge_participants(challenge_id)
+                                    participant_usernames = [p['username'] for p in participants]
+                                    minigame_info_payload["all_participants"] = participant_usernames
+                                    number_of_usernames = len(participant_usernames)
+                                    logger.debug("Challenge %s has %s participants", challenge_id, number_of_usernames)
+                                    if number_of_usernames == 4:
+                                        player_number_flag = "--four"
+                                    elif number_of_usernames == 3:
+                                        player_number_flag = "--three"
+                                    else:
+                                        player_number_flag = ""
+                                    game_command = [GODOT_EXECUTABLE_PATH, "--server", "--headless", f"--ip={DUMMY_MINIGAME_IP}", player_number_flag]
+                                    logger.debug("Current Working Directory is: %s", os.getcwd())
+                                    logger.info("Starting game server: %s", ' '.join(game_command))
+                                    game_proc = subprocess.Popen(
+                                        game_command,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, # Redirect stderr to stdout
+                                        text=False, # Read bytes
+                                        bufsize=0, # Unbuffered
+                                        cwd=os.path.dirname(GODOT_EXECUTABLE_PATH) or '.' # Run in GodotGame dir
                                     )
-
-                                    # Notify the kicked user if they are online
                                     with lock:
-                                        if user_to_kick_id in authenticated_clients:
-                                            kicked_user_socket = authenticated_clients[user_to_kick_id]['socket']
-                                            kick_notification_to_user = {
-                                                "type": "YOU_WERE_KICKED",
-                                                "payload": {
-                                                    "server_id": target_server_id,
-                                                    "server_name": server_details['name'],
-                                                    "kicked_by_username": self.username,
-                                                    "timestamp": int(time.time())
-                                                }
-                                            }
-                                            send_json(kicked_user_socket, kick_notification_to_user)
-                                else:
-                                    response["message"] = f"Failed to kick user '{kicked_username}'. Reason: {removal_result.get('status', 'Unknown error')}"
-                                    if removal_result.get("status") == "NOT_MEMBER": # Should have been caught by is_user_member
-                                         response["message"] = f"User '{kicked_username}' was not found as a member during removal."
-
-
-                        except ValueError:
-                            response["message"] = "Invalid server_id or user_to_kick_id format. Must be numbers."
-                        except Exception as e_kick:
-                            print(f"DEBUG: [{thread_name}] Exception in KICK_USER for {self.username}: {e_kick}")
-                            response["message"] = f"An unexpected error occurred: {e_kick}"
-
-                    send_json(self.client_socket, response) # Send response to the admin who issued kick
-                    continue
+                                        game_processes[challenge_id] = game_proc
+                                    logger.info("Game server started for Challenge %s. PID: %s", challenge_id, game_proc.pid)
+
+                                    # <<< START MONITOR THREAD >>>
+                                    monitor_thread = threading.Thread(
+                                        target=monitor_game_process,
+                                        args=(challenge_id, game_proc, target_server_id, server_name),
+                                        daemon=True # Allow server to exit even if monitor hangs
+                                    )
+                                    monitor_thread.start()
+                                    with lock:
+                                        game_monitor_threads[challenge_id] = monitor_thread
 
-                elif action == "ACCEPT_CHALLENGE":
-                    server_id_str = payload.get("server_id")
-                    response = {"action_response_to": action, "status": "error"}
+                                    # Give game server a moment to start (CRUDE!)
+                                    time.sleep(2.0)
 
-                    if server_id_str is None:
-                        response["message"] = "server_id is required to accept a challenge."
-                    else:
-                        try:
-                            target_server_id = int(server_id_str)
-                            server_details = database.get_server_details(target_server_id)
+                                    send_frame_to_users(
+                                        [participant_data['user_id'] for participant_data in participants],
+                                        {"type": "MINIGAME_INVITE", "payload": minigame_info_payload}
+                                    )
 
-                            if not server_details:
-                                response["message"] = f"Server ID {target_server_id} not found."
+                                    broadcast_system_message_to_server(
+                                        target_server_id, server_name,
+                                        (f"Admin {self.username} accepted the challenge! "
+                                         f"Minigame starting for participants: {', '.join(participant_usernames)}."),
+                                        response, self.client_socket
+                                    )
+
+                                except FileNotFoundError:
+                                    logger.error("Godot executable not found at %s", GODOT_EXECUTABLE_PATH)
+                                    response["status"] = "error"
+                                    response["message"] = "Minigame server executable not found. Cannot start game."
+                                    database.update_challenge_status(challenge_id, "pending") # Revert status
+                                except Exception as e_game_start:
+                                    logger.error("Failed to start game server: %s", e_game_start)
+                                    response["status"] = "error"
+                                    response["message"] = f"Failed to start minigame server: {e_game_start}"
+                                    database.update_challenge_status(challenge_id, "pending") # Revert status
                             else:
-                                server_name = server_details.get('name', f"ServerID_{target_server_id}")
-                                active_challenge = database.get_active_challenge_for_server(target_server_id)
-
-                                if not active_challenge:
-                                    response["message"] = f"No active challenge found in server '{server_name}' to accept."
-                                elif active_challenge.get('status') != 'pending':
-                                    response["message"] = f"The challenge in server '{server_name}' is not 'pending' (current: {active_challenge.get('status')})."
-                                elif self.user_id != active_challenge.get('admin_user_id'):
-                                    response["message"] = "Only the challenged admin can accept this challenge."
-                                elif active_challenge['challenge_id'] in game_processes:
-                                     response["message"] = "A game for this challenge is already running or starting."
-                                else:
-                                    challenge_id = active_challenge['challenge_id']
-                                    if database.update_challenge_status(challenge_id, "accepted"):
-                                        response["status"] = "success"
-                                        response["message"] = "Challenge accepted! Starting minigame server and sending invites..."
-
-                                        # <<< START GAME SERVER SUBPROCESS >>>
-                                        try:
-                                            # <<< SEND INVITES >>>
-                                            minigame_info_payload = {
-                                                "challenge_id": challenge_id,
-                                                "server_id": target_server_id,
-                                                "server_name": server_name,
-                                                "minigame_ip": DUMMY_MINIGAME_IP,
-                                                "minigame_port": DUMMY_MINIGAME_PORT,
-                                                "game_type": "DefaultMinigame"
-                                            }
-                                            participants = database.get_challenge_participants(challenge_id)
-                                            participant_usernames = [p['username'] for p in participants]
-                                            minigame_info_payload["all_participants"] = participant_usernames
-                                            number_of_usernames = len(participant_usernames)
-                                            print(number_of_usernames)
-                                            if number_of_usernames == 4:
-                                                player_number_flag = "--four"
-                                            elif number_of_usernames == 3:
-                                                player_number_flag = "--three"
-                                            else:
-                                                player_number_flag = ""
-                                            game_command = [GODOT_EXECUTABLE_PATH, "--server", "--headless", f"--ip={DUMMY_MINIGAME_IP}", player_number_flag]
-                                            print(f"DEBUG: Current Working Directory is: {os.getcwd()}") 
-                                            print(f"INFO: [{thread_name}] Starting game server: {' '.join(game_command)}")
-                                            game_proc = subprocess.Popen(
-                                                game_command,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.STDOUT, # Redirect stderr to stdout
-                                                text=False, # Read bytes
-                                                bufsize=0, # Unbuffered
-                                                cwd=os.path.dirname(GODOT_EXECUTABLE_PATH) or '.' # Run in GodotGame dir
-                                            )
-                                            with lock:
-                                                game_processes[challenge_id] = game_proc
-                                            print(f"INFO: [{thread_name}] Game server started for Challenge {challenge_id}. PID: {game_proc.pid}")
-
-                                            # <<< START MONITOR THREAD >>>
-                                            monitor_thread = threading.Thread(
-                                                target=monitor_game_process,
-                                                args=(challenge_id, game_proc, target_server_id, server_name),
-                                                daemon=True # Allow server to exit even if monitor hangs
-                                            )
-                                            monitor_thread.start()
-                                            with lock:
-                                                game_monitor_threads[challenge_id] = monitor_thread
-
-                                            # Give game server a moment to start (CRUDE!)
-                                            time.sleep(2.0)
-
-                                            with lock:
-                                                for participant_data in participants:
-                                                    p_user_id = participant_data['user_id']
-                                                    if p_user_id in authenticated_clients:
-                                                        send_json(authenticated_clients[p_user_id]['socket'], {
-                                                            "type": "MINIGAME_INVITE",
-                                                            "payload": minigame_info_payload
-                                                        })
-
-                                            broadcast_system_message_to_server(
-                                                target_server_id, server_name,
-                                                (f"Admin {self.username} accepted the challenge! "
-                                                 f"Minigame starting for participants: {', '.join(participant_usernames)}."),
-                                                response, self.client_socket
-                                            )
-
-                                        except FileNotFoundError:
-                                            print(f"ERROR: [{thread_name}] Godot executable not found at {GODOT_EXECUTABLE_PATH}")
-                                            response["status"] = "error"
-                                            response["message"] = "Minigame server executable not found. Cannot start game."
-                                            database.update_challenge_status(challenge_id, "pending") # Revert status
-                                        except Exception as e_game_start:
-                                            print(f"ERROR: [{thread_name}] Failed to start game server: {e_game_start}")
-                                            response["status"] = "error"
-                                            response["message"] = f"Failed to start minigame server: {e_game_start}"
-                                            database.update_challenge_status(challenge_id, "pending") # Revert status
-                                    else:
-                                        response["message"] = "Failed to update challenge status in the database."
-                        except ValueError:
-                            response["message"] = "Invalid server_id format."
-                        except Exception as e_accept_chal:
-                            print(f"DEBUG: [{thread_name}] Exception in ACCEPT_CHALLENGE: {e_accept_chal}")
-                            response["message"] = f"An unexpected error occurred: {e_accept_chal}"
+                                response["message"] = "Failed to update challenge status in the database."
+                except ValueError:
+                    response["message"] = "Invalid server_id format."
+                except Exception as e_accept_chal:
+                    logger.error("Exception in ACCEPT_CHALLENGE: %s", e_accept_chal)
+                    response["message"] = f"An unexpected error occurred: {e_accept_chal}"
 
-                    send_json(self.client_socket, response)
-                    continue
+            send_json(self.client_socket, response)
+            return True
 
 
-                elif action == "JOIN_CHALLENGE":
-                    server_id_str = payload.get("server_id")
-                    response = {"action_response_to": action, "status": "error", "message": "Default error joining challenge."} # Default error
+        elif action == "JOIN_CHALLENGE":
+            server_id_str = payload.get("server_id")
+            response = new_response(action, request_id, message="Default error joining challenge.") # Default error
 
-                    if server_id_str is None:
-                        response["message"] = "server_id is required to join a challenge."
+            if server_id_str is None:
+                response["message"] = "server_id is required to join a challenge."
+            else:
+                try:
+                    target_server_id = int(server_id_str)
+                    server_details = server_cache.get_server_details(target_server_id) # Returns dict or None
+
+                    if not server_details:
+                        response["message"] = f"Server ID {target_server_id} not found."
+                    elif not server_cache.is_user_member(self.user_id, target_server_id): # Check if joiner is member of server
+                        response["message"] = f"You are not a member of server '{server_details.get('name', 'Unknown Server')}'."
                     else:
-                        try:
-                            target_server_id = int(server_id_str)
-                            server_details = database.get_server_details(target_server_id) # Returns dict or None
-
-                            if not server_details:
-                                response["message"] = f"Server ID {target_server_id} not found."
-                            elif not database.is_user_member(self.user_id, target_server_id): # Check if joiner is member of server
-                                response["message"] = f"You are not a member of server '{server_details.get('name', 'Unknown Server')}'."
-                            else:
-                                # Safely get server name for messages
-                                server_name = server_details.get('name', f"ServerID_{target_server_id}")
-
-                                active_challenge = database.get_active_challenge_for_server(target_server_id) # Returns dict or None
-
-                                if not active_challenge:
-                                    response["message"] = f"No active challenge found in server '{server_name}' to join."
-                                elif active_challenge.get('status') != 'pending': # Now safe to access 'status'
-                                    response["message"] = (f"The challenge in server '{server_name}' is not currently 'pending' "
-                                                           f"(current status: {active_challenge.get('status')}).")
-                                elif self.user_id == active_challenge.get('admin_user_id') or \
-                                     self.user_id == active_challenge.get('challenger_user_id'):
-                                    response["message"] = "You are already a primary participant (admin or original challenger) in this challenge."
-                                else:
-                                    challenge_id = active_challenge['challenge_id'] # Safe now
-
-                                    # Get admin username for the notification message
-                                    admin_user_for_challenge = database.get_user_by_name(active_challenge['admin_user_id'])
-                                    admin_username_for_notification = "the Admin"
-                                    if admin_user_for_challenge and admin_user_for_challenge.get('username'):
-                                        admin_username_for_notification = admin_user_for_challenge['username']
-
-                                    # Attempt to add participant
-                                    join_status = database.add_participant_to_challenge(
-                                        challenge_id, self.user_id, MAX_CHALLENGE_PARTICIPANTS # Ensure MAX_CHALLENGE_PARTICIPANTS is defined
-                                    )
+                        # Safely get server name for messages
+                        server_name = server_details.get('name', f"ServerID_{target_server_id}")
+
+                        active_challenge = database.get_active_challenge_for_server(target_server_id) # Returns dict or None
+
+                        if not active_challenge:
+                            response["message"] = f"No active challenge found in server '{server_name}' to join."
+                        elif active_challenge.get('status') != 'pending': # Now safe to access 'status'
+                            response["message"] = (f"The challenge in server '{server_name}' is not currently 'pending' "
+                                                   f"(current status: {active_challenge.get('status')}).")
+                        elif self.user_id == active_challenge.get('admin_user_id') or \
+                             self.user_id == active_challenge.get('challenger_user_id'):
+                            response["message"] = "You are already a primary participant (admin or original challenger) in this challenge."
+                        else:
+                            challenge_id = active_challenge['challenge_id'] # Safe now
 
-                                    if join_status == "SUCCESS":
-                                        response["status"] = "success"
-                                        response["message"] = f"You have successfully joined the challenge (ID: {challenge_id}) in server '{server_name}'."
-                                        broadcast_system_message_to_server(
-                                            target_server_id,
-                                            server_name,
-                                            f"{self.username} has joined the challenge against the Admin!",
-                                            response,
-                                            self.client_socket
-                                        )
-                                    elif join_status == "ALREADY_JOINED":
-                                        response["message"] = "You have already joined this challenge."
-                                    elif join_status == "CHALLENGE_FULL":
-                                        response["message"] = "This challenge is already full."
-                                    elif join_status == "CHALLENGE_NOT_PENDING": # Should be caught earlier, but good fallback
-                                        response["message"] = "This challenge is no longer accepting new participants."
-                                    elif join_status == "ALREADY_A_PRIMARY_PARTICIPANT": # From add_participant_to_challenge
-                                        response["message"] = "You cannot join as an additional participant if you are the admin or original challenger."
-                                    else: # CHALLENGE_NOT_FOUND or ERROR from add_participant
-                                        response["message"] = f"Could not join challenge (Reason: {join_status})."
-                        except ValueError:
-                            response["message"] = "Invalid server_id format."
-                        except Exception as e_join_chal: # Catch any other unexpected error
-                            print(f"DEBUG: [{thread_name}] Exception in JOIN_CHALLENGE for {self.username}: {e_join_chal}")
-                            response["message"] = f"An unexpected error occurred while trying to join the challenge: {e_join_chal}"
+                            # Get admin username for the notification message
+                            admin_user_for_challenge = database.get_user_by_name(active_challenge['admin_user_id'])
+                            admin_username_for_notification = "the Admin"
+                            if admin_user_for_challenge and admin_user_for_challenge.get('username'):
+                                admin_username_for_notification = admin_user_for_challenge['username']
 
+                            # Attempt to add participant
+                            join_status = database.add_participant_to_challenge(
+                                challenge_id, self.user_id, MAX_CHALLENGE_PARTICIPANTS # Ensure MAX_CHALLENGE_PARTICIPANTS is defined
+                            )
+
+                            if join_status == "SUCCESS":
+                                response["status"] = "success"
+                                response["message"] = f"You have successfully joined the challenge (ID: {challenge_id}) in server '{server_name}'."
+                                broadcast_system_message_to_server(
+                                    target_server_id,
+                                    server_name,
+                                    f"{self.username} has joined the challenge against the Admin!",
+                                    response,
+                                    self.client_socket
+                                )
+                            elif join_status == "ALREADY_JOINED":
+                                response["message"] = "You have already joined this challenge."
+                            elif join_status == "CHALLENGE_FULL":
+                                response["message"] = "This challenge is already full."
+                            elif join_status == "CHALLENGE_NOT_PENDING": # Should be caught earlier, but good fallback
+                                response["message"] = "This challenge is no longer accepting new participants."
+                            elif join_status == "ALREADY_A_PRIMARY_PARTICIPANT": # From add_participant_to_challenge
+                                response["message"] = "You cannot join as an additional participant if you are the admin or original challenger."
+                            else: # CHALLENGE_NOT_FOUND or ERROR from add_participant
+                                response["message"] = f"Could not join challenge (Reason: {join_status})."
+                except ValueError:
+                    response["message"] = "Invalid server_id format."
+                except Exception as e_join_chal: # Catch any other unexpected error
+                    logger.error("Exception in JOIN_CHALLENGE for %s: %s", self.username, e_join_chal)
+                    response["message"] = f"An unexpected error occurred while trying to join the challenge: {e_join_chal}"
+
+            send_json(self.client_socket, response)
+            return True
+
+        elif action == "GET_SERVER_MEMBERS":
+            server_id_to_query_str = payload.get("server_id")
+            response = new_response(action, request_id, message="Server ID not provided or invalid.")
+
+            target_server_id = None
+            if server_id_to_query_str is not None:
+                try:
+                    target_server_id = int(server_id_to_query_str)
+                except ValueError:
+                    response["message"] = "Invalid server_id format. Must be a number."
                     send_json(self.client_socket, response)
-                    continue
+                    return True
+            elif self.current_server_id is not None:
+                target_server_id = self.current_server_id
+
+            if target_server_id is not None:
+                server_details = server_cache.get_server_details(target_server_id) # Fetches name, admin_user_id, etc.
+                if not server_details:
+                    response["message"] = f"Server ID {target_server_id} not found."
+                else:
+                    current_server_admin_id = server_details['admin_user_id'] # Get the admin ID for this server
+                    db_members = server_cache.get_server_members(target_server_id) # List of {'user_id': X, 'username': 'name'}
 
-                elif action == "GET_SERVER_MEMBERS":
-                    server_id_to_query_str = payload.get("server_id")
-                    response = {"action_response_to": action, "status": "error", "message": "Server ID not provided or invalid."}
-
-                    target_server_id = None
-                    if server_id_to_query_str is not None:
-                        try:
-                            target_server_id = int(server_id_to_query_str)
-                        except ValueError:
-                            response["message"] = "Invalid server_id format. Must be a number."
-                            send_json(self.client_socket, response)
-                            continue
-                    elif self.current_server_id is not None:
-                        target_server_id = self.current_server_id
-
-                    if target_server_id is not None:
-                        server_details = database.get_server_details(target_server_id) # Fetches name, admin_user_id, etc.
-                        if not server_details:
-                            response["message"] = f"Server ID {target_server_id} not found."
-                        else:
-                            current_server_admin_id = server_details['admin_user_id'] # Get the admin ID for this server
-                            db_members = database.get_server_members(target_server_id) # List of {'user_id': X, 'username': 'name'}
-
-                            member_list_with_status = []
-                            with lock:
-                                for member_data in db_members: # Renamed to avoid conflict if member is a keyword
-                                    is_online = member_data['user_id'] in authenticated_clients
-                                    is_admin = (member_data['user_id'] == current_server_admin_id) # <<< CHECK IF ADMIN
-
-                                    member_list_with_status.append({
-                                        "user_id": member_data['user_id'],
-                                        "username": member_data['username'],
-                                        "is_online": is_online,
-                                        "is_admin": is_admin  # <<< ADD is_admin FLAG TO PAYLOAD
-                                    })
+                    member_list_with_status = build_member_roster(db_members, current_server_admin_id)
 
-                            response["status"] = "success"
-                            response["message"] = f"Retrieved members for server '{server_details['name']}'."
-                            response["data"] = {
-                                "server_id": target_server_id,
-                                "server_name": server_details['name'],
-                                "members": member_list_with_status # This list now contains the 'is_admin' flag
-                            }
-                    else:
-                        response["message"] = "You must specify a server ID or be active in a server using /server_history."
+                    response["status"] = "success"
+                    response["message"] = f"Retrieved members for server '{server_details['name']}'."
+                    response["data"] = {
+                        "server_id": target_server_id,
+                        "server_name": server_details['name'],
+                        "members": member_list_with_status # This list now contains the 'is_admin' flag
+                    }
+            else:
+                response["message"] = "You must specify a server ID or be active in a server using /server_history."
+
+            send_json(self.client_socket, response)
+            return True
+
+        # --- Server Management Actions ---
+        elif action == "CREATE_SERVER":
+            server_name = payload.get("server_name")
+            if server_name:
+                created_server_info = server_cache.create_server(server_name, self.user_id, self.username)
+                if created_server_info: # This is now a dict from create_server
+                    remember_membership(self.user_id, created_server_info['server_id'])
+                    response["status"] = "success"
+                    response["message"] = f"Server '{server_name}' created successfully."
+                    response["data"] = { # Pass the dict directly
+                        "server_id": created_server_info['server_id'],
+                        "server_name": server_name,
+                        "admin_id": self.user_id,
+                        "invite_code": created_server_info['invite_code'] # Include invite code
+                    }
+                else:
+                    response["message"] = f"Failed to create server '{server_name}'. It might already exist or database error."
+            else:
+                response["message"] = "Server name missing in payload for CREATE_SERVER."
 
-                    send_json(self.client_socket, response)
-                    continue
+        elif action == "CHALLENGE_ADMIN":
+            server_id_str = payload.get("server_id")
+            response = new_response(action, request_id)
+
+            if server_id_str is None:
+                response["message"] = "server_id is required."
+            else:
+                try:
+                    target_server_id = int(server_id_str)
+                    server_details = server_cache.get_server_details(target_server_id)
+
+                    if not server_details:
+                        response["message"] = f"Server ID {target_server_id} not found."
+                    elif not server_cache.is_user_member(self.user_id, target_server_id):
+                        response["message"] = f"You are not a member of server '{server_details['name']}'."
+                    elif self.user_id == server_details['admin_user_id']:
+                        response["message"] = "You cannot challenge yourself (you are the admin)."
+                    elif database.get_active_challenge_for_server(target_server_id):
+                        response["message"] = f"An active challenge already exists in server '{server_details['name']}'."
+                    else:
+                        admin_user_id_to_challenge = server_details['admin_user_id']
+                        admin_username_to_challenge = server_details['admin_username'] # From get_server_details
 
-                # --- Server Management Actions ---
-                elif action == "CREATE_SERVER":
-                    server_name = payload.get("server_name")
-                    if server_name:
-                        created_server_info = database.create_server(server_name, self.user_id)
-                        if created_server_info: # This is now a dict from create_server
+                        challenge_id = database.create_challenge(target_server_id, self.user_id, admin_user_id_to_challenge)
+                        if challenge_id:
                             response["status"] = "success"
-                            response["message"] = f"Server '{server_name}' created successfully."
-                            response["data"] = { # Pass the dict directly
-                                "server_id": created_server_info['server_id'],
-                                "server_name": server_name,
-                                "admin_id": self.user_id,
-                                "invite_code": created_server_info['invite_code'] # Include invite code
-                            }
+                            response["message"] = (f"Challenge initiated against admin {admin_username_to_challenge} "
+                                                   f"in server '{server_details['name']}'. Waiting for admin to accept. Challenge ID: {challenge_id}")
+                            response["data"] = {"challenge_id": challenge_id, "server_name": server_details['name']}
+
+                            # Broadcast notification to the server
+                            broadcast_challenge_message_to_server(
+                                target_server_id,
+                                server_details['name'],
+                                (f"{self.username} has challenged Admin {admin_username_to_challenge}! "),
+                                response,
+                                self.client_socket
+                            )
                         else:
-                            response["message"] = f"Failed to create server '{server_name}'. It might already exist or database error."
+                            response["message"] = "Failed to create challenge (database error or active challenge exists)."
+                except ValueError:
+                    response["message"] = "Invalid server_id format."
+                except Exception as e_chal:
+                    logger.error("Exception in CHALLENGE_ADMIN: %s", e_chal)
+                    response["message"] = f"An unexpected error occurred: {e_chal}"
+
+            send_json(self.client_socket, response)
+            return True
+
+        elif action == "LIST_ALL_SERVERS":
+            all_servers = database.get_all_servers() # This function now returns admin_username too
+            response["status"] = "success"
+            response["message"] = "Retrieved all servers."
+            response["data"] = {"servers": all_servers}
+
+        elif action == "LIST_MY_SERVERS":
+            my_servers = database.get_user_servers(self.user_id) # This now returns invite_code too
+            response["status"] = "success"
+            response["message"] = "Retrieved your servers."
+            response["data"] = {"servers": my_servers} # my_servers now contains invite_code
+            send_json(self.client_socket, response)
+            return True
+
+        elif action == "LOGIN_BOOTSTRAP":
+            # Servers + latest history page + member roster for each, in one round trip
+            try:
+                history_limit = int(payload.get("history_limit", database.MESSAGE_HISTORY_PAGE_SIZE))
+            except (ValueError, TypeError):
+                history_limit = database.MESSAGE_HISTORY_PAGE_SIZE
+            bootstrap_servers = database.get_login_bootstrap(self.user_id, history_limit)
+            if bootstrap_servers is None:
+                response["message"] = "Could not load your servers."
+            else:
+                for server_item in bootstrap_servers:
+                    server_item["members"] = build_member_roster(server_item["members"], server_item["admin_user_id"])
+                response["status"] = "success"
+                response["message"] = f"Loaded {len(bootstrap_servers)} servers."
+                response["data"] = {"servers": bootstrap_servers}
+            send_json(self.client_socket, response)
+            return True
+
+        elif action == "JOIN_SERVER":
+            invite_code_to_join = payload.get("invite_code")
+            response = new_response(action, request_id)
+            join_server(self.client_socket, response, self.user_id, self.username, invite_code_to_join)
+
+        elif action == "LEAVE_SERVER":
+            server_id_to_leave_str = payload.get("server_id")
+            # Initialize response with action_response_to for proper client handling
+            response = new_response(action, request_id, message="Could not process leave request.")
+
+            if server_id_to_leave_str is not None:
+                try:
+                    server_id_to_leave = int(server_id_to_leave_str)
+                    server_details = server_cache.get_server_details(server_id_to_leave)
+
+                    if not server_details:
+                        response["message"] = f"Server ID {server_id_to_leave} not found."
                     else:
-                        response["message"] = "Server name missing in payload for CREATE_SERVER."
+                        server_name_for_messages = server_details.get('name')
 
-                elif action == "CHALLENGE_ADMIN":
-                    server_id_str = payload.get("server_id")
-                    response = {"action_response_to": action, "status": "error"}
+                        if server_name_for_messages is None:
+                            logger.error("Server details for ID %s fetched but 'name' key is missing or None. Details: %s", server_id_to_leave, server_details)
+                            response["message"] = f"Internal error retrieving details for server ID {server_id_to_leave}."
+                        else:
+                            leave_result = server_cache.remove_user_from_server(self.user_id, server_id_to_leave)
+                            forget_membership(self.user_id, server_id_to_leave, leave_result.get("status"))
+
+                            # Update response based on leave_result
+                            response["status"] = leave_result.get("status", "ERROR") # Default to ERROR if status missing
+
+                            response_message_for_client = f"Processed leaving server '{server_name_for_messages}'. Status: {response['status']}" # Default
+                            # Customize messages based on specific statuses from remove_user_from_server
+                            if leave_result["status"] == "SUCCESS_LEFT":
+                                response_message_for_client = f"You have left server '{server_name_for_messages}'."
+                                broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"{self.username} left the server.", response, self.client_socket)
+                            elif leave_result["status"] == "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED":
+                                new_admin_info = leave_result.get("data", {})
+                                new_admin_username = new_admin_info.get("new_admin_username", "A new user")
+                                response_message_for_client = f"You have left server '{server_name_for_messages}'. {new_admin_username} is the new admin."
+                                broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"{self.username} left the server.", response, self.client_socket)
+                                broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"New admin is {new_admin_username}.", response, self.client_socket)
+                            elif leave_result["status"] == "SUCCESS_ADMIN_LEFT_SERVER_DELETED":
+                                response_message_for_client = f"You have left server '{server_name_for_messages}'. The server has been deleted."
+                            elif leave_result["status"] == "NOT_MEMBER":
+                                response_message_for_client = f"You are not a member of server '{server_name_for_messages}'."
+                            elif leave_result["status"] == "ERROR_FAILED_TO_ASSIGN_NEW_ADMIN":
+                                response_message_for_client = f"You left as admin from '{server_name_for_messages}', but a new admin could not be assigned."
+                            elif leave_result["status"] == "ERROR":
+                                error_detail_db = leave_result.get("data", {}).get("details", "Database operation failed.")
+                                response_message_for_client = f"Failed to leave server '{server_name_for_messages}'. Detail: {error_detail_db}"
+
+                            response["message"] = response_message_for_client
+                except ValueError:
+                    response["message"] = "Invalid server_id format for LEAVE_SERVER."
+                except Exception as e_leave: # Catch any other unexpected error in this block
+                    logger.exception("Unexpected Exception in LEAVE_SERVER for %s: %s", self.username, e_leave)
+                    response["message"] = f"An unexpected error occurred while trying to leave the server: {e_leave}"
+                    # Ensure status is error if not already set by a more specific condition
+                    response["status"] = "error"
 
-                    if server_id_str is None:
-                        response["message"] = "server_id is required."
+            else: # server_id_to_leave_str was None
+                response["message"] = "server_id missing in payload for LEAVE_SERVER."
+
+            send_json(self.client_socket, response)
+            return True
+
+        elif action == "SERVER_HISTORY":
+            server_id_str = payload.get("server_id")
+            if server_id_str is None:
+                response["message"] = "server_id is required for SERVER_HISTORY."
+            else:
+                try:
+                    target_server_id = int(server_id_str)
+                    # Optional keyset cursors; without them this is the latest page
+                    before_message_id = payload.get("before_message_id")
+                    after_message_id = payload.get("after_message_id")
+                    before_message_id = int(before_message_id) if before_message_id is not None else None
+                    after_message_id = int(after_message_id) if after_message_id is not None else None
+                    page_size = int(payload.get("limit", database.MESSAGE_HISTORY_PAGE_SIZE))
+                    if server_cache.is_user_member(self.user_id, target_server_id): # Check membership
+                        server_details = server_cache.get_server_details(target_server_id)
+                        server_name = server_details.get('name', 'Unknown Server') if server_details else 'Unknown Server'
+                        page_messages, has_more = database.get_message_page(
+                            target_server_id, before_message_id=before_message_id,
+                            after_message_id=after_message_id, limit=page_size
+                        )
+
+                        response["status"] = "success"
+                        response["message"] = f"Message history for server '{server_name}'."
+                        response["data"] = {
+                            "server_id": target_server_id,
+                            "server_name": server_name,
+                            "messages": page_messages,
+                            "before_message_id": before_message_id,
+                            "after_message_id": after_message_id,
+                            "has_more": has_more
+                        }
+                        self.current_server_id = target_server_id # <<< SET Current Server ID
                     else:
-                        try:
-                            target_server_id = int(server_id_str)
-                            server_details = database.get_server_details(target_server_id)
-
-                            if not server_details:
-                                response["message"] = f"Server ID {target_server_id} not found."
-                            elif not database.is_user_member(self.user_id, target_server_id):
-                                response["message"] = f"You are not a member of server '{server_details['name']}'."
-                            elif self.user_id == server_details['admin_user_id']:
-                                response["message"] = "You cannot challenge yourself (you are the admin)."
-                            elif database.get_active_challenge_for_server(target_server_id):
-                                response["message"] = f"An active challenge already exists in server '{server_details['name']}'."
-                            else:
-                                admin_user_id_to_challenge = server_details['admin_user_id']
-                                admin_username_to_challenge = server_details['admin_username'] # From get_server_details
-
-                                challenge_id = database.create_challenge(target_server_id, self.user_id, admin_user_id_to_challenge)
-                                if challenge_id:
-                                    response["status"] = "success"
-                                    response["message"] = (f"Challenge initiated against admin {admin_username_to_challenge} "
-                                                           f"in server '{server_details['name']}'. Waiting for admin to accept. Challenge ID: {challenge_id}")
-                                    response["data"] = {"challenge_id": challenge_id, "server_name": server_details['name']}
-
-                                    # Broadcast notification to the server
-                                    broadcast_challenge_message_to_server(
-                                        target_server_id,
-                                        server_details['name'],
-                                        (f"{self.username} has challenged Admin {admin_username_to_challenge}! "),
-                                        response,
-                                        self.client_socket
-                                    )
-                                else:
-                                    response["message"] = "Failed to create challenge (database error or active challenge exists)."
-                        except ValueError:
-                            response["message"] = "Invalid server_id format."
-                        except Exception as e_chal:
-                            print(f"DEBUG: [{thread_name}] Exception in CHALLENGE_ADMIN: {e_chal}")
-                            response["message"] = f"An unexpected error occurred: {e_chal}"
+                        response["message"] = f"You are not a member of server ID {target_server_id} or it does not exist."
+                except (ValueError, TypeError):
+                    response["message"] = "Invalid server_id, cursor or limit format for SERVER_HISTORY."
+            send_json(self.client_socket, response)
+            return True
 
-                    send_json(self.client_socket, response)
-                    continue
+        else: # Default case for unknown actions during an authenticated session
+            response["message"] = f"Unknown or unsupported action: {action}"
 
-                elif action == "LIST_ALL_SERVERS":
-                    all_servers = database.get_all_servers() # This function now returns admin_username too
-                    response["status"] = "success"
-                    response["message"] = "Retrieved all servers."
-                    response["data"] = {"servers": all_servers}
+        # Send the determined response back to the client for most actions
+        if action not in ["SEND_CHAT_MESSAGE", "DISCONNECT", "JOIN_SERVER", "LEAVE_SERVER", "ACCEPT_CHALLENGE", "JOIN_CHALLENGE", "CHALLENGE_ADMIN", "KICK_USER", "SERVER_HISTORY", "GET_SERVER_MEMBERS"]: # <<< Update list
+            send_json(self.client_socket, response)
 
-                elif action == "LIST_MY_SERVERS":
-                    my_servers = database.get_user_servers(self.user_id) # This now returns invite_code too
-                    response["status"] = "success"
-                    response["message"] = "Retrieved your servers."
-                    response["data"] = {"servers": my_servers} # my_servers now contains invite_code
-                    send_json(self.client_socket, response)
-                    continue
+        return True
 
-                elif action == "JOIN_SERVER":
-                    invite_code_to_join = payload.get("invite_code")
-                    response = {"action_response_to": action, "status": "error"}
-                    join_server(self.client_socket, response, self.user_id, self.username, invite_code_to_join)
+    def end_session(self):
+        """Removes the user from the online list, notifies the others and closes the socket."""
+        logger.info("Ending session for User %s", self.username)
+        self.running = False
+        with lock:
+            if self.user_id in authenticated_clients:
+                del authenticated_clients[self.user_id]
+            # Kill any game process started by this user (if any logic depends on it)
+            # This part is tricky - usually only admins start games. Let's skip auto-kill for now.
+        server_ids = presence_roster.user_offline(self.user_id)
+        presence_coalescer.publish(self.user_id, self.username, False, server_ids)
+        publish_presence(self.user_id, self.username, False, server_ids)
+        presence_registry.release(self.user_id, node_id)
+        if RESUME_TOKEN_TTL > 0 and not self.logged_out: # Resumable for RESUME_TOKEN_TTL from now
+            database.extend_resume_tokens(self.user_id, int(time.time()) + RESUME_TOKEN_TTL)
+        try:
+            self.client_socket.close()
+        except Exception as e_close:
+             logger.warning("Exception during socket close for %s: %s", self.username, e_close)
 
-                elif action == "LEAVE_SERVER":
-                    server_id_to_leave_str = payload.get("server_id")
-                    # Initialize response with action_response_to for proper client handling
-                    response = {"action_response_to": action, "status": "error", "message": "Could not process leave request."}
 
-                    if server_id_to_leave_str is not None:
-                        try:
-                            server_id_to_leave = int(server_id_to_leave_str)
-                            server_details = database.get_server_details(server_id_to_leave)
+class ClientThread(ClientSession, threading.Thread):
+    def __init__(self, client_socket, addr, user_id, username):
+        threading.Thread.__init__(self)
+        ClientSession.__init__(self, client_socket, addr, user_id, username)
+        self.pipeline = RequestPipeline(pipeline_executor) if pipeline_executor is not None else None
 
-                            if not server_details:
-                                response["message"] = f"Server ID {server_id_to_leave} not found."
-                            else:
-                                server_name_for_messages = server_details.get('name')
-
-                                if server_name_for_messages is None:
-                                    print(f"CRITICAL SERVER ERROR: Server details for ID {server_id_to_leave} fetched but 'name' key is missing or None. Details: {server_details}")
-                                    response["message"] = f"Internal error retrieving details for server ID {server_id_to_leave}."
-                                else:
-                                    leave_result = database.remove_user_from_server(self.user_id, server_id_to_leave)
-
-                                    # Update response based on leave_result
-                                    response["status"] = leave_result.get("status", "ERROR") # Default to ERROR if status missing
-
-                                    response_message_for_client = f"Processed leaving server '{server_name_for_messages}'. Status: {response['status']}" # Default
-                                    # Customize messages based on specific statuses from remove_user_from_server
-                                    if leave_result["status"] == "SUCCESS_LEFT":
-                                        response_message_for_client = f"You have left server '{server_name_for_messages}'."
-                                        broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"{self.username} left the server.", response, self.client_socket)
-                                    elif leave_result["status"] == "SUCCESS_ADMIN_LEFT_NEW_ADMIN_ASSIGNED":
-                                        new_admin_info = leave_result.get("data", {})
-                                        new_admin_username = new_admin_info.get("new_admin_username", "A new user")
-                                        response_message_for_client = f"You have left server '{server_name_for_messages}'. {new_admin_username} is the new admin."
-                                        broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"{self.username} left the server.", response, self.client_socket)
-                                        broadcast_system_message_to_server(server_id_to_leave, server_name_for_messages, f"New admin is {new_admin_username}.", response, self.client_socket)
-                                    elif leave_result["status"] == "SUCCESS_ADMIN_LEFT_SERVER_DELETED":
-                                        response_message_for_client = f"You have left server '{server_name_for_messages}'. The server has been deleted."
-                                    elif leave_result["status"] == "NOT_MEMBER":
-                                        response_message_for_client = f"You are not a member of server '{server_name_for_messages}'."
-                                    elif leave_result["status"] == "ERROR_FAILED_TO_ASSIGN_NEW_ADMIN":
-                                        response_message_for_client = f"You left as admin from '{server_name_for_messages}', but a new admin could not be assigned."
-                                    elif leave_result["status"] == "ERROR":
-                                        error_detail_db = leave_result.get("data", {}).get("details", "Database operation failed.")
-                                        response_message_for_client = f"Failed to leave server '{server_name_for_messages}'. Detail: {error_detail_db}"
-
-                                    response["message"] = response_message_for_client
-                        except ValueError:
-                            response["message"] = "Invalid server_id format for LEAVE_SERVER."
-                        except Exception as e_leave: # Catch any other unexpected error in this block
-                            print(f"DEBUG: [{thread_name}] Unexpected Exception in LEAVE_SERVER for {self.username}: {e_leave}")
-                            response["message"] = f"An unexpected error occurred while trying to leave the server: {e_leave}"
-                            # Ensure status is error if not already set by a more specific condition
-                            response["status"] = "error"
-
-                    else: # server_id_to_leave_str was None
-                        response["message"] = "server_id missing in payload for LEAVE_SERVER."
+    def run(self):
+        logger.debug("ClientThread.run started for User: %s (ID: %s)", self.username, self.user_id)
 
-                    send_json(self.client_socket, response)
-                    continue
+        self.announce_join()
 
-                elif action == "SERVER_HISTORY":
-                    server_id_str = payload.get("server_id")
-                    if server_id_str is None:
-                        response["message"] = "server_id is required for SERVER_HISTORY."
-                    else:
-                        try:
-                            target_server_id = int(server_id_str)
-                            if database.is_user_member(self.user_id, target_server_id): # Check membership
-                                server_details = database.get_server_details(target_server_id)
-                                server_name = server_details.get('name', 'Unknown Server') if server_details else 'Unknown Server'
-                                recent_messages = database.get_messages_for_server(target_server_id, limit=50)
+        try:
+            while self.running:
+                logger.debug("ClientThread for User %s waiting for JSON...", self.username)
+                request_data = receive_json(self.client_socket)
 
-                                response["status"] = "success"
-                                response["message"] = f"Message history for server '{server_name}'."
-                                response["data"] = {
-                                    "server_id": target_server_id,
-                                    "server_name": server_name,
-                                    "messages": recent_messages
-                                }
-                                self.current_server_id = target_server_id # <<< SET Current Server ID
-                            else:
-                                response["message"] = f"You are not a member of server ID {target_server_id} or it does not exist."
-                        except ValueError:
-                            response["message"] = "Invalid server_id format for SERVER_HISTORY."
-                    send_json(self.client_socket, response)
+                if request_data is None:
+                    logger.debug("User %s (ID: %s) disconnected or bad data.", self.username, self.user_id)
+                    self.running = False
+                    break
+                self.last_received = time.monotonic()
+
+                if not self.admit(request_data):
+                    if self.read_backoff:
+                        time.sleep(self.read_backoff)
                     continue
 
-                else: # Default case for unknown actions during an authenticated session
-                    response["message"] = f"Unknown or unsupported action: {action}"
+                if self.pipeline is not None:
+                    if is_pipelined_request(request_data):
+                        self.pipeline.submit(self.handle_request, request_data)
+                        continue
+                    self.pipeline.wait_idle() # Writes and untagged requests run after in-flight reads
 
-                # Send the determined response back to the client for most actions
-                if action not in ["SEND_CHAT_MESSAGE", "DISCONNECT", "JOIN_SERVER", "LEAVE_SERVER", "ACCEPT_CHALLENGE", "JOIN_CHALLENGE", "CHALLENGE_ADMIN", "KICK_USER", "SERVER_HISTORY", "GET_SERVER_MEMBERS"]: # <<< Update list
-                    send_json(self.client_socket, response)
+                if not self.handle_request(request_data):
+                    self.running = False
+                    break
 
         except Exception as e:
-            print(f"DEBUG: [{thread_name}] General Exception in ClientThread.run for {self.username}: {e}")
+            logger.exception("General Exception in ClientThread.run for %s: %s", self.username, e)
             self.running = False
         finally:
-            print(f"DEBUG: [{thread_name}] **Executing finally block in ClientThread for User {self.username}**")
-            with lock:
-                if self.user_id in authenticated_clients:
-                    del authenticated_clients[self.user_id]
-                leave_broadcast = {
-                    "type": "USER_LEFT",
-                    "payload": {"username": self.username, "user_id": self.user_id, "timestamp": int(time.time())}
-                }
-                # Kill any game process started by this user (if any logic depends on it)
-                # This part is tricky - usually only admins start games. Let's skip auto-kill for now.
-
-                for target_user_id_final, client_info_final in authenticated_clients.items(): # Corrected variable names
-                    send_json(client_info_final['socket'], leave_broadcast)
-            try:
-                self.client_socket.close()
-            except Exception as e_close:
-                 print(f"DEBUG: [{thread_name}] Exception during socket close for {self.username}: {e_close}")
-            print(f"DEBUG: [{thread_name}] ClientThread for {self.username} finished.")
+            logger.debug("Executing finally block in ClientThread for User %s", self.username)
+            if self.pipeline is not None:
+                self.pipeline.wait_idle()
+            self.end_session()
+            logger.debug("ClientThread for %s finished.", self.username)
+
+
+
+# --- Admission control ---
+# A new connection enters the auth phase only while fewer than
+# AUTH_WORKERS + AUTH_QUEUE_SIZE handshakes are in progress, and fewer than
+# AUTH_MAX_PER_IP from its address. Otherwise it gets error SERVER_BUSY and is
+# closed before any thread is spent on it. In threaded mode the admitted
+# connections are authenticated by a pool of AUTH_WORKERS threads, and the rest
+# wait in the pool's queue. In both modes a connection that has not logged in
+# within AUTH_DEADLINE seconds of being accepted is closed. Password hashing
+# and checks run on a PasswordHasher (passwords.py): the auth threads only wait
+# on its worker processes.
+LISTEN_BACKLOG = 128 # Connections the kernel queues before accept() (capped by net.core.somaxconn)
+AUTH_WORKERS = 32 # Threads running the auth phase (threaded mode)
+AUTH_QUEUE_SIZE = 256 # Admitted connections waiting for an auth worker
+AUTH_MAX_PER_IP = 32 # Handshakes in progress from one IP address
+AUTH_DEADLINE = 10.0 # Seconds from accept() to a successful LOGIN
+auth_executor = None # ThreadPoolExecutor created by init_server
+PASSWORD_HASH_WORKERS = passwords.PASSWORD_HASH_WORKERS # Hashing processes; 0 hashes on the auth threads
+password_hasher = passwords.PasswordHasher(0) # Replaced by start_password_hasher() in init_server/init_async_server
+
+def start_password_hasher():
+    global password_hasher
+    password_hasher = passwords.PasswordHasher(PASSWORD_HASH_WORKERS)
+
+def stop_password_hasher():
+    password_hasher.close()
+
+class AdmissionControl:
+    """Handshakes in progress, overall and per IP address, and how they ended. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending_by_ip = collections.Counter()
+        self.pending = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.authenticated = 0
+
+    def admit(self, ip):
+        """Starts a handshake from ip. Returns None if admitted, otherwise the reason for turning it away."""
+        with self._lock:
+            if self.pending >= AUTH_WORKERS + AUTH_QUEUE_SIZE:
+                reason = "Too many connections are logging in. Try again later."
+            elif self._pending_by_ip[ip] >= AUTH_MAX_PER_IP:
+                reason = "Too many connections from your address are logging in. Try again later."
+            else:
+                self.pending += 1
+                self._pending_by_ip[ip] += 1
+                self.accepted += 1
+                return None
+            self.rejected += 1
+            return reason
+
+    def finish(self, ip, outcome):
+        """Ends a handshake started by admit(); outcome is "authenticated", "timed_out" or "closed"."""
+        with self._lock:
+            self.pending -= 1
+            self._pending_by_ip[ip] -= 1
+            if not self._pending_by_ip[ip]:
+                del self._pending_by_ip[ip]
+            if outcome == "authenticated":
+                self.authenticated += 1
+            elif outcome == "timed_out":
+                self.timed_out += 1
+
+    def log_summary(self):
+        logger.info("Handshakes: %s accepted, %s rejected, %s timed out, %s logged in.",
+                    self.accepted, self.rejected, self.timed_out, self.authenticated)
+
+admission_control = AdmissionControl()
+
+def rejection_frame(reason):
+    return encode_frame({"status": "error", "error": "SERVER_BUSY", "message": reason})
+
+def reject_connection(sock, reason):
+    """Tells a connection turned away by admission control why, without ever blocking the accept loop."""
+    try:
+        sock.setblocking(False)
+        sock.send(rejection_frame(reason))
+    except OSError:
+        pass
+    sock.close()
+
+
+# --- Resumable sessions ---
+# LOGIN also returns a resume token. A client that lost its connection can send
+# RESUME instead of LOGIN, with the token and the newest message_id it holds for
+# each server, and gets back only what it missed: newer messages, membership and
+# admin events (see database.get_resume_delta), servers it was added to or
+# removed from, and who is online now. A token works once: every RESUME reply
+# carries the next one. Tokens expire RESUME_TOKEN_TTL seconds after the session
+# ends, and DISCONNECT revokes them. If the server has not noticed the old
+# connection drop yet, RESUME closes that session (here or on another node) and
+# waits up to RESUME_TAKEOVER_TIMEOUT for it to end.
+RESUME_TOKEN_TTL = 24 * 3600 # Seconds; 0 turns resume tokens off
+RESUME_TAKEOVER_TIMEOUT = 3.0 # Seconds RESUME waits for the session it replaces to end
+
+def issue_resume_token(user_id):
+    """Stores a new resume token for user_id and returns it (None if tokens are off or it could not be stored)."""
+    if RESUME_TOKEN_TTL <= 0:
+        return None
+    token, token_hash = passwords.new_resume_token()
+    if not database.add_resume_token(token_hash, user_id, int(time.time()) + RESUME_TOKEN_TTL):
+        return None
+    return token
+
+def parse_resume_positions(servers):
+    """RESUME's "servers" payload, {server_id: newest message_id held}, with int or string keys -> {int: int}."""
+    if not isinstance(servers, dict):
+        raise ValueError("servers must map server_id to a message_id")
+    return {int(server_id): int(message_id or 0) for server_id, message_id in servers.items()}
+
+def end_stale_session(user_id):
+    """Closes the user's session wherever it is connected; its read loop then ends it as usual."""
+    with lock:
+        client_info = authenticated_clients.get(user_id)
+    if client_info is not None:
+        client_info['session'].client_socket.abort()
+    else:
+        message_bus_client.publish({"kind": "end_session", "user_id": user_id})
+
+def take_over_session(user_id):
+    """Claims user_id's session for a RESUME, ending the old session first if it is still open.
 
+    False if the old session did not end within RESUME_TAKEOVER_TIMEOUT.
+    """
+    deadline = time.monotonic() + RESUME_TAKEOVER_TIMEOUT
+    ending = False
+    while True:
+        with lock:
+            online = user_id in authenticated_clients or user_id in remote_users
+        if not online and presence_registry.claim(user_id, node_id):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        if not ending:
+            logger.info("Closing the previous session of user %s, which is being resumed.", user_id)
+            end_stale_session(user_id)
+            ending = True
+        time.sleep(0.05)
+
+
+def process_auth_request(client_socket, addr, request_data):
+    """Handles one HELLO/REGISTER/LOGIN request from an unauthenticated connection.
+
+    Sends the response itself and returns (user_id, username, None) once a LOGIN
+    succeeds, or None if the connection should stay in the auth phase. A
+    successful RESUME returns (user_id, username, resume): its reply is sent by
+    ClientSession.complete_resume(resume) once the session is registered, so
+    nothing that happens in between is missed.
+    client_socket must carry .codec/.compressor (QueuedSocket/AsyncSocketAdapter),
+    which HELLO switches after its reply has been encoded.
+    """
+
+    if traffic_logging_wanted("RECEIVED_FROM_CLIENT"): # Check before calling log function
+        # For unauthenticated phase, user_details might be None or just basic
+        log_traffic("RECEIVED_FROM_CLIENT", addr, None, request_data)
+
+    logger.debug("Received %s from %s during auth", request_data.get("action"), addr) # Payload holds the password
+
+    action = request_data.get("action")
+    payload = request_data.get("payload", {})
+    response = new_response(action, request_data.get("request_id"), status=None) # Base for response
+
+    if action == "HELLO":
+        codec = protocol.choose_codec(payload.get("codecs"))
+        compressor = protocol.choose_compressor(payload.get("compression"), payload.get("dictionary"),
+                                                compression_dictionary, COMPRESSION_MIN_BYTES)
+        response["status"] = "success"
+        response["message"] = f"Using {codec.name} framing{f' with {compressor.name} compression' if compressor else ''}."
+        response["data"] = {
+            "codec": codec.name,
+            "codecs": protocol.available_codec_names(),
+            "compression": compressor.name if compressor else None,
+            "dictionary": compressor.dictionary.id if compressor and compressor.dictionary else None
+        }
+        send_json(client_socket, response) # Encoded with the old settings, so the reply is always readable
+        client_socket.codec = codec
+        client_socket.compressor = compressor
+
+    elif action == "REGISTER":
+        username = payload.get("username")
+        password = payload.get("password")
+        if not username or not password:
+            response["status"] = "error"
+            response["message"] = "Username and password required for registration."
+        elif database.add_user(username, password_hasher.hash(password)):
+            response["status"] = "success"
+            response["message"] = "Registration successful. Please login."
+        else:
+            response["status"] = "error"
+            response["message"] = "Registration failed. Username may be taken or server error."
+        AUTH_ATTEMPTS.labels(action, response["status"]).inc()
+        send_json(client_socket, response)
 
+    elif action == "LOGIN":
+        username = payload.get("username")
+        password = payload.get("password")
+        if not username or not password:
+            response["status"] = "error"
+            response["message"] = "Username and password required for login."
+            AUTH_ATTEMPTS.labels(action, "error").inc()
+            send_json(client_socket, response)
+            return None # Allow retry
+
+        credentials = server_cache.get_credentials(username)
+        matched, upgraded_hash = password_hasher.verify(password, credentials[1] if credentials else None)
+        auth_user_id = credentials[0] if matched else None
+        if upgraded_hash:
+            server_cache.set_password_hash(auth_user_id, username, upgraded_hash)
+            logger.info("Upgraded the stored password of user '%s' to a salted hash.", username)
+        if auth_user_id:
+            with lock:
+                online_elsewhere = auth_user_id in remote_users
+            # Check if already logged in, here or on another node. The registry claim is atomic
+            # (cluster-wide with Redis) and is released by ClientSession.end_session.
+            if online_elsewhere or not presence_registry.claim(auth_user_id, node_id):
+                response["status"] = "error"
+                response["message"] = "User already logged in elsewhere."
+                AUTH_ATTEMPTS.labels(action, "already_logged_in").inc()
+                send_json(client_socket, response)
+                return None # Allow retry with different credentials or client can decide to quit
 
-def handle_client(client_socket, addr):
-    thread_name = threading.current_thread().name
-    print(f"DEBUG: [{thread_name}] handle_client started for {addr}")
-    socket_handed_off = False
+            response["status"] = "success"
+            response["message"] = f"Welcome {username}!"
+            response["data"] = {"user_id": auth_user_id, "username": username,
+                                "resume_token": issue_resume_token(auth_user_id), "resume_token_ttl": RESUME_TOKEN_TTL}
+            AUTH_ATTEMPTS.labels(action, "success").inc()
+            send_json(client_socket, response)
+            return auth_user_id, username, None
+        else:
+            response["status"] = "error"
+            response["message"] = "Invalid username or password."
+            AUTH_ATTEMPTS.labels(action, "invalid_credentials").inc()
+            send_json(client_socket, response)
 
-    try:
-        while not socket_handed_off: # Loop only for authentication phase
-            print(f"DEBUG: [{thread_name}] handle_client for {addr} waiting for auth JSON...")
-            request_data = receive_json(client_socket)
+    elif action == "RESUME":
+        token = payload.get("resume_token")
+        try:
+            last_seen = parse_resume_positions(payload.get("servers", {}))
+            history_limit = int(payload.get("history_limit", database.MESSAGE_HISTORY_PAGE_SIZE))
+        except (ValueError, TypeError):
+            response["status"] = "error"
+            response["message"] = "servers must map each server_id to the newest message_id you have."
+            AUTH_ATTEMPTS.labels(action, "error").inc()
+            send_json(client_socket, response)
+            return None
 
-            if request_data is None: # Connection closed or error
-                print(f"DEBUG: [{thread_name}] Client {addr} disconnected or bad data during auth.")
-                break # Exit auth loop, connection will be closed in finally
+        token_hash = passwords.hash_resume_token(token) if RESUME_TOKEN_TTL > 0 and isinstance(token, str) else None
+        token_user = database.get_resume_token_user(token_hash) if token_hash else None
+        if token_user is None:
+            response["status"] = "error"
+            response["error"] = "RESUME_REJECTED"
+            response["message"] = "This session can no longer be resumed. Please log in."
+            AUTH_ATTEMPTS.labels(action, "invalid_credentials").inc()
+            send_json(client_socket, response)
+            return None
 
-            if mongodb_logging_active: # Check before calling log function
-                # For unauthenticated phase, user_details might be None or just basic
-                log_to_mongodb("RECEIVED_FROM_CLIENT", addr, None, request_data)
+        auth_user_id, username = token_user
+        if not take_over_session(auth_user_id):
+            response["status"] = "error"
+            response["message"] = "User already logged in elsewhere."
+            AUTH_ATTEMPTS.labels(action, "already_logged_in").inc()
+            send_json(client_socket, response)
+            return None
+        new_token, new_token_hash = passwords.new_resume_token()
+        if not database.replace_resume_token(token_hash, new_token_hash, auth_user_id, int(time.time()) + RESUME_TOKEN_TTL):
+            presence_registry.release(auth_user_id, node_id) # Another connection used the token first
+            response["status"] = "error"
+            response["error"] = "RESUME_REJECTED"
+            response["message"] = "This session can no longer be resumed. Please log in."
+            AUTH_ATTEMPTS.labels(action, "invalid_credentials").inc()
+            send_json(client_socket, response)
+            return None
+        AUTH_ATTEMPTS.labels(action, "success").inc()
+        return auth_user_id, username, {"request_id": response.get("request_id"), "resume_token": new_token,
+                                        "last_seen": last_seen, "history_limit": history_limit}
 
-            print(f"DEBUG: [{thread_name}] Received from {addr} for auth: {request_data}")
+    else: # Unknown action during auth phase
+        response["status"] = "error"
+        response["message"] = f"Invalid action during auth: {action}. Expecting HELLO, REGISTER, LOGIN or RESUME."
+        send_json(client_socket, response)
 
-            action = request_data.get("action")
-            payload = request_data.get("payload", {})
-            response = {"action_response_to": action} # Base for response
+    return None
 
-            if action == "REGISTER":
-                username = payload.get("username")
-                password = payload.get("password")
-                if not username or not password:
-                    response["status"] = "error"
-                    response["message"] = "Username and password required for registration."
-                elif database.add_user(username, password):
-                    response["status"] = "success"
-                    response["message"] = "Registration successful. Please login."
-                else:
-                    response["status"] = "error"
-                    response["message"] = "Registration failed. Username may be taken or server error."
-                send_json(client_socket, response)
+def handle_client(client_socket, addr, deadline):
+    """Auth phase for one admitted connection, run on the auth pool; must log in before deadline (time.monotonic())."""
+    logger.debug("handle_client started for %s", addr)
+    socket_handed_off = False
+    outcome = "closed"
+    client_socket = QueuedSocket(client_socket, addr) # Wrapped from the start so HELLO can set its codec
+    client_socket.frame_reader.deadline = deadline # Reads only: the writer thread's sends stay blocking
 
-            elif action == "LOGIN":
-                username = payload.get("username")
-                password = payload.get("password")
-                if not username or not password:
-                    response["status"] = "error"
-                    response["message"] = "Username and password required for login."
-                    send_json(client_socket, response)
-                    continue # Allow retry
-
-                auth_user_id = database.check_user_credentials(username, password)
-                if auth_user_id:
-                    with lock: # Check if already logged in
-                        if auth_user_id in authenticated_clients:
-                            response["status"] = "error"
-                            response["message"] = "User already logged in elsewhere."
-                            send_json(client_socket, response)
-                            continue # Allow retry with different credentials or client can decide to quit
+    try:
+        while not socket_handed_off: # Loop only for authentication phase
+            if time.monotonic() >= deadline:
+                outcome = "timed_out"
+                break
+            logger.debug("handle_client for %s waiting for auth JSON...", addr)
+            request_data = receive_json(client_socket)
 
-                    response["status"] = "success"
-                    response["message"] = f"Welcome {username}!"
-                    response["data"] = {"user_id": auth_user_id, "username": username}
-                    send_json(client_socket, response)
-
-                    print(f"DEBUG: [{thread_name}] Starting ClientThread for {addr} (User: {username}, ID: {auth_user_id})")
-                    t = ClientThread(client_socket, addr, auth_user_id, username)
-                    t.start()
-                    socket_handed_off = True # Set flag
-                    print(f"DEBUG: [{thread_name}] ClientThread started. Socket handoff flag set. **Returning from handle_client.**")
-                    return # Exit handle_client
-                else:
-                    response["status"] = "error"
-                    response["message"] = "Invalid username or password."
-                    send_json(client_socket, response)
+            if request_data is None: # Connection closed, error or deadline
+                if time.monotonic() >= deadline:
+                    outcome = "timed_out"
+                logger.debug("Client %s disconnected or bad data during auth.", addr)
+                break # Exit auth loop, connection will be closed in finally
 
-            else: # Unknown action during auth phase
-                response["status"] = "error"
-                response["message"] = f"Invalid action during auth: {action}. Expecting REGISTER or LOGIN."
-                send_json(client_socket, response)
+            authenticated = process_auth_request(client_socket, addr, request_data)
+            if authenticated:
+                auth_user_id, username, resume = authenticated
+                client_socket.frame_reader.deadline = None
+                outcome = "authenticated"
+                logger.debug("Starting ClientThread for %s (User: %s, ID: %s)", addr, username, auth_user_id)
+                t = ClientThread(client_socket, addr, auth_user_id, username)
+                if resume is not None:
+                    t.complete_resume(resume)
+                t.start()
+                socket_handed_off = True # Set flag
+                logger.debug("ClientThread started. Socket handoff flag set. Returning from handle_client.")
+                return # Exit handle_client
 
             # If loop continues, it means auth wasn't successful and handed off yet.
 
     except Exception as e: # Catch-all for unexpected errors in auth loop
-        print(f"DEBUG: [{thread_name}] Exception in handle_client for {addr}: {e}")
+        logger.exception("Exception in handle_client for %s: %s", addr, e)
     finally:
-        print(f"DEBUG: [{thread_name}] **Executing finally block in handle_client for {addr}.**")
+        logger.debug("Executing finally block in handle_client for %s.", addr)
+        if outcome == "timed_out":
+            logger.info("Closing connection from %s:%s: no login within %ss.", addr[0], addr[1], AUTH_DEADLINE)
+        admission_control.finish(addr[0], outcome)
         if not socket_handed_off:
-            print(f"DEBUG: [{thread_name}] Socket NOT handed off. Closing connection for {addr} from handle_client.")
+            logger.debug("Socket NOT handed off. Closing connection for %s from handle_client.", addr)
             try:
                 client_socket.close()
             except: pass # Ignore errors on close if already closed
         else:
-            print(f"DEBUG: [{thread_name}] Socket WAS handed off. Not closing from handle_client.")
-        print(f"DEBUG: [{thread_name}] handle_client for {addr} finished execution path.")
+            logger.debug("Socket WAS handed off. Not closing from handle_client.")
+        logger.debug("handle_client for %s finished execution path.", addr)
 
 # ... (init_server and __main__ remain largely the same, ensure init_server calls the modified handle_client) ...
 # Ensure 'socket' and 'threading' are imported at the top of server.py if they were missing
 
 
-def init_server(port):
+def cleanup_game_processes():
+    """Terminates any minigame server processes still running on shutdown."""
+    with lock:
+        logger.info("Cleaning up running game processes...")
+        for challenge_id, proc in list(game_processes.items()):
+             logger.info("Terminating game process for challenge %s (PID: %s)", challenge_id, proc.pid)
+             try:
+                 proc.terminate()
+                 proc.wait(timeout=2)
+             except subprocess.TimeoutExpired:
+                 proc.kill()
+             except Exception as e_kill:
+                 logger.warning("Error terminating game process %s: %s", proc.pid, e_kill)
+
+def init_server(port, reuse_port=False):
+    global pipeline_executor, auth_executor
+    pipeline_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PIPELINE_EXECUTOR_MAX_WORKERS, thread_name_prefix="pipeline")
+    auth_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+    start_password_hasher()
+    database.start_message_writer()
+    presence_coalescer.start()
+    session_reaper.start()
+    start_metrics_server()
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Allow address reuse immediately
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        print("Socket successfully created")
+        if reuse_port: # Every worker process binds the same port; the kernel balances connections between them
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        logger.debug("Socket successfully created")
         s.bind(('0.0.0.0', port))
-        print(f"Socket binded to {port}")
-        s.listen(5) # Max 5 queued connections
-        print("Socket is listening...")
+        logger.debug("Socket binded to %s", port)
+        s.listen(LISTEN_BACKLOG)
+        logger.info("Socket is listening...")
         while True:
             client_socket, addr = s.accept()
-            print(f"Accepted new connection from {addr[0]}:{addr[1]}")
-            # Create a new thread to handle the client's authentication and subsequent communication
-            auth_thread = threading.Thread(target=handle_client, args=(client_socket, addr,))
-            auth_thread.daemon = True # Optional: allow main program to exit even if auth_threads are running
-            auth_thread.start()
+            logger.info("Accepted new connection from %s:%s", addr[0], addr[1])
+            rejection = admission_control.admit(addr[0])
+            if rejection:
+                logger.warning("Rejected connection from %s:%s: %s", addr[0], addr[1], rejection)
+                reject_connection(client_socket, rejection)
+                continue
+            configure_keepalive(client_socket)
+            # The auth pool runs the authentication phase; a successful LOGIN hands the socket to a ClientThread
+            auth_executor.submit(handle_client, client_socket, addr, time.monotonic() + AUTH_DEADLINE)
     except Exception as error:
-        print(f"Server error in init_server: {error}")
+        logger.error("Server error in init_server: %s", error)
     finally:
         if 's' in locals() and s: # Check if s was defined and is not None
             s.close()
-            print("Server socket closed.")
+            logger.info("Server socket closed.")
+        pipeline_executor.shutdown(wait=False)
+        auth_executor.shutdown(wait=False)
+        stop_password_hasher()
+        stop_metrics_server()
+        admission_control.log_summary()
+        presence_coalescer.stop()
+        session_reaper.stop()
+        # Commit any chat messages still waiting in the group-commit writer
+        database.stop_message_writer()
+        stop_traffic_logging()
         # <<< ADDED: Cleanup running game processes on server exit >>>
-        with lock:
-            print("SERVER: Cleaning up running game processes...")
-            for challenge_id, proc in list(game_processes.items()):
-                 print(f"SERVER: Terminating game process for challenge {challenge_id} (PID: {proc.pid})")
-                 try:
-                     proc.terminate()
-                     proc.wait(timeout=2)
-                 except subprocess.TimeoutExpired:
-                     proc.kill()
-                 except Exception as e_kill:
-                     print(f"SERVER: Error terminating game process {proc.pid}: {e_kill}")
+        cleanup_game_processes()
+
+
+# --- Asyncio server mode ---
+# One event loop owns every connection: framing, the auth loop and the session
+# loop are coroutines, and the request handlers (which are mostly blocking
+# SQLite calls) run on a small bounded thread pool instead of a thread per user.
+
+ASYNC_DB_EXECUTOR_MAX_WORKERS = 16 # Upper bound on threads doing blocking database work in async mode
+async_db_executor = None # ThreadPoolExecutor created by init_async_server
+
+class AsyncSocketAdapter:
+    """Socket-like wrapper around an asyncio StreamWriter.
+
+    send_json and the broadcast helpers only need sendall/getpeername/close, so
+    handing them this adapter lets code running on executor threads (or the game
+    monitor threads) write to async connections. sendall() hands the frame to
+    the event loop, which queues it in a bounded OutboundFrames; a per-connection
+    writer coroutine drains the queue, awaiting drain() so slow clients only
+    back up their own queue.
+    """
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.codec = protocol.JSON # Switched by a HELLO request during the auth phase
+        self.compressor = None # protocol.Compressor, also negotiated by HELLO
+        self.outbound = OutboundFrames()
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._writer_task = loop.create_task(self._drain())
+
+    def sendall(self, data):
+        if self._closed:
+            raise BrokenPipeError(f"Connection to {self.peername} is closed.")
+        self.loop.call_soon_threadsafe(self._enqueue, bytes(data))
+
+    def _enqueue(self, data):
+        if self._closed:
+            return
+        if not self.outbound.push(data):
+            logger.warning("Outbound queue for %s overflowed (%s frames). Disconnecting slow client.", self.peername, self.outbound.max_frames)
+            self._close_now(abort=True)
+            return
+        self._wakeup.set()
+
+    async def _drain(self):
+        try:
+            while not self._closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.outbound.frames and not self._closed:
+                    self.writer.write(self.outbound.frames.popleft())
+                    await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            logger.debug("Writer for %s stopped: %s", self.peername, e)
+            self._close_now(abort=True)
+
+    def _close_now(self, abort=False):
+        self._closed = True
+        self.outbound.frames.clear()
+        self._wakeup.set()
+        if abort:
+            self.writer.transport.abort() # close() would wait to flush to a peer that isn't reading
+        else:
+            self.writer.close() # Also ends the reader, which runs the normal disconnect path
 
+    def getpeername(self):
+        return self.peername
+
+    def abort(self):
+        """Drops the connection without flushing; the reader sees EOF and ends the session."""
+        try:
+            self.loop.call_soon_threadsafe(self._close_now, True)
+        except RuntimeError:
+            pass # Event loop already closed
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self._close_now)
+        except RuntimeError:
+            pass # Event loop already closed
+
+async def async_receive_json(reader, peername, codec=protocol.JSON, compressor=None):
+    """Coroutine counterpart of receive_json using the same !I length-prefixed framing."""
+    try:
+        len_prefix_bytes = await reader.readexactly(MSG_LENGTH_PREFIX_SIZE)
+        actual_message_length, compressed = protocol.parse_prefix(len_prefix_bytes)
+        logger.debug("Expecting %s message of length: %s%s from %s", codec.name, actual_message_length, " (compressed)" if compressed else "", peername)
+
+        if actual_message_length > protocol.MAX_FRAME_SIZE: # Same limit as receive_json
+            logger.warning("Message length %s exceeds limit from %s. Closing connection.", actual_message_length, peername)
+            return None
+
+        message_bytes = await reader.readexactly(actual_message_length)
+        request_data = protocol.decode_body(message_bytes, compressed, codec, compressor)
+        logger.debug("Received %s message from %s: %s", codec.name, peername, request_action(request_data))
+        return request_data
+
+    except asyncio.IncompleteReadError:
+        logger.debug("Connection closed by %s while expecting more data.", peername)
+        return None
+    except protocol.FrameDecodeError as de:
+        logger.warning("Failed to decode %s from %s. Error: %s", codec.name, peername, de)
+        return {"status": "error", "message": f"Malformed {codec.name.upper()} received."}
+    except Exception as e:
+        logger.exception("Critical error in async_receive_json from %s: %s", peername, e)
+        return None
+
+async def async_handle_client(reader, writer):
+    """Auth phase followed by the session loop for one connection, as a coroutine."""
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    rejection = admission_control.admit(addr[0])
+    if rejection:
+        logger.warning("Rejected connection from %s:%s: %s", addr[0], addr[1], rejection)
+        writer.write(rejection_frame(rejection))
+        writer.close()
+        return
+    deadline = loop.time() + AUTH_DEADLINE
+    handshake_outcome = None # Set once the auth phase is over
+    client_socket = AsyncSocketAdapter(loop, writer)
+    configure_keepalive(writer.get_extra_info('socket'))
+    session = None
+    in_flight = set() # Pipelined read-only requests still running for this connection
+    pipeline_slots = asyncio.Semaphore(PIPELINE_MAX_IN_FLIGHT)
+
+    def pipelined_request_done(task):
+        in_flight.discard(task)
+        pipeline_slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Exception in pipelined request from %s: %s", addr, task.exception())
+
+    logger.info("Accepted new connection from %s:%s", addr[0], addr[1])
+
+    try:
+        while session is None: # Auth phase
+            try:
+                request_data = await asyncio.wait_for(
+                    async_receive_json(reader, addr, client_socket.codec, client_socket.compressor),
+                    max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                handshake_outcome = "timed_out"
+                logger.info("Closing connection from %s:%s: no login within %ss.", addr[0], addr[1], AUTH_DEADLINE)
+                break
+            if request_data is None:
+                logger.debug("Client %s disconnected or bad data during auth.", addr)
+                break
+
+            authenticated = await loop.run_in_executor(async_db_executor, process_auth_request, client_socket, addr, request_data)
+            if authenticated:
+                auth_user_id, username, resume = authenticated
+                session = ClientSession(client_socket, addr, auth_user_id, username)
+                handshake_outcome = "authenticated"
+                if resume is not None:
+                    await loop.run_in_executor(async_db_executor, session.complete_resume, resume)
+
+        handshake_outcome = handshake_outcome or "closed"
+        admission_control.finish(addr[0], handshake_outcome)
+
+        if session:
+            await loop.run_in_executor(async_db_executor, session.announce_join)
+            while session.running:
+                request_data = await async_receive_json(reader, addr, client_socket.codec, client_socket.compressor)
+                if request_data is None:
+                    logger.debug("User %s (ID: %s) disconnected or bad data.", session.username, session.user_id)
+                    break
+                session.last_received = time.monotonic()
+                if not session.admit(request_data):
+                    if session.read_backoff:
+                        await asyncio.sleep(session.read_backoff)
+                    continue
+                if is_pipelined_request(request_data):
+                    await pipeline_slots.acquire()
+                    task = loop.run_in_executor(async_db_executor, session.handle_request, request_data)
+                    in_flight.add(task)
+                    task.add_done_callback(pipelined_request_done)
+                    continue
+                if in_flight:
+                    await asyncio.wait(in_flight) # Writes and untagged requests run after in-flight reads
+                if not await loop.run_in_executor(async_db_executor, session.handle_request, request_data):
+                    break
+
+    except Exception as e:
+        logger.exception("Exception while serving %s: %s", addr, e)
+    finally:
+        if handshake_outcome is None: # Failed during the auth phase
+            admission_control.finish(addr[0], "closed")
+        if in_flight:
+            await asyncio.wait(in_flight)
+        if session:
+            await loop.run_in_executor(async_db_executor, session.end_session)
+        else:
+            client_socket.close()
+        logger.debug("Connection %s finished.", addr)
+
+async def serve_async(port, reuse_port=False):
+    server = await asyncio.start_server(async_handle_client, '0.0.0.0', port, reuse_address=True, reuse_port=reuse_port,
+                                        backlog=LISTEN_BACKLOG)
+    logger.info("Async server listening on port %s...", port)
+    async with server:
+        await server.serve_forever()
+
+def init_async_server(port, reuse_port=False):
+    """Runs the server on a single asyncio event loop instead of a thread per client."""
+    global async_db_executor
+    async_db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_DB_EXECUTOR_MAX_WORKERS, thread_name_prefix="async-db")
+    start_password_hasher()
+    database.start_message_writer()
+    presence_coalescer.start()
+    session_reaper.start()
+    start_metrics_server()
+    try:
+        asyncio.run(serve_async(port, reuse_port))
+    except KeyboardInterrupt:
+        logger.info("Interrupted, shutting down async server.")
+    except Exception as error:
+        logger.error("Server error in init_async_server: %s", error)
+    finally:
+        async_db_executor.shutdown(wait=False)
+        stop_password_hasher()
+        stop_metrics_server()
+        admission_control.log_summary()
+        presence_coalescer.stop()
+        session_reaper.stop()
+        database.stop_message_writer()
+        stop_traffic_logging()
+        cleanup_game_processes()
+
+
+def stop_on_signal(signum, frame):
+    """SIGINT/SIGTERM handler for bus nodes and --workers: the first signal stops the process like Ctrl-C,
+    later ones are ignored so the shutdown (flushing messages, stopping workers) isn't interrupted halfway."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+def run_worker(number, port, use_async, broker_path, setup_worker):
+    """Body of one forked worker: joins the message bus, then serves port like a single-process server."""
+    global METRICS_PORT
+    signal.signal(signal.SIGINT, stop_on_signal)
+    setup_worker()
+    if METRICS_PORT: # One endpoint per worker; each serves its own process's metrics
+        METRICS_PORT += number - 1
+    start_message_bus(*create_message_bus(number, broker_path))
+    try:
+        if use_async:
+            init_async_server(port, reuse_port=True)
+        else:
+            init_server(port, reuse_port=True)
+    finally:
+        stop_message_bus()
+
+def run_workers(port, worker_count, use_async, setup_worker):
+    """Forks worker_count server processes sharing port until interrupted, relaying messages between them
+    through a Unix socket broker (unless MESSAGE_BUS_TYPE says they use Redis).
+
+    setup_worker runs first thing in every worker (e.g. to open its own traffic log).
+    A worker that dies after running for a while is restarted.
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        logger.error("--workers needs fork() and SO_REUSEPORT (Linux, macOS or BSD).")
+        return
+    broker = None
+    if MESSAGE_BUS_TYPE == "unix":
+        bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+        broker = message_bus.BusBroker(os.path.join(bus_dir, "bus.sock"))
+        broker.listen()
+    database.configure_connection_pool() # Close our idle connections; every worker opens its own
+    workers = {} # pid -> (worker number, monotonic start time)
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                if broker is not None:
+                    broker.close_in_child()
+                run_worker(number, port, use_async, broker.path if broker else None, setup_worker)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception("Worker %s failed.", number)
+                exit_code = 1
+            finally:
+                server_logging.stop_logging()
+                os._exit(exit_code)
+        workers[pid] = (number, time.monotonic())
+        logger.info("Started worker %s (PID %s).", number, pid)
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    try:
+        for number in range(1, worker_count + 1):
+            spawn(number)
+        if broker is not None:
+            broker.start()
+        while workers:
+            pid, status = os.wait()
+            if pid not in workers:
+                continue
+            number, started_at = workers.pop(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+            if time.monotonic() - started_at < WORKER_RESTART_MIN_UPTIME:
+                logger.error("Worker %s exited with status %s right after starting. Shutting down.", number, exit_code)
+                break
+            logger.warning("Worker %s (PID %s) exited with status %s. Restarting it.", number, pid, exit_code)
+            spawn(number)
+    except KeyboardInterrupt:
+        logger.info("Interrupted, stopping %s workers.", len(workers))
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
+        if broker is not None:
+            broker.close()
+            shutil.rmtree(bus_dir, ignore_errors=True)
+        logger.info("All workers stopped.")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python server.py <port>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Chat.io server")
+    parser.add_argument("port", help="Port to listen on (1024-65535).")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Serve all clients from one asyncio event loop instead of a thread per client.")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT,
+                        help="Worker processes sharing the port (SO_REUSEPORT), each using its own CPU core.")
+    parser.add_argument("--bus", choices=MESSAGE_BUS_TYPES, default=None,
+                        help="How server nodes reach each other's users: inprocess (single process, the default), "
+                             "unix (default with --workers) or redis (several machines).")
+    parser.add_argument("--redis", dest="redis_address", default=REDIS_ADDRESS,
+                        help="host:port of the Redis server for --bus redis.")
+    parser.add_argument("--outbound-queue-size", type=int, default=OUTBOUND_QUEUE_MAX_FRAMES,
+                        help="Frames buffered per client before the overflow policy applies.")
+    parser.add_argument("--overflow-policy", choices=OUTBOUND_OVERFLOW_POLICIES, default=OUTBOUND_OVERFLOW_POLICY,
+                        help="What to do when a slow client's outbound queue is full.")
+    parser.add_argument("--rate-limit-user", metavar="RATE/BURST", type=rate_limit.parse_limit, default=RATE_LIMIT_USER,
+                        help="Requests per second (and burst) each user may send, all actions together.")
+    parser.add_argument("--rate-limit-action", metavar="ACTION=RATE/BURST", action="append", default=[],
+                        type=rate_limit.parse_action_limit,
+                        help="Per-user limit for one action, e.g. SEND_CHAT_MESSAGE=5/10. Repeatable.")
+    parser.add_argument("--rate-limit-server", metavar="RATE/BURST", type=rate_limit.parse_limit, default=RATE_LIMIT_SERVER_FANOUT,
+                        help="Chat messages per second (and burst) one chat server accepts from all its members together.")
+    parser.add_argument("--no-rate-limit", dest="rate_limit", action="store_false",
+                        help="Turn request rate limiting off.")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="Seconds a client may stay silent before the server pings it (0: never ping).")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="Seconds of silence after which a session is considered dead and evicted (0: never).")
+    parser.add_argument("--listen-backlog", type=int, default=LISTEN_BACKLOG,
+                        help="Connections the kernel queues before the server accepts them.")
+    parser.add_argument("--auth-workers", type=int, default=AUTH_WORKERS,
+                        help="Threads authenticating new connections (threaded mode).")
+    parser.add_argument("--auth-queue-size", type=int, default=AUTH_QUEUE_SIZE,
+                        help="New connections that may wait for an auth worker before further ones are turned away.")
+    parser.add_argument("--auth-max-per-ip", type=int, default=AUTH_MAX_PER_IP,
+                        help="Connections from one IP address that may be logging in at the same time.")
+    parser.add_argument("--auth-deadline", type=float, default=AUTH_DEADLINE,
+                        help="Seconds a new connection has to log in before it is closed.")
+    parser.add_argument("--password-workers", type=int, default=PASSWORD_HASH_WORKERS,
+                        help="Processes hashing and checking passwords (0: on the server's own threads).")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics over HTTP on this port (0: off). Worker N of --workers uses this port + N - 1.")
+    parser.add_argument("--metrics-host", default=METRICS_HOST,
+                        help="Address the metrics endpoint listens on.")
+    parser.add_argument("--resume-token-ttl", type=int, default=RESUME_TOKEN_TTL,
+                        help="Seconds after a disconnect that the session can still be resumed with RESUME (0: no resume tokens).")
+    parser.add_argument("--db", dest="database_file", default=None,
+                        help=f"SQLite database file (default: {database.DATABASE_FILE}).")
+    parser.add_argument("--traffic-log", choices=TRAFFIC_LOG_SINKS, default="mongodb",
+                        help="Where to log client traffic (MongoDB at localhost:27017, a JSON-lines file, or off).")
+    parser.add_argument("--traffic-log-file", default="message_traffic.jsonl",
+                        help="Output file for --traffic-log file.")
+    parser.add_argument("--traffic-log-level", choices=traffic_log.TRAFFIC_LOG_LEVELS, default=traffic_log.TRAFFIC_LOG_LEVEL,
+                        help="Which directions to log: everything, only requests received, or nothing.")
+    parser.add_argument("--traffic-log-sample", type=float, default=traffic_log.TRAFFIC_LOG_SAMPLE_RATE,
+                        help="Fraction of eligible messages to log (0.0-1.0).")
+    parser.add_argument("--traffic-log-queue-size", type=int, default=traffic_log.TRAFFIC_LOG_QUEUE_SIZE,
+                        help="Log entries buffered before new ones are dropped.")
+    parser.add_argument("--compression-dict", default=None,
+                        help="Shared compression dictionary offered to clients that load the same file.")
+    parser.add_argument("--compression-threshold", type=int, default=None,
+                        help=f"Smallest body, in bytes, worth compressing (default: {protocol.COMPRESSION_MIN_BYTES}, "
+                             f"or {protocol.COMPRESSION_MIN_BYTES_WITH_DICTIONARY} with a dictionary).")
+    parser.add_argument("--log-level", type=str.upper, choices=server_logging.LOG_LEVELS, default=server_logging.LOG_LEVEL,
+                        help="Minimum level logged by every module (DEBUG adds a line per request and message).")
+    parser.add_argument("--log-module-level", metavar="MODULE=LEVEL", action="append", default=[],
+                        type=server_logging.parse_module_level,
+                        help="Override the level for one module (server, database, presence, traffic_log). Repeatable.")
+    parser.add_argument("--log-format", choices=server_logging.LOG_FORMATS, default=server_logging.LOG_FORMAT,
+                        help="Plain text lines or one JSON object per line.")
+    parser.add_argument("--log-file", default=None,
+                        help="Write the log to this file instead of stderr.")
+    parser.add_argument("--log-queue-size", type=int, default=server_logging.LOG_QUEUE_SIZE,
+                        help="Log records buffered for the writer thread before new ones are dropped.")
+    args = parser.parse_args()
+    if args.bus is None:
+        args.bus = "unix" if args.workers > 1 else "inprocess"
+    elif args.bus == "unix" and args.workers < 2:
+        parser.error("--bus unix needs --workers 2 or more")
+    elif args.bus == "inprocess" and args.workers > 1:
+        parser.error("--bus inprocess cannot connect --workers; use unix or redis")
+    server_logging.configure_logging(args.log_level, args.log_module_level, args.log_format,
+                                     args.log_file, args.log_queue_size)
+    OUTBOUND_QUEUE_MAX_FRAMES = args.outbound_queue_size
+    OUTBOUND_OVERFLOW_POLICY = args.overflow_policy
+    COMPRESSION_MIN_BYTES = args.compression_threshold
+    MESSAGE_BUS_TYPE = args.bus
+    RATE_LIMIT_ENABLED = args.rate_limit
+    RATE_LIMIT_USER = args.rate_limit_user
+    RATE_LIMIT_ACTIONS.update(args.rate_limit_action)
+    RATE_LIMIT_SERVER_FANOUT = args.rate_limit_server
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    IDLE_TIMEOUT = args.idle_timeout
+    LISTEN_BACKLOG = args.listen_backlog
+    AUTH_WORKERS = args.auth_workers
+    AUTH_QUEUE_SIZE = args.auth_queue_size
+    AUTH_MAX_PER_IP = args.auth_max_per_ip
+    AUTH_DEADLINE = args.auth_deadline
+    PASSWORD_HASH_WORKERS = args.password_workers
+    RESUME_TOKEN_TTL = args.resume_token_ttl
+    METRICS_PORT = args.metrics_port
+    METRICS_HOST = args.metrics_host
+    REDIS_ADDRESS = args.redis_address
 
     try:
-        port_num = int(sys.argv[1])
+        port_num = int(args.port)
         if not (1024 <= port_num <= 65535):
             raise ValueError("Port number must be between 1024 and 65535.")
     except ValueError as e:
-        print(f"Invalid port number: {e}")
+        logger.error("Invalid port number: %s", e)
+        server_logging.stop_logging()
         sys.exit(1)
 
     # Clear console
     os.system('cls' if os.name == 'nt' else 'clear')
 
-    print("Initializing database...")
+    if args.database_file:
+        database.configure_connection_pool(database_file=args.database_file)
+    logger.info("Initializing database...")
     database.initialize_database()
+    traffic_log_settings = (args.traffic_log, args.traffic_log_file, args.traffic_log_level,
+                            args.traffic_log_sample, args.traffic_log_queue_size)
+    if args.workers <= 1: # Workers each open their own sink after the fork
+        configure_traffic_logging(*traffic_log_settings)
+    if args.compression_dict:
+        try:
+            compression_dictionary = protocol.CompressionDictionary.load(args.compression_dict)
+            logger.info("Compression dictionary %s loaded (%s bytes).", compression_dictionary.id, len(compression_dictionary.data))
+        except OSError as e:
+            logger.warning("Could not load compression dictionary: %s. Compressing without it.", e)
 
-    print(f"Starting server on port {port_num}...")
-    init_server(port_num)
\ No newline at end of file
+    try:
+        if args.workers > 1:
+            logger.info("Starting %s %sworkers on port %s...", args.workers, "async " if args.use_async else "", port_num)
+            run_workers(port_num, args.workers, args.use_async, lambda: configure_traffic_logging(*traffic_log_settings))
+        else:
+            start_message_bus(*create_message_bus())
+            try:
+                if args.use_async:
+                    logger.info("Starting async server on port %s...", port_num)
+                    init_async_server(port_num)
+                else:
+                    logger.info("Starting server on port %s...", port_num)
+                    init_server(port_num)
+            finally:
+                stop_message_bus()
+    except OSError as e: # Typically Redis unreachable for --bus redis
+        logger.error("Could not join the %s message bus: %s", args.bus, e)
+    except KeyboardInterrupt:
+        logger.info("Interrupted, server stopped.")
+    finally:
+        if server_logging.dropped_records():
+            logger.warning("%s log records were dropped because the log queue was full.", server_logging.dropped_records())
+        server_logging.stop_logging()
@@ -0,0 +1,229 @@
+# SERVER_CACHE.PY
+# In-memory cache of server details and membership for the chat server.
+# Reads are populated lazily from database.py; every server, membership and admin write the
+# server makes goes through the wrappers below so the cache is updated in the
+# same step (write-through) instead of expiring on a timer. With several worker
+# processes each has its own cache; set_write_listener() lets server.py tell the
+# other workers to drop a server this one changed. Login credentials
+# (user_id and password hash by username) are cached the same way, so a
+# reconnect storm does not query the users table once per login.
+import threading
+from collections import OrderedDict
+
+import database
+
+SERVER_CACHE_MAX_SERVERS = 1024 # Servers kept in each cache before the least recently used is evicted
+CREDENTIAL_CACHE_MAX_USERS = 10000 # Usernames whose credentials are kept
+
+
+class LRUCache:
+    """Small OrderedDict-based LRU map. Not thread-safe on its own; ServerCache locks around it."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        return self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ServerCache:
+    """server_id -> details and server_id -> {user_id: username}, bounded with LRU eviction.
+
+    Member maps are replaced, never mutated in place, so callers can iterate the
+    dict they were handed without holding the lock. Every write bumps a version
+    counter; a lazy load that raced with a write is returned but not stored, so
+    the cache never keeps data older than the last write.
+    """
+    def __init__(self, max_servers=SERVER_CACHE_MAX_SERVERS):
+        self._lock = threading.Lock()
+        self._details = LRUCache(max_servers)
+        self._members = LRUCache(max_servers)
+        self._version = 0
+        self.write_listener = None # Called with the server_id after every write-through
+
+    # --- Reads ---
+
+    def get_server_details(self, server_id):
+        with self._lock:
+            details = self._details.get(server_id)
+            version = self._version
+        if details is not None:
+            return dict(details)
+
+        details = database.get_server_details(server_id)
+        if details is not None:
+            with self._lock:
+                if self._version == version:
+                    self._details.put(server_id, dict(details))
+        return details
+
+    def get_member_map(self, server_id):
+        """Returns {user_id: username} for the server. Treat the dict as read-only."""
+        with self._lock:
+            members = self._members.get(server_id)
+            version = self._version
+        if members is not None:
+            return members
+
+        rows = database.get_server_members(server_id)
+        members = {row['user_id']: row['username'] for row in rows or ()}
+        if members: # Not a failed load (None) or an unknown server ({}); those are read again next time
+            with self._lock:
+                if self._version == version:
+                    self._members.put(server_id, members)
+        return members
+
+    def get_server_members(self, server_id):
+        """Same shape as database.get_server_members: [{'user_id', 'username'}] sorted by username."""
+        members = self.get_member_map(server_id)
+        return [{"user_id": user_id, "username": username}
+                for user_id, username in sorted(members.items(), key=lambda item: item[1])]
+
+    def is_user_member(self, user_id, server_id):
+        return user_id in self.get_member_map(server_id)
+
+    # --- Write-through ---
+
+    def create_server(self, server_name, admin_user_id, admin_username=None):
+        created = database.create_server(server_name, admin_user_id)
+        if created is not None:
+            server_id = created['server_id']
+            with self._lock:
+                self._version += 1
+                self._details.pop(server_id)
+                if admin_username is not None:
+                    self._members.put(server_id, {admin_user_id: admin_username})
+                else:
+                    self._members.pop(server_id)
+            self._written(server_id)
+        return created
+
+    def add_user_to_server(self, user_id, server_id, username=None):
+        added = database.add_user_to_server(user_id, server_id)
+        with self._lock:
+            self._version += 1
+            members = self._members.get(server_id)
+            if added and members is not None and username is not None:
+                updated = dict(members)
+                updated[user_id] = username
+                self._members.put(server_id, updated)
+            else:
+                self._members.pop(server_id)
+        self._written(server_id)
+        return added
+
+    def remove_user_from_server(self, user_id, server_id, kicked=False):
+        result = database.remove_user_from_server(user_id, server_id, kicked)
+        status = result.get("status")
+        with self._lock:
+            self._version += 1
+            members = self._members.get(server_id)
+            if status == "SUCCESS_LEFT" and members is not None:
+                updated = dict(members)
+                updated.pop(user_id, None)
+                self._members.put(server_id, updated)
+            else:
+                # Admin changes, server deletion and errors: reload both on next read
+                self._members.pop(server_id)
+                self._details.pop(server_id)
+        self._written(server_id)
+        return result
+
+    def update_server_admin(self, server_id, new_admin_id):
+        updated = database.update_server_admin(server_id, new_admin_id)
+        self.invalidate_server(server_id)
+        self._written(server_id)
+        return updated
+
+    def _written(self, server_id):
+        if self.write_listener is not None:
+            self.write_listener(server_id)
+
+    def invalidate_server(self, server_id):
+        with self._lock:
+            self._version += 1
+            self._details.pop(server_id)
+            self._members.pop(server_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._details.clear()
+            self._members.clear()
+
+
+class CredentialCache:
+    """username -> (user_id, password hash), bounded with LRU eviction. Unknown usernames are not cached."""
+    def __init__(self, max_users=CREDENTIAL_CACHE_MAX_USERS):
+        self._lock = threading.Lock()
+        self._credentials = LRUCache(max_users)
+        self._version = 0
+
+    def get_credentials(self, username):
+        with self._lock:
+            credentials = self._credentials.get(username)
+            version = self._version
+        if credentials is not None:
+            return credentials
+
+        credentials = database.get_user_credentials(username)
+        if credentials is not None:
+            with self._lock:
+                if self._version == version:
+                    self._credentials.put(username, credentials)
+        return credentials
+
+    def set_password_hash(self, user_id, username, password_hash):
+        updated = database.set_password_hash(user_id, password_hash)
+        with self._lock:
+            self._version += 1
+            if updated:
+                self._credentials.put(username, (user_id, password_hash))
+            else:
+                self._credentials.pop(username)
+        return updated
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._credentials.clear()
+
+
+_cache = ServerCache()
+_credential_cache = CredentialCache()
+
+get_server_details = _cache.get_server_details
+get_member_map = _cache.get_member_map
+get_server_members = _cache.get_server_members
+is_user_member = _cache.is_user_member
+create_server = _cache.create_server
+add_user_to_server = _cache.add_user_to_server
+remove_user_from_server = _cache.remove_user_from_server
+update_server_admin = _cache.update_server_admin
+invalidate_server = _cache.invalidate_server
+clear = _cache.clear
+get_credentials = _credential_cache.get_credentials
+set_password_hash = _credential_cache.set_password_hash
+clear_credentials = _credential_cache.clear
+
+def set_write_listener(callback):
+    """callback(server_id) runs after every server/membership/admin write made through this module."""
+    _cache.write_listener = callback
@@ -0,0 +1,177 @@
+# SERVER_LOGGING.PY
+# Logging setup for server.py and the modules it uses (database, traffic_log, presence).
+# Every module logs through its own logger under "chat" (e.g. "chat.server",
+# "chat.database"), so levels can be set per module. Records are handed to a
+# bounded queue by the calling thread and formatted/written by a QueueListener
+# thread, so a slow terminal or disk never stalls a request; when the queue is
+# full the record is dropped and counted. Repeated lines (same logger, level and
+# message template) are rate-limited. At the default INFO level nothing is
+# logged per message; per-request detail is at DEBUG. Forked worker processes
+# (server.py --workers) get a queue and writer thread of their own.
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_ROOT = "chat"
+LOG_LEVEL = "INFO" # Production default: no per-message lines
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_FORMATS = ("text", "json")
+LOG_FORMAT = "text"
+LOG_QUEUE_SIZE = 10000 # Records waiting for the writer thread before new ones are dropped
+LOG_RATE_LIMIT_BURST = 20 # Identical lines allowed per window...
+LOG_RATE_LIMIT_WINDOW = 10.0 # ...of this many seconds, before further ones are suppressed
+
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s %(name)s [%(process)d %(threadName)s] %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra= and goes into the JSON output
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+_queue_handler = None
+
+
+def get_logger(module_name):
+    """Logger for one module, e.g. get_logger("database") -> "chat.database"."""
+    return logging.getLogger(f"{LOG_ROOT}.{module_name}")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with extra= are included as-is."""
+    def format(self, record):
+        document = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                document[key] = value
+        if record.exc_info:
+            document["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document["exc_info"] = record.exc_text
+        return json.dumps(document, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records per (logger, level, message template) every window seconds.
+
+    The first record after a window with suppressed ones says how many were skipped.
+    """
+    def __init__(self, burst=LOG_RATE_LIMIT_BURST, window=LOG_RATE_LIMIT_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._lock = threading.Lock()
+        self._state = {} # key -> [window_start, count, suppressed]
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                skipped = state[2] if state else 0
+                self._state[key] = [now, 1, 0]
+            elif state[1] < self.burst:
+                state[1] += 1
+                return True
+            else:
+                state[2] += 1
+                self.suppressed += 1
+                return False
+        if skipped:
+            record.msg = f"{record.msg} (suppressed {skipped} similar lines in the last {self.window:g}s)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record and counts it."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_module_level(value):
+    """argparse type for --log-module-level: "database=DEBUG" -> ("database", "DEBUG")."""
+    module_name, separator, level = value.partition("=")
+    level = level.upper()
+    if not separator or not module_name or level not in LOG_LEVELS:
+        raise ValueError(f"expected MODULE=LEVEL with LEVEL one of {', '.join(LOG_LEVELS)}, got '{value}'")
+    return module_name, level
+
+
+def configure_logging(level=LOG_LEVEL, module_levels=(), log_format=LOG_FORMAT, log_file=None,
+                      queue_size=LOG_QUEUE_SIZE, rate_limit=True):
+    """Routes the "chat" loggers through a bounded queue to stderr (or log_file). Call once at startup."""
+    global _listener, _queue_handler
+    stop_logging()
+    if log_file:
+        output = logging.FileHandler(log_file, encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    if rate_limit:
+        _queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger(LOG_ROOT)
+    root.handlers[:] = [_queue_handler]
+    root.propagate = False
+    root.setLevel(level)
+    for module_name, module_level in module_levels:
+        get_logger(module_name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output)
+    _listener.start()
+    return _listener
+
+
+def _restart_after_fork():
+    """The writer thread does not survive fork(): give the child a fresh queue, filter and writer for the same outputs."""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    inherited = _queue_handler
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=inherited.queue.maxsize))
+    for log_filter in inherited.filters:
+        if isinstance(log_filter, RateLimitFilter): # Its lock may have been held by another thread at fork time
+            log_filter = RateLimitFilter(log_filter.burst, log_filter.window)
+        _queue_handler.addFilter(log_filter)
+    logging.getLogger(LOG_ROOT).handlers[:] = [_queue_handler]
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *_listener.handlers)
+    _listener.start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def dropped_records():
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def stop_logging():
+    """Writes out everything still queued and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,87 @@
+# TEST_FRAME_READER.PY
+# protocol.FrameReader must survive socket timeouts in the middle of a frame.
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+
+class ScriptedSocket:
+    """recv_into() hands out the scripted chunks in order; a None entry raises socket.timeout instead."""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise socket.timeout("timed out")
+        taken, rest = chunk[:len(view)], chunk[len(view):]
+        if rest:
+            self.chunks.insert(0, rest)
+        view[:len(taken)] = taken
+        return len(taken)
+
+
+def frame(message):
+    return bytes(protocol.encode_frame(message))
+
+
+def read_message(reader):
+    body, compressed = reader.read_frame()
+    return protocol.decode_body(body, compressed)
+
+
+def test_timeout_inside_large_frame_loses_nothing():
+    large = {"action": "SEND_CHAT_MESSAGE", "payload": {"message": "x" * 5000}}
+    data = frame(large) + frame({"action": "PING"})
+    sock = ScriptedSocket([data[:100], None, data[100:3000], None, data[3000:]])
+    reader = protocol.FrameReader(sock, buffer_size=1024)
+
+    received = []
+    while len(received) < 2:
+        try:
+            received.append(read_message(reader))
+        except socket.timeout:
+            continue
+    assert received == [large, {"action": "PING"}]
+
+
+def test_timeout_inside_small_frame_loses_nothing():
+    data = frame({"action": "PING", "payload": {"n": 1}})
+    sock = ScriptedSocket([data[:3], None, data[3:10], None, data[10:]])
+    reader = protocol.FrameReader(sock)
+
+    for _ in range(2):
+        try:
+            reader.read_frame()
+        except socket.timeout:
+            pass
+    assert read_message(reader) == {"action": "PING", "payload": {"n": 1}}
+
+
+def test_deadline_times_out_reads_only():
+    server_side, client_side = socket.socketpair()
+    try:
+        reader = protocol.FrameReader(server_side)
+        reader.deadline = time.monotonic() + 0.2
+        data = frame({"action": "LOGIN"})
+        client_side.sendall(data[:5]) # A frame that never completes
+        started = time.monotonic()
+        with pytest.raises(socket.timeout):
+            reader.read_frame()
+        assert 0.1 < time.monotonic() - started < 2
+        assert server_side.gettimeout() is None # Sends on the same socket are not affected
+
+        reader.deadline = None
+        client_side.sendall(data[5:])
+        assert read_message(reader) == {"action": "LOGIN"}
+    finally:
+        server_side.close()
+        client_side.close()
@@ -0,0 +1,33 @@
+# TEST_QUERY_PLANS.PY
+# The hot queries in database.HOT_QUERY_PLANS must use their indexes on a freshly
+# initialized (and fully migrated) database.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+
+
+@pytest.fixture
+def fresh_database(tmp_path):
+    previous_file = database.DATABASE_FILE
+    database.configure_connection_pool(database_file=str(tmp_path / "plans.db"))
+    database.initialize_database()
+    yield
+    database.configure_connection_pool(database_file=previous_file)
+
+
+def test_hot_queries_use_their_indexes(fresh_database):
+    assert database.check_query_plans() == []
+
+
+def test_every_hot_query_names_an_existing_index(fresh_database):
+    conn = database.get_connection()
+    try:
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    finally:
+        database.release_connection(conn)
+    missing = [name for name, _, _, index_name in database.HOT_QUERY_PLANS if index_name not in indexes]
+    assert missing == []
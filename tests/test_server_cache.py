@@ -0,0 +1,50 @@
+# TEST_SERVER_CACHE.PY
+# Write-through behaviour of server_cache.ServerCache against a temporary database.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import server_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    previous_file = database.DATABASE_FILE
+    database.configure_connection_pool(database_file=str(tmp_path / "cache.db"))
+    database.initialize_database()
+    yield server_cache.ServerCache()
+    database.configure_connection_pool(database_file=previous_file)
+
+
+def add_user(username):
+    assert database.add_user(username, "!")
+    return database.get_user_credentials(username)[0]
+
+
+def test_unknown_server_is_not_cached_as_empty(cache):
+    user_id = add_user("creator")
+    next_server_id = database.create_server("probe", user_id)["server_id"] + 1
+    assert not cache.is_user_member(user_id, next_server_id) # Looked up before it exists
+
+    created = cache.create_server("later", user_id, "creator")
+    assert created["server_id"] == next_server_id
+    assert cache.is_user_member(user_id, next_server_id)
+
+
+def test_create_server_without_username_reloads_members(cache):
+    user_id = add_user("creator")
+    server_id = cache.create_server("plain", user_id)["server_id"]
+    assert cache.get_member_map(server_id) == {user_id: "creator"}
+
+
+def test_failed_member_load_is_not_cached(cache, monkeypatch):
+    user_id = add_user("member")
+    server_id = cache.create_server("flaky", user_id)["server_id"]
+    cache.invalidate_server(server_id)
+    monkeypatch.setattr(database, "get_server_members", lambda server_id: None)
+    assert cache.get_member_map(server_id) == {}
+    monkeypatch.undo()
+    assert cache.is_user_member(user_id, server_id)
@@ -0,0 +1,212 @@
+# TRAFFIC_LOG.PY
+# Asynchronous, batched logging of the JSON traffic between server and clients.
+# Callers only append an entry to a bounded in-process queue; a background worker
+# drains it and writes batches to a sink (MongoDB via insert_many, or a JSON-lines
+# file), so no send or receive ever waits on a logging round-trip. When the queue
+# is full the entry is dropped and counted instead of blocking the caller.
+import datetime
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+import protocol
+
+try:
+    import pymongo # Optional: only needed for the MongoDB sink
+except ImportError:
+    pymongo = None
+
+logger = logging.getLogger("chat.traffic_log")
+
+TRAFFIC_LOG_MONGODB_URI = "mongodb://localhost:27017/" # Default local MongoDB URI
+TRAFFIC_LOG_MONGODB_DATABASE = "chat_app_logs"
+TRAFFIC_LOG_MONGODB_COLLECTION = "message_traffic"
+TRAFFIC_LOG_MONGODB_TIMEOUT_MS = 2000 # How long the startup ping may take before logging is disabled
+
+TRAFFIC_LOG_QUEUE_SIZE = 10000 # Entries waiting to be written before new ones are dropped
+TRAFFIC_LOG_BATCH_SIZE = 500 # Max entries per insert_many / file write
+TRAFFIC_LOG_FLUSH_INTERVAL_MS = 200 # Max time an entry waits for its batch to fill up
+TRAFFIC_LOG_SAMPLE_RATE = 1.0 # Fraction of eligible messages that are logged
+
+# Level controls which directions are logged at all
+TRAFFIC_LOG_LEVELS = ("off", "received", "all")
+TRAFFIC_LOG_LEVEL = "all"
+TRAFFIC_LOG_LEVEL_DIRECTIONS = {
+    "off": (),
+    "received": ("RECEIVED_FROM_CLIENT",),
+    "all": ("RECEIVED_FROM_CLIENT", "SENT_TO_CLIENT"),
+}
+
+
+class TrafficLogSinkError(Exception):
+    """Raised when a sink cannot be opened."""
+
+
+class MongoSink:
+    """Writes batches to a MongoDB collection with insert_many.
+
+    Any object with a pymongo-compatible insert_many works as the collection,
+    e.g. mongomock.MongoClient()["db"]["collection"].
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    @classmethod
+    def connect(cls, uri=TRAFFIC_LOG_MONGODB_URI, database_name=TRAFFIC_LOG_MONGODB_DATABASE,
+                collection_name=TRAFFIC_LOG_MONGODB_COLLECTION, timeout_ms=TRAFFIC_LOG_MONGODB_TIMEOUT_MS):
+        if pymongo is None:
+            raise TrafficLogSinkError("pymongo is not installed")
+        try:
+            client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=timeout_ms)
+            client.admin.command('ping') # Test connection
+        except Exception as e:
+            raise TrafficLogSinkError(f"MongoDB connection failed: {e}") from e
+        return cls(client[database_name][collection_name])
+
+    def write_batch(self, entries):
+        self.collection.insert_many(entries, ordered=False)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """Appends one JSON document per line to a file. Useful without a MongoDB instance."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write_batch(self, entries):
+        self._file.write("".join(json.dumps(entry, default=str) + "\n" for entry in entries))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TrafficLogger:
+    """Bounded queue + background batch writer in front of a sink."""
+    _STOP = object()
+
+    def __init__(self, sink, queue_size=None, batch_size=None, flush_interval_ms=None,
+                 sample_rate=None, level=None):
+        self.sink = sink
+        self.batch_size = batch_size or TRAFFIC_LOG_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else TRAFFIC_LOG_FLUSH_INTERVAL_MS) / 1000.0
+        self.sample_rate = TRAFFIC_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.level = level or TRAFFIC_LOG_LEVEL
+        if self.level not in TRAFFIC_LOG_LEVELS:
+            raise ValueError(f"Unknown traffic log level '{self.level}'")
+        self.directions = TRAFFIC_LOG_LEVEL_DIRECTIONS[self.level]
+        self._queue = queue.Queue(maxsize=queue_size or TRAFFIC_LOG_QUEUE_SIZE)
+        self._counter_lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped_queue_full = 0
+        self.dropped_write_failed = 0
+        self._worker = threading.Thread(target=self._run, name="traffic-log-writer", daemon=True)
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self._worker.start()
+        return self
+
+    def wants(self, direction):
+        """Cheap pre-check so callers can skip building log arguments entirely."""
+        return direction in self.directions and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def log(self, direction, client_addr, user_details, message, codec=None, compressor=None):
+        """Queues one entry. message is a dict or a complete encoded frame (bytes/memoryview) in codec (JSON if None).
+
+        Never blocks: returns False and counts a drop if the queue is full.
+        """
+        entry = (datetime.datetime.now(datetime.timezone.utc), direction, client_addr, user_details, message, codec, compressor)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._counter_lock:
+                self.dropped_queue_full += 1
+                dropped = self.dropped_queue_full
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning("Queue full, %s entries dropped so far.", dropped)
+            return False
+        with self._counter_lock:
+            self.enqueued += 1
+        return True
+
+    @staticmethod
+    def _build_document(entry):
+        timestamp, direction, client_addr, user_details, message, codec, compressor = entry
+        if not isinstance(message, dict): # Encoded frame: decode off the hot path
+            try:
+                message = protocol.decode_frame(message, codec or protocol.JSON, compressor)
+            except ValueError:
+                message = {"undecodable": bytes(message[protocol.MSG_LENGTH_PREFIX_SIZE:]).decode("utf-8", "replace")}
+        return {
+            "timestamp_utc": timestamp, # Store as UTC
+            "direction": direction,  # "SENT_TO_CLIENT" or "RECEIVED_FROM_CLIENT"
+            "client_ip": client_addr[0] if client_addr else None,
+            "client_port": client_addr[1] if client_addr else None,
+            "user_id": user_details.get("user_id") if user_details else None,
+            "username": user_details.get("username") if user_details else None,
+            "message_json": message
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is self._STOP:
+                break
+            batch = [entry]
+            flush_at = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = flush_at - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is self._STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._write(batch)
+
+    def _write(self, batch):
+        documents = [self._build_document(entry) for entry in batch]
+        try:
+            self.sink.write_batch(documents)
+        except Exception as e:
+            logger.error("Error writing batch of %s entries: %s", len(documents), e)
+            with self._counter_lock:
+                self.dropped_write_failed += len(documents)
+            return
+        with self._counter_lock:
+            self.written += len(documents)
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped_queue_full": self.dropped_queue_full,
+                "dropped_write_failed": self.dropped_write_failed,
+            }
+
+    def stop(self):
+        """Flushes everything already queued, then stops the worker and closes the sink."""
+        if self._started:
+            self._queue.put(self._STOP) # Blocks only if the queue is full, while the worker drains it
+            self._worker.join()
+        try:
+            self.sink.close()
+        except Exception as e:
+            logger.warning("Error closing sink: %s", e)
+        logger.info("Stopped. %s", self.stats())
+
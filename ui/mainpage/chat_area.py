@@ -191,7 +191,7 @@ class ChatArea(QWidget):
 
         self.setLayout(m_layout)
 
-    def add_message(self, username, text, timestamp, is_admin, is_sender, server_id): # <<< Add server_id
+    def add_message(self, username, text, timestamp, is_admin, is_sender, server_id, index=None): # <<< Add server_id
         now = datetime.now()
         current_time = timestamp
 
@@ -207,7 +207,11 @@ class ChatArea(QWidget):
             else:
                 message.joinChallengeClicked.connect(lambda sid=server_id: self.joinChallenge.emit(sid))
 
-        self.m_container_layout.addWidget(message)
+        if index is None:
+            self.m_container_layout.addWidget(message)
+        else:
+            self.m_container_layout.insertWidget(index, message) # Older history page
+            return
 
         # Scroll reliably using a delayed scroll on the vertical scrollbar
         def scroll_later():